@@ -1,10 +1,11 @@
 from tapiriik.database import db, close_connections
 from tapiriik.settings import RABBITMQ_BROKER_URL, MONGO_HOST, MONGO_FULL_WRITE_CONCERN
 from tapiriik import settings
+from tapiriik.requests_lib import configure_source_address
 from datetime import datetime
 
 from celery import Celery
-from celery.signals import worker_shutdown
+from celery.signals import worker_shutdown, worker_process_init
 from datetime import datetime
 
 class _celeryConfig:
@@ -21,6 +22,12 @@ celery_app.config_from_object(_celeryConfig())
 def celery_shutdown(**kwargs):
     close_connections()
 
+@worker_process_init.connect
+def celery_process_init(**kwargs):
+    # Rollbacks delete activities through the services, so they go out the same way syncs do
+    # (not at import time, since the web app imports this module to schedule them)
+    configure_source_address(settings.WORKER_AFFINITY, settings.WORKER_INDEX)
+
 @celery_app.task()
 def rollback_task(task_id):
     from tapiriik.services.rollback import RollbackTask
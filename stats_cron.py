@@ -1,5 +1,6 @@
 from tapiriik.database import db, close_connections
 from tapiriik.settings import RABBITMQ_USER_QUEUE_STATS_URL
+from tapiriik.sync import Sync
 from datetime import datetime, timedelta
 import requests
 
@@ -26,7 +27,9 @@ else:
 
 # How long users are taking to get pushed into rabbitMQ
 # Once called "queueHead" as, a very long time ago, this _was_ user queuing
-enqueueHead = list(db.users.find({"QueuedAt": {"$lte": datetime.utcnow()}, "SynchronizationWorker": None, "SynchronizationHostRestriction": {"$exists": False}}, {"QueuedAt": 1}).sort("QueuedAt").limit(10))
+enqueueHeadQuery = {"QueuedAt": {"$lte": datetime.utcnow()}, "SynchronizationHostRestriction": {"$exists": False}}
+enqueueHeadQuery.update(Sync.UnlockedUserMongoQuery())
+enqueueHead = list(db.users.find(enqueueHeadQuery, {"QueuedAt": 1}).sort("QueuedAt").limit(10))
 enqueueTime = timedelta(0)
 if len(enqueueHead):
     for pendingEnqueueUser in enqueueHead:
@@ -52,7 +55,7 @@ else:
 
 # error/pending/locked stats
 lockedSyncRecords = list(db.users.aggregate([
-                                       {"$match": {"SynchronizationWorker": {"$ne": None}}},
+                                       {"$match": Sync.LockedUserMongoQuery()},
                                        {"$group": {"_id": None, "count": {"$sum": 1}}}
                                        ]))
 if len(lockedSyncRecords) > 0:
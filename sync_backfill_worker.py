@@ -0,0 +1,56 @@
+from tapiriik.database import db, close_connections
+from tapiriik.settings import RABBITMQ_BROKER_URL
+from tapiriik import settings
+from tapiriik.requests_lib import patch_requests_with_default_timeout, configure_source_address
+from tapiriik.cpu_budget import apply_configured_worker_cpu_limit
+from bson.objectid import ObjectId
+
+from celery import Celery
+from celery.signals import worker_shutdown, worker_process_init
+
+patch_requests_with_default_timeout(timeout=60)
+
+cpu_throttle = None
+
+class _celeryConfig:
+    CELERY_ROUTES = {
+        "sync_backfill_worker.backfill_task": {"queue": "tapiriik-backfill"}
+    }
+    CELERYD_CONCURRENCY = 1
+    CELERYD_PREFETCH_MULTIPLIER = 1
+
+celery_app = Celery('sync_backfill_worker', broker=RABBITMQ_BROKER_URL)
+celery_app.config_from_object(_celeryConfig())
+
+@worker_shutdown.connect
+def celery_shutdown(**kwargs):
+    close_connections()
+
+@worker_process_init.connect
+def celery_process_init(**kwargs):
+    # Backfills go through the same services as regular syncs, so each pool process gets the same setup a sync_worker does (before the services are imported)
+    # Not at import time - sync.py imports this module too, to schedule backfills from wherever they're requested
+    global cpu_throttle
+    configure_source_address(settings.WORKER_AFFINITY, settings.WORKER_INDEX)
+    cpu_throttle = apply_configured_worker_cpu_limit()
+
+def backfill_heartbeat(step):
+    if cpu_throttle:
+        cpu_throttle()
+
+@celery_app.task()
+def backfill_task(user_id):
+    from tapiriik.sync import Sync
+    user = db.users.find_one({"_id": ObjectId(user_id)})
+    if not user:
+        return
+    print("Backfilling user %s" % user_id)
+    delay = Sync.PerformUserBackfill(user, heartbeat_callback=backfill_heartbeat)
+    if delay is not None:
+        # Each slice is its own task, so other users' backfills get a turn in between.
+        backfill_task.apply_async(args=[user_id], countdown=delay.total_seconds())
+    else:
+        print("Finished backfill for user %s" % user_id)
+
+def schedule_backfill_task(user_id):
+    backfill_task.apply_async(args=[user_id])
@@ -1,11 +1,12 @@
 from tapiriik.database import db, close_connections
+from tapiriik.sync import Sync
 from datetime import datetime, timedelta
 # I resisted calling this file sync_watchdog_watchdog.py, but that's what it is.
 # Normally a watchdog process runs on each server and detects hung/crashed
 # synchronization tasks, returning them to the queue for another worker to pick
 # up. Except, if the entire server goes down, the watchdog no longer runs and
-# users get stuck. So, we need a watchdog for the watchdogs. A separate process
-# reschedules users left stranded by a failed server/process.
+# its worker records stick around. So, we need a watchdog for the watchdogs.
+# (users held by a failed server are released by their lock leases expiring)
 
 SERVER_WATCHDOG_TIMEOUT = timedelta(minutes=5)
 
@@ -13,9 +14,11 @@ print("Global sync watchdog run at %s" % datetime.now())
 
 for host_record in db.sync_watchdogs.find():
     if datetime.utcnow() - host_record["Timestamp"] > SERVER_WATCHDOG_TIMEOUT:
-        print("Releasing users held by %s (last check-in %s)" % (host_record["Host"], host_record["Timestamp"]))
-        db.users.update({"SynchronizationHost": host_record["Host"]}, {"$unset": {"SynchronizationWorker": True}}, multi=True)
+        print("Releasing workers on %s (last check-in %s)" % (host_record["Host"], host_record["Timestamp"]))
         db.sync_workers.remove({"Host": host_record["Host"]}, multi=True)
         db.sync_watchdogs.remove({"_id": host_record["_id"]})
 
+# Transfers lost somewhere in the staged pipeline, along with the extended auth details they were holding on to
+Sync.ClearExpiredTransfers()
+
 close_connections()
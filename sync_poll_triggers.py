@@ -1,12 +1,11 @@
 from tapiriik.database import db, close_connections
-from tapiriik.requests_lib import patch_requests_source_address
+from tapiriik.requests_lib import configure_source_address
 from tapiriik.settings import RABBITMQ_BROKER_URL, MONGO_HOST, MONGO_FULL_WRITE_CONCERN
 from tapiriik import settings
 from datetime import datetime
 
-if isinstance(settings.HTTP_SOURCE_ADDR, list):
-    settings.HTTP_SOURCE_ADDR = settings.HTTP_SOURCE_ADDR[0]
-    patch_requests_source_address((settings.HTTP_SOURCE_ADDR, 0))
+# Before the services are imported - they take their own copy of the setting
+configure_source_address(settings.WORKER_AFFINITY, settings.WORKER_INDEX)
 
 from tapiriik.services import Service
 from celery import Celery
@@ -44,7 +43,7 @@ def trigger_poll(service_id, index):
     trigger_users_query = User.PaidUserMongoQuery()
     trigger_users_query.update({"ConnectedServices.ID": {"$in": affected_connection_ids}})
     trigger_users_query.update({"Config.suppress_auto_sync": {"$ne": True}})
-    db.users.update(trigger_users_query, {"$set": {"NextSynchronization": datetime.utcnow()}}, multi=True) # It would be nicer to use the Sync.Schedule... method, but I want to cleanly do this in bulk
+    db.users.update(trigger_users_query, {"$set": {"NextSynchronization": datetime.utcnow()}, "$unset": {"NextSyncIsPeriodic": True}}, multi=True) # It would be nicer to use the Sync.Schedule... method, but I want to cleanly do this in bulk
 
     db.poll_stats.insert({"Service": service_id, "Index": index, "Timestamp": datetime.utcnow(), "TriggerCount": len(affected_connection_external_ids)})
 
@@ -29,4 +29,4 @@ def trigger_remote(service_id, affected_connection_external_ids):
     trigger_users_query = User.PaidUserMongoQuery()
     trigger_users_query.update({"ConnectedServices.ID": {"$in": affected_connection_ids}})
     trigger_users_query.update({"Config.suppress_auto_sync": {"$ne": True}})
-    db.users.update(trigger_users_query, {"$set": {"NextSynchronization": datetime.utcnow()}}, multi=True) # It would be nicer to use the Sync.Schedule... method, but I want to cleanly do this in bulk
+    db.users.update(trigger_users_query, {"$set": {"NextSynchronization": datetime.utcnow()}, "$unset": {"NextSyncIsPeriodic": True}}, multi=True) # It would be nicer to use the Sync.Schedule... method, but I want to cleanly do this in bulk
@@ -1,34 +1,122 @@
 from tapiriik.database import db
 from tapiriik.sync import Sync
-from datetime import datetime
+from tapiriik.settings import RABBITMQ_USER_QUEUE_STATS_URL
+from datetime import datetime, timedelta
 from pymongo.read_preferences import ReadPreference
 import kombu
+import requests
 import time
+import urllib.parse
 import uuid
 
+# Once the queue holds this much of a backlog, there's no point piling more periodic syncs on top of it - they'll just go stale together.
+# User-initiated and triggered syncs are always let through.
+PERIODIC_SYNC_QUEUE_WAIT_THRESHOLD = timedelta(minutes=10)
+QUEUE_STATS_REFRESH_INTERVAL = timedelta(seconds=30)
+
 Sync.InitializeWorkerBindings()
 
 producer = kombu.Producer(Sync._channel, Sync._exchange)
 
-while True:
-    generation = str(uuid.uuid4())
-    queueing_at = datetime.utcnow()
-    users = list(db.users.with_options(read_preference=ReadPreference.PRIMARY).find(
-                {
-                    "NextSynchronization": {"$lte": datetime.utcnow()},
-                    "QueuedAt": {"$exists": False}
-                },
+slots_released_at = None
+queue_stats_fetched_at = None
+periodic_allowances = {}
+
+def queue_stats_url(queue_name):
+    # RABBITMQ_USER_QUEUE_STATS_URL is for the general queue - the affinity queues' stats are right alongside it
+    url = urllib.parse.urlsplit(RABBITMQ_USER_QUEUE_STATS_URL)
+    return urllib.parse.urlunsplit(url._replace(path=url.path.rsplit("/", 1)[0] + "/" + queue_name))
+
+def periodic_sync_allowance(queue_name):
+    # How many periodic syncs we can add to this queue before the estimated wait crosses the threshold - None if there's no limit
+    # Same figures stats_cron uses for QueueHeadTime
+    try:
+        queue_stats = requests.get(queue_stats_url(queue_name), timeout=10).json()
+        queue_length = queue_stats["messages_ready"]
+        queue_rate = queue_stats["message_stats"]["ack_details"]["avg_rate"]
+    except Exception as e:
+        # Better to carry on as normal than stop scheduling people entirely
+        print("Could not fetch %s stats - %s" % (queue_name, e))
+        return None
+    if not queue_length:
+        return None
+    if not queue_rate:
+        print("%s of %d isn't moving, holding back periodic syncs" % (queue_name, queue_length))
+        return 0
+    queue_wait = timedelta(seconds=queue_length / queue_rate)
+    allowance = max(0, int((PERIODIC_SYNC_QUEUE_WAIT_THRESHOLD - queue_wait).total_seconds() * queue_rate))
+    print("%s wait %s (%d @ %f/s), allowing %d periodic syncs" % (queue_name, queue_wait, queue_length, queue_rate, allowance))
+    return allowance
+
+def periodic_sync_allowances():
+    # Each affinity pool works through its own queue, so a backlog in one shouldn't hold back (or be hidden by) the others
+    # Keyed by routing key, as Sync.GetRoutingKey gives them - host-restricted users aren't limited
+    allowances = {"": periodic_sync_allowance(Sync._global_queue.name)}
+    for service_id, queue in Sync._affinity_queues.items():
+        allowances[Sync._affinityRoutingKey(service_id)] = periodic_sync_allowance(queue.name)
+    return allowances
+
+def find_due_users(periodic):
+    query = {
+        "NextSynchronization": {"$lte": datetime.utcnow()},
+        "QueuedAt": {"$exists": False},
+        "NextSyncIsPeriodic": True if periodic else {"$ne": True}
+    }
+    cursor = db.users.with_options(read_preference=ReadPreference.PRIMARY).find(
+                query,
                 {
                     "_id": True,
-                    "SynchronizationHostRestriction": True
+                    "SynchronizationHostRestriction": True,
+                    "ConnectedServices.Service": True,
+                    "ServiceTraffic": True
                 }
-            ))
+            )
+    if periodic:
+        # Whoever's been waiting longest goes first
+        cursor = cursor.sort("NextSynchronization")
+    return cursor
+
+def find_due_periodic_users(allowances):
+    # Takes as many as each queue's allowance has room for, and uses it up
+    def exhausted():
+        return all(allowance is not None and allowance <= 0 for allowance in allowances.values())
+    users = []
+    if exhausted():
+        return users
+    for user in find_due_users(periodic=True):
+        routing_key = Sync.GetRoutingKey(user)
+        allowance = allowances.get(routing_key)
+        if allowance is None:
+            users.append(user)
+        elif allowance > 0:
+            allowances[routing_key] = allowance - 1
+            users.append(user)
+            if exhausted():
+                break
+    return users
+
+while True:
+    generation = str(uuid.uuid4())
+    queueing_at = datetime.utcnow()
+
+    if not queue_stats_fetched_at or datetime.utcnow() - queue_stats_fetched_at > QUEUE_STATS_REFRESH_INTERVAL:
+        periodic_allowances = periodic_sync_allowances()
+        queue_stats_fetched_at = datetime.utcnow()
+
+    users = list(find_due_users(periodic=False))
+    users += find_due_periodic_users(periodic_allowances)
+
     scheduled_ids = [x["_id"] for x in users]
     print("Found %d users at %s" % (len(scheduled_ids), datetime.utcnow()))
-    db.users.update({"_id": {"$in": scheduled_ids}}, {"$set": {"QueuedAt": queueing_at, "QueuedGeneration": generation}, "$unset": {"NextSynchronization": True}}, multi=True)
+    db.users.update({"_id": {"$in": scheduled_ids}}, {"$set": {"QueuedAt": queueing_at, "QueuedGeneration": generation}, "$unset": {"NextSynchronization": True, "NextSyncIsPeriodic": True}}, multi=True)
     print("Marked %d users as queued at %s" % (len(scheduled_ids), datetime.utcnow()))
     for user in users:
-        producer.publish({"user_id": str(user["_id"]), "generation": generation}, routing_key=user["SynchronizationHostRestriction"] if "SynchronizationHostRestriction" in user and user["SynchronizationHostRestriction"] else "")
+        producer.publish({"user_id": str(user["_id"]), "generation": generation}, routing_key=Sync.GetRoutingKey(user))
     print("Scheduled %d users at %s" % (len(scheduled_ids), datetime.utcnow()))
 
+    # Bookings made by Sync._allocateSyncSlot are only useful until the slot passes
+    if not slots_released_at or datetime.utcnow() - slots_released_at > Sync.SyncSlotLength:
+        Sync.ReleaseElapsedSyncSlots()
+        slots_released_at = datetime.utcnow()
+
     time.sleep(1)
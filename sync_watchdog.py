@@ -3,7 +3,7 @@ from tapiriik.sync import SyncStep
 import os
 import signal
 import socket
-from datetime import timedelta, datetime
+from datetime import datetime
 
 print("Sync watchdog run at %s" % datetime.now())
 
@@ -19,10 +19,7 @@ for worker in db.sync_workers.find({"Host": host}):
         alive = False
 
     # Has it been stalled for too long?
-    if worker["State"] == SyncStep.List:
-        timeout = timedelta(minutes=45)  # This can take a loooooooong time
-    else:
-        timeout = timedelta(minutes=10)  # But everything else shouldn't
+    timeout = SyncStep.StallTimeout(worker["State"])
 
     if alive and worker["Heartbeat"] < datetime.utcnow() - timeout:
         print("%s timed out" % worker)
@@ -30,10 +27,9 @@ for worker in db.sync_workers.find({"Host": host}):
         alive = False
 
     # Clear it from the database if it's not alive.
+    # Users it was holding don't need unlocking - their lock leases will have lapsed by themselves.
     if not alive:
         db.sync_workers.remove({"_id": worker["_id"]})
-        # Unlock users attached to it.
-        db.users.update({"SynchronizationWorker": worker["Process"], "SynchronizationHost": host}, {"$unset":{"SynchronizationWorker": True}}, multi=True)
 
 db.sync_watchdogs.update({"Host": host}, {"Host": host, "Timestamp": datetime.utcnow()}, upsert=True)
 
@@ -7,7 +7,8 @@ def worker_message(state):
 
 worker_message("booting")
 
-from tapiriik.requests_lib import patch_requests_with_default_timeout, patch_requests_source_address
+from tapiriik.requests_lib import patch_requests_with_default_timeout, configure_source_address
+from tapiriik.cpu_budget import apply_configured_worker_cpu_limit
 from tapiriik import settings
 from tapiriik.database import db, close_connections
 from pymongo import ReturnDocument
@@ -16,12 +17,16 @@ import subprocess
 import socket
 
 RecycleInterval = 2 # Time spent rebooting workers < time spent wrangling Python memory management.
+StageRecycleInterval = 25 # Stage workers handle one activity at a time, rather than entire users
 
 oldCwd = os.getcwd()
 WorkerVersion = subprocess.Popen(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE, cwd=os.path.dirname(__file__)).communicate()[0].strip()
 os.chdir(oldCwd)
 
 def sync_heartbeat(state, user=None):
+    # Throttling first, so the heartbeat we record is from after any time spent asleep
+    if cpu_throttle:
+        cpu_throttle()
     db.sync_workers.update({"_id": heartbeat_rec_id}, {"$set": {"Heartbeat": datetime.utcnow(), "State": state, "User": user}})
 
 worker_message("initialized")
@@ -48,6 +53,8 @@ heartbeat_rec = db.sync_workers.find_one_and_update(
 			"Startup":  datetime.utcnow(),
 			"Version": WorkerVersion,
 			"Index": settings.WORKER_INDEX,
+			"Affinity": settings.WORKER_AFFINITY,
+			"Stage": settings.WORKER_STAGE,
 			"State": "startup"
 		}
 	}, upsert=True,
@@ -56,11 +63,11 @@ heartbeat_rec_id = heartbeat_rec["_id"]
 
 patch_requests_with_default_timeout(timeout=60)
 
-if isinstance(settings.HTTP_SOURCE_ADDR, list):
-    settings.HTTP_SOURCE_ADDR = settings.HTTP_SOURCE_ADDR[settings.WORKER_INDEX % len(settings.HTTP_SOURCE_ADDR)]
-    patch_requests_source_address((settings.HTTP_SOURCE_ADDR, 0))
+cpu_throttle = apply_configured_worker_cpu_limit()
 
-print(" %d -> Index %s\n -> Interface %s" % (os.getpid(), settings.WORKER_INDEX, settings.HTTP_SOURCE_ADDR))
+configure_source_address(settings.WORKER_AFFINITY, settings.WORKER_INDEX)
+
+print(" %d -> Index %s\n -> Affinity %s\n -> Stage %s\n -> Interface %s" % (os.getpid(), settings.WORKER_INDEX, settings.WORKER_AFFINITY, settings.WORKER_STAGE, settings.HTTP_SOURCE_ADDR))
 
 # We defer including the main body of the application till here so the settings aren't captured before we've set them up.
 # The better way would be to defer initializing services until they're requested, but it's 10:30 and this will work just as well.
@@ -72,7 +79,7 @@ sync_heartbeat("ready")
 
 worker_message("ready")
 
-Sync.PerformGlobalSync(heartbeat_callback=sync_heartbeat, version=WorkerVersion, max_users=RecycleInterval)
+Sync.PerformGlobalSync(heartbeat_callback=sync_heartbeat, version=WorkerVersion, max_users=StageRecycleInterval if settings.WORKER_STAGE else RecycleInterval)
 
 worker_message("shutting down cleanly")
 db.sync_workers.remove({"_id": heartbeat_rec_id})
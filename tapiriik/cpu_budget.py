@@ -0,0 +1,72 @@
+# Keeps each sync worker to its share of the CPU, so one user with a pile of giant activities can't starve everyone else on the host.
+# Where the kernel can do it for us (cgroup v2 cpu.max) it does, and there's nothing more to it.
+# Otherwise, the worker sleeps itself back down to its budget every time it heartbeats - those are frequent enough to keep it close.
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+CGROUP_CPU_PERIOD = 100000 # microseconds
+CGROUP_CPU_MIN_QUOTA = 1000 # The kernel won't take anything smaller
+COOPERATIVE_BUDGET_WINDOW = 10 # seconds - so time spent idle waiting for work doesn't bank an unlimited amount of CPU for later
+COOPERATIVE_MAX_SLEEP = 60 # seconds - well short of SyncStep.StallTimeout, so a big debt (e.g. from parsing a huge file at a low limit) is paid off over several heartbeats instead of looking like a hung worker
+
+def _place_in_cgroup(cgroup_root, limit):
+    # Workers that have since exited leave empty cgroups behind - rmdir cleans those up, and fails harmlessly on the ones still in use.
+    for name in os.listdir(cgroup_root):
+        if name.startswith("worker-"):
+            try:
+                os.rmdir(os.path.join(cgroup_root, name))
+            except OSError:
+                pass
+
+    cgroup = os.path.join(cgroup_root, "worker-%d" % os.getpid())
+    if not os.path.isdir(cgroup):
+        os.mkdir(cgroup)
+    quota = max(CGROUP_CPU_MIN_QUOTA, int(CGROUP_CPU_PERIOD * limit / 100))
+    with open(os.path.join(cgroup, "cpu.max"), "w") as f:
+        f.write("%d %d" % (quota, CGROUP_CPU_PERIOD))
+    with open(os.path.join(cgroup, "cgroup.procs"), "w") as f:
+        f.write(str(os.getpid()))
+
+class CooperativeCPUBudget:
+    def __init__(self, limit):
+        self._fraction = limit / 100
+        self._reset()
+
+    def _reset(self):
+        self._cpu_start = time.process_time()
+        self._wall_start = time.monotonic()
+
+    def Throttle(self):
+        cpu_used = time.process_time() - self._cpu_start
+        wall_elapsed = time.monotonic() - self._wall_start
+        owed = cpu_used / self._fraction - wall_elapsed
+        if owed > 0:
+            slept = min(owed, COOPERATIVE_MAX_SLEEP)
+            time.sleep(slept)
+            wall_elapsed += slept
+            owed -= slept
+        # Whatever's still owed carries over to the next call
+        if owed <= 0 and wall_elapsed >= COOPERATIVE_BUDGET_WINDOW:
+            self._reset()
+
+def apply_worker_cpu_limit(limit, cgroup_root=None):
+    # limit is a percentage of a single core, as cpulimit's -l took.
+    # Returns a function to call periodically from the worker (or None, if there's no need).
+    if cgroup_root:
+        try:
+            _place_in_cgroup(cgroup_root, limit)
+        except OSError as e:
+            logger.warning("Could not place worker in cgroup under %s (%s), falling back to cooperative CPU budget" % (cgroup_root, e))
+        else:
+            return None
+    return CooperativeCPUBudget(limit).Throttle
+
+def apply_configured_worker_cpu_limit():
+    # The WORKER_CPU_LIMIT/WORKER_CGROUP settings, for whichever kind of worker this is - returns the same as apply_worker_cpu_limit
+    from tapiriik import settings
+    if not settings.WORKER_CPU_LIMIT:
+        return None
+    return apply_worker_cpu_limit(settings.WORKER_CPU_LIMIT, settings.WORKER_CGROUP)
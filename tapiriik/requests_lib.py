@@ -30,6 +30,24 @@ def patch_requests_source_address(new_source_address):
 			return old_create_connection(address, timeout, source_address)
 	socket.create_connection = new_create_connection
 
+def resolve_source_address(source_address, affinity=None, index=0):
+	# HTTP_SOURCE_ADDR is an address, a list of them (spread across workers by index), or a dict of WORKER_AFFINITY -> either of those (None being the general pool)
+	if isinstance(source_address, dict):
+		source_address = source_address.get(affinity, source_address.get(None, "0.0.0.0"))
+	if isinstance(source_address, list):
+		source_address = source_address[index % len(source_address)]
+	return source_address
+
+def configure_source_address(affinity=None, index=0):
+	# Pins settings.HTTP_SOURCE_ADDR down to the one address this process uses, and sends outgoing HTTP(S) from it.
+	# Call it before the services are imported - some of them take their own copy of the setting.
+	from tapiriik import settings
+	configured = settings.HTTP_SOURCE_ADDR
+	settings.HTTP_SOURCE_ADDR = resolve_source_address(configured, affinity, index)
+	if not isinstance(configured, str):
+		patch_requests_source_address((settings.HTTP_SOURCE_ADDR, 0))
+	return settings.HTTP_SOURCE_ADDR
+
 def patch_requests_user_agent(user_agent):
 	import requests
 	old_request = requests.Session.request
@@ -300,13 +300,14 @@ class BeginnerTriathleteService(ServiceBase):
 
                 if contentType:
                     if contentType == _DeviceFileTypes.FIT:
-                        # Oh no! Not supported! So close ....
-                        # FITIO.Parse(res.content, activity)
-                        return activity
+                        FITIO.Parse(res.content, activity)
+                        activity.PrerenderedFormats["fit"] = res.content
                     if contentType == _DeviceFileTypes.TCX:
                         TCXIO.Parse(res.content, activity)
+                        activity.PrerenderedFormats["tcx"] = res.content
                     if contentType == _DeviceFileTypes.GPX:
                         GPXIO.Parse(res.content, activity)
+                        activity.PrerenderedFormats["gpx"] = res.content
             except ValueError as e:
                 raise APIExcludeActivity("Parse error " + deviceUploadFile + " " + str(e),
                                          user_exception=UserException(UserExceptionType.Corrupt),
@@ -2,6 +2,7 @@ from datetime import datetime, timedelta
 from django.core.urlresolvers import reverse
 from tapiriik.database import cachedb
 from tapiriik.services.api import APIException, ServiceExceptionScope, UserException, UserExceptionType, APIExcludeActivity, ServiceException
+from tapiriik.services.compression import ActivityFileCompression
 from tapiriik.services.exception_tools import strip_context
 from tapiriik.services.gpx import GPXIO
 from tapiriik.services.interchange import ActivityType, UploadedActivity
@@ -126,21 +127,33 @@ class DropboxService(ServiceBase):
                 return act
         return None
 
-    def _getActivity(self, serviceRecord, dbcl, path, base_activity=None):
+    def _getActivity(self, serviceRecord, dbcl, path, base_activity=None, metadata_only=False):
         try:
             metadata, file = dbcl.files_download(path)
         except dropbox.exceptions.DropboxException as e:
             self._raiseDbException(e)
 
+        # .tcx.gz and .gpx.gz files are read just the same, once they're decompressed
+        filePath = path.lower()
+        if filePath.endswith(ActivityFileCompression.Extension):
+            filePath = filePath[:-len(ActivityFileCompression.Extension)]
         try:
-            if path.lower().endswith(".tcx"):
-                act = TCXIO.Parse(file.content, base_activity)
+            content = ActivityFileCompression.Decompress(file.content)
+        except ActivityFileCompression.DecompressionErrors as e:
+            raise APIExcludeActivity("Invalid gzip " + str(e), activity_id=path, user_exception=UserException(UserExceptionType.Corrupt))
+
+        try:
+            if filePath.endswith(".tcx"):
+                act = TCXIO.Parse(content, base_activity, metadata_only=metadata_only)
             else:
-                act = GPXIO.Parse(file.content, base_activity)
+                act = GPXIO.Parse(content, base_activity, metadata_only=metadata_only)
         except ValueError as e:
             raise APIExcludeActivity("Invalid GPX/TCX " + str(e), activity_id=path, user_exception=UserException(UserExceptionType.Corrupt))
         except lxml.etree.XMLSyntaxError as e:
             raise APIExcludeActivity("LXML parse error " + str(e), activity_id=path, user_exception=UserException(UserExceptionType.Corrupt))
+        if not metadata_only:
+            # The file is the activity - if it makes it to the upload untouched, it can go out as it came in
+            act.PrerenderedFormats[filePath.rsplit(".", 1)[1]] = content
         return act, metadata.rev
 
     def DownloadActivityList(self, svcRec, exhaustive=False):
@@ -186,7 +199,7 @@ class DropboxService(ServiceBase):
                     continue
                 path = entry.path_lower
 
-                if not path.endswith(".gpx") and not path.endswith(".tcx"):
+                if not path.endswith((".gpx", ".tcx", ".gpx" + ActivityFileCompression.Extension, ".tcx" + ActivityFileCompression.Extension)):
                     # Not an activity file -> we don't care.
                     continue
 
@@ -214,9 +227,9 @@ class DropboxService(ServiceBase):
                         act.EndTime = datetime.strptime(existing["EndTime"], "%H:%M:%S %d %m %Y %z")
                 else:
                     logger.debug("Retrieving %s (%s)" % (path, "outdated meta cache" if existing else "not in meta cache"))
-                    # get the full activity
+                    # get enough of the activity to place it - the rest is read in DownloadActivity
                     try:
-                        act, rev = self._getActivity(svcRec, dbcl, path)
+                        act, rev = self._getActivity(svcRec, dbcl, path, metadata_only=True)
                     except APIExcludeActivity as e:
                         logger.info("Encountered APIExcludeActivity %s" % str(e))
                         exclusions.append(strip_context(e))
@@ -285,6 +298,21 @@ class DropboxService(ServiceBase):
         # https://www.dropbox.com/help/145/en
         return re.sub("[><:\"|?*]", "", re.sub("[/\\\]", "-", name))
 
+    def _prerendered_file_matches(self, fileFormat, data, activity):
+        # The file's all that ends up in their Dropbox, so the original can only go in its place if it says the same things ours would.
+        # Sync may well have filled in the name, notes or type from elsewhere since it was downloaded.
+        try:
+            if fileFormat == "tcx":
+                original = TCXIO.Parse(data, metadata_only=True)
+                # TCX only knows of the two sports
+                expectedType = activity.Type if activity.Type in (ActivityType.Cycling, ActivityType.Running) else ActivityType.Other
+                return (original.Name, original.Notes, original.Type) == (activity.Name, activity.Notes, expectedType)
+            else:
+                original = GPXIO.Parse(data, metadata_only=True)
+                return original.Name == activity.Name # GPX doesn't carry the rest, ours included
+        except (ValueError, lxml.etree.XMLSyntaxError):
+            return False
+
     def _format_file_name(self, format, activity):
         name_pattern = re.compile("#NAME", re.IGNORECASE)
         type_pattern = re.compile("#TYPE", re.IGNORECASE)
@@ -297,21 +325,26 @@ class DropboxService(ServiceBase):
 
     def UploadActivity(self, serviceRecord, activity):
         format = serviceRecord.GetConfiguration()["Format"]
-        if format == "tcx":
-            if "tcx" in activity.PrerenderedFormats:
-                logger.debug("Using prerendered TCX")
-                data = activity.PrerenderedFormats["tcx"]
-            else:
-                data = TCXIO.Dump(activity)
+        # tcx.gz and gpx.gz are the same as ever, just gzipped on the way out
+        compress = format.endswith(ActivityFileCompression.Extension)
+        if format.startswith("tcx"):
+            fileFormat, dumper = "tcx", TCXIO.Dump
         else:
-            if "gpx" in activity.PrerenderedFormats:
-                logger.debug("Using prerendered GPX")
-                data = activity.PrerenderedFormats["gpx"]
-            else:
-                data = GPXIO.Dump(activity)
+            fileFormat, dumper = "gpx", GPXIO.Dump
+        if fileFormat in activity.PrerenderedFormats and self._prerendered_file_matches(fileFormat, activity.PrerenderedFormats[fileFormat], activity):
+            logger.debug("Using prerendered %s" % fileFormat.upper())
+            data = activity.PrerenderedFormats[fileFormat]
+            if compress:
+                data = ActivityFileCompression.Compress(data)
+            elif isinstance(data, str):
+                data = data.encode("UTF-8")
+        elif compress:
+            data = ActivityFileCompression.CompressDump(dumper, activity)
+        else:
+            data = dumper(activity).encode("UTF-8")
 
         dbcl = self._getClient(serviceRecord)
-        fname = self._format_file_name(serviceRecord.GetConfiguration()["Filename"], activity)[:250] + "." + format # DB has a max path component length of 255 chars, and we have to save for the file ext (4) and the leading slash (1)
+        fname = self._format_file_name(serviceRecord.GetConfiguration()["Filename"], activity)[:254 - len("." + format)] + "." + format # DB has a max path component length of 255 chars, and we have to save for the file ext (4, or 7 gzipped) and the leading slash (1)
 
         if not serviceRecord.Authorization["Full"]:
             fpath = "/" + fname
@@ -319,7 +352,7 @@ class DropboxService(ServiceBase):
             fpath = serviceRecord.Config["SyncRoot"] + "/" + fname
 
         try:
-            metadata = dbcl.files_upload(data.encode("UTF-8"), fpath, mode=dropbox.files.WriteMode.overwrite)
+            metadata = dbcl.files_upload(data, fpath, mode=dropbox.files.WriteMode.overwrite)
         except dropbox.exceptions.DropboxException as e:
             self._raiseDbException(e)
         # Fake this in so we don't immediately redownload the activity next time 'round
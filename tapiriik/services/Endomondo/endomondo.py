@@ -2,11 +2,11 @@ from tapiriik.settings import WEB_ROOT, ENDOMONDO_CLIENT_KEY, ENDOMONDO_CLIENT_S
 from tapiriik.services.service_base import ServiceAuthenticationType, ServiceBase
 from tapiriik.services.interchange import UploadedActivity, ActivityType, ActivityStatistic, ActivityStatisticUnit, Waypoint, WaypointType, Location, Lap
 from tapiriik.services.api import APIException, APIExcludeActivity, UserException, UserExceptionType
+from tapiriik.services.timestamp_parser import TimestampParser
 from tapiriik.database import redis
 
 from django.core.urlresolvers import reverse
 from datetime import timedelta, datetime
-import dateutil.parser
 from requests_oauthlib import OAuth1Session
 import logging
 import pytz
@@ -122,7 +122,11 @@ class EndomondoService(ServiceBase):
         pass
 
     def _parseDate(self, date):
-        return datetime.strptime(date, "%Y-%m-%d %H:%M:%S UTC").replace(tzinfo=pytz.utc)
+        parsed = TimestampParser.Parse(date)
+        if parsed.tzinfo is None:
+            # They always say which zone they mean (UTC, so far) - without one there's no telling what time it really is
+            raise ValueError("Timestamp %s has no timezone" % date)
+        return parsed.astimezone(pytz.utc)
 
     def _formatDate(self, date):
         return datetime.strftime(date.astimezone(pytz.utc), "%Y-%m-%d %H:%M:%S UTC")
@@ -1,4 +1,4 @@
-from tapiriik.settings import WEB_ROOT, HTTP_SOURCE_ADDR, GARMIN_CONNECT_USER_WATCH_ACCOUNTS
+from tapiriik.settings import WEB_ROOT, HTTP_SOURCE_ADDR, WORKER_AFFINITY, WORKER_INDEX, GARMIN_CONNECT_USER_WATCH_ACCOUNTS
 from tapiriik.services.service_base import ServiceAuthenticationType, ServiceBase
 from tapiriik.services.service_record import ServiceRecord
 from tapiriik.services.interchange import UploadedActivity, ActivityType, ActivityStatistic, ActivityStatisticUnit, Waypoint, Location, Lap
@@ -10,6 +10,7 @@ from tapiriik.services.fit import FITIO
 from tapiriik.services.sessioncache import SessionCache
 from tapiriik.services.devices import DeviceIdentifier, DeviceIdentifierType, Device
 from tapiriik.database import cachedb, db
+from tapiriik.requests_lib import resolve_source_address
 
 from django.core.urlresolvers import reverse
 import pytz
@@ -128,7 +129,8 @@ class GarminConnectService(ServiceBase):
             cachedb.gc_type_hierarchy.insert({"Hierarchy": rawHierarchy})
         else:
             self._activityHierarchy = json.loads(cachedHierarchy["Hierarchy"])["dictionary"]
-        rate_lock_path = tempfile.gettempdir() + "/gc_rate.%s.lock" % HTTP_SOURCE_ADDR
+        # Whatever process this is might not have pinned HTTP_SOURCE_ADDR down (see configure_source_address) - the lock's still per-address either way
+        rate_lock_path = tempfile.gettempdir() + "/gc_rate.%s.lock" % resolve_source_address(HTTP_SOURCE_ADDR, WORKER_AFFINITY, WORKER_INDEX)
         # Ensure the rate lock file exists (...the easy way)
         open(rate_lock_path, "a").close()
         self._rate_lock = open(rate_lock_path, "r+")
@@ -498,6 +500,12 @@ class GarminConnectService(ServiceBase):
                         attrs_map[key]["to_units"] = attrs_map[key]["from_units"] = None
                 attrs_indexed[measurement["metricsIndex"]] = attrs_map[key]
 
+        # Convert units a whole metric at a time, rather than frame by frame
+        converted = {}
+        for idx, attr in attrs_indexed.items():
+            if not attr["is_timestamp"] and attr["to_units"]:
+                converted[idx] = ActivityStatistic.convertValues((frame["metrics"][idx] for frame in raw_data["metrics"]), attr["from_units"], attr["to_units"])
+
         # Process the data frames
         frame_idx = 0
         active_lap_idx = 0
@@ -514,8 +522,8 @@ class GarminConnectService(ServiceBase):
                 # Handle units
                 if attr["is_timestamp"]:
                     value = pytz.utc.localize(datetime.utcfromtimestamp(value / 1000))
-                elif attr["to_units"]:
-                    value = ActivityStatistic.convertValue(value, attr["from_units"], attr["to_units"])
+                elif idx in converted:
+                    value = converted[idx][frame_idx]
 
                 # Write the value (can't use __dict__ because __slots__)
                 setattr(target_obj, attr["key"], value)
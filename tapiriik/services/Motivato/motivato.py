@@ -1,9 +1,10 @@
-from tapiriik.settings import WEB_ROOT, HTTP_SOURCE_ADDR
+from tapiriik.settings import WEB_ROOT, HTTP_SOURCE_ADDR, WORKER_AFFINITY, WORKER_INDEX
 from tapiriik.services.service_base import ServiceAuthenticationType, ServiceBase
 from tapiriik.services.interchange import UploadedActivity, ActivityType, ActivityStatistic, ActivityStatisticUnit, Waypoint, Location, Lap
 from tapiriik.services.api import APIException, APIWarning, UserException, UserExceptionType
 from tapiriik.services.sessioncache import SessionCache
 from tapiriik.payments import ExternalPaymentProvider
+from tapiriik.requests_lib import resolve_source_address
 
 from django.core.urlresolvers import reverse
 from datetime import datetime, timedelta
@@ -60,7 +61,7 @@ class MotivatoService(ServiceBase):
     _urlRoot = "http://motivato.pl"
 
     def __init__(self):
-        rate_lock_path = tempfile.gettempdir() + "/m_rate.%s.lock" % HTTP_SOURCE_ADDR
+        rate_lock_path = tempfile.gettempdir() + "/m_rate.%s.lock" % resolve_source_address(HTTP_SOURCE_ADDR, WORKER_AFFINITY, WORKER_INDEX)
         # Ensure the rate lock file exists (...the easy way)
         open(rate_lock_path, "a").close()
         self._rate_lock = open(rate_lock_path, "r+")
@@ -1,6 +1,5 @@
 import os
 from datetime import datetime, timedelta
-import dateutil.parser
 
 import pytz
 from dateutil.tz import tzutc
@@ -15,6 +14,7 @@ from tapiriik.services.api import APIException, APIWarning, APIExcludeActivity,
 from tapiriik.services.fit import FITIO
 from tapiriik.services.tcx import TCXIO
 from tapiriik.services.sessioncache import SessionCache
+from tapiriik.services.timestamp_parser import TimestampParser
 
 import logging
 logger = logging.getLogger(__name__)
@@ -139,7 +139,7 @@ class RideWithGPSService(ServiceBase):
             # 0 = public, 1 = private, 2 = friends
             activity.Private = act["visibility"] == 1
 
-            activity.StartTime = dateutil.parser.parse(act["departed_at"])
+            activity.StartTime = TimestampParser.Parse(act["departed_at"])
 
             try:
                 activity.TZ = pytz.timezone(act["time_zone"])
@@ -189,6 +189,7 @@ class RideWithGPSService(ServiceBase):
             TCXIO.Parse(res.content, activity)
         except ValueError as e:
             raise APIExcludeActivity("TCX parse error " + str(e), user_exception=UserException(UserExceptionType.Corrupt))
+        activity.PrerenderedFormats["tcx"] = res.content
 
         return activity
 
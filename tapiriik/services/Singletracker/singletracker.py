@@ -3,6 +3,7 @@
 #
 from tapiriik.settings import WEB_ROOT, SINGLETRACKER_CLIENT_SECRET, SINGLETRACKER_CLIENT_ID
 from tapiriik.services.service_base import ServiceAuthenticationType, ServiceBase
+from tapiriik.services.timestamp_parser import TimestampParser
 from tapiriik.services.interchange import UploadedActivity, ActivityType, ActivityStatistic, ActivityStatisticUnit, \
     Waypoint, WaypointType, Location, Lap
 
@@ -11,7 +12,6 @@ from datetime import datetime
 from urllib.parse import urlencode
 import requests
 import logging
-import dateutil.parser
 import json
 
 logger = logging.getLogger(__name__)
@@ -186,7 +186,7 @@ class SingletrackerService(ServiceBase):
         wayPointExist = False
 
         for stream in streamdata:
-            waypoint = Waypoint(dateutil.parser.parse(stream["time"], ignoretz=True))
+            waypoint = Waypoint(TimestampParser.Parse(stream["time"], ignoretz=True))
 
             if "latitude" in stream:
                 if "longitude" in stream:
@@ -5,7 +5,6 @@ import contextlib
 import functools
 
 import requests
-import dateutil
 from django.core.urlresolvers import reverse
 from smashrun import Smashrun as SmashrunClient
 
@@ -16,6 +15,7 @@ from tapiriik.services.interchange import (UploadedActivity, ActivityType, Activ
                                            Location, Lap, LapIntensity)
 from tapiriik.services.api import APIException, APIExcludeActivity, UserException, UserExceptionType
 from tapiriik.services.sessioncache import SessionCache
+from tapiriik.services.timestamp_parser import TimestampParser
 
 logger = logging.getLogger(__name__)
 
@@ -158,7 +158,7 @@ class SmashrunService(ServiceBase):
 
         for act in self._getActivities(serviceRecord, exhaustive=exhaustive):
             activity = UploadedActivity()
-            activity.StartTime = dateutil.parser.parse(act['startDateTimeLocal'])
+            activity.StartTime = TimestampParser.Parse(act['startDateTimeLocal'])
             activity.EndTime = activity.StartTime + timedelta(seconds=act['duration'])
             _type = self._activityMappings.get(act['activityType'])
             if not _type:
@@ -3,11 +3,11 @@ from tapiriik.services.service_base import ServiceAuthenticationType, ServiceBas
 from tapiriik.services.interchange import UploadedActivity, ActivityType, ActivityStatistic, ActivityStatisticUnit, Waypoint, WaypointType, Location, LapIntensity, Lap
 from tapiriik.services.api import APIException, UserException, UserExceptionType, APIExcludeActivity
 from tapiriik.services.sessioncache import SessionCache
+from tapiriik.services.timestamp_parser import TimestampParser
 from tapiriik.database import cachedb
 from django.core.urlresolvers import reverse
 import pytz
 from datetime import timedelta
-import dateutil.parser
 from dateutil.tz import tzutc
 import requests
 import json
@@ -211,7 +211,7 @@ class SportTracksService(ServiceBase):
                     activity.Name = act["name"]
                     # Longstanding ST.mobi bug causes it to return negative partial-hour timezones as "-2:-30" instead of "-2:30"
                 fixed_start_time = re.sub(r":-(\d\d)", r":\1", act["start_time"])
-                activity.StartTime = dateutil.parser.parse(fixed_start_time)
+                activity.StartTime = TimestampParser.Parse(fixed_start_time)
                 if isinstance(activity.StartTime.tzinfo, tzutc):
                     activity.TZ = pytz.utc # The dateutil tzutc doesn't have an _offset value.
                 else:
@@ -295,12 +295,12 @@ class SportTracksService(ServiceBase):
         if "laps" in activityData:
             laps_info = activityData["laps"]
             for lap in activityData["laps"]:
-                laps_starts.append(dateutil.parser.parse(lap["start_time"]))
+                laps_starts.append(TimestampParser.Parse(lap["start_time"]))
         lap = None
         for lapinfo in laps_info:
             lap = Lap()
             activity.Laps.append(lap)
-            lap.StartTime = dateutil.parser.parse(lapinfo["start_time"])
+            lap.StartTime = TimestampParser.Parse(lapinfo["start_time"])
             lap.EndTime = lap.StartTime + timedelta(seconds=lapinfo["clock_duration"])
             if "type" in lapinfo:
                 lap.Intensity = LapIntensity.Active if lapinfo["type"] == "ACTIVE" else LapIntensity.Rest
@@ -337,7 +337,7 @@ class SportTracksService(ServiceBase):
         timerStops = []
         if "timer_stops" in activityData:
             for stop in activityData["timer_stops"]:
-                timerStops.append([dateutil.parser.parse(stop[0]), dateutil.parser.parse(stop[1])])
+                timerStops.append([TimestampParser.Parse(stop[0]), TimestampParser.Parse(stop[1])])
 
         def isInTimerStop(timestamp):
             for stop in timerStops:
@@ -5,6 +5,7 @@ from tapiriik.database import cachedb
 from tapiriik.services.interchange import UploadedActivity, ActivityType, ActivityStatistic, ActivityStatisticUnit, Waypoint, WaypointType, Location, Lap
 from tapiriik.services.api import APIException, UserException, UserExceptionType, APIExcludeActivity
 from tapiriik.services.fit import FITIO
+from tapiriik.services.compression import ActivityFileCompression
 
 from django.core.urlresolvers import reverse
 from datetime import datetime, timedelta
@@ -314,7 +315,7 @@ class StravaService(ServiceBase):
         upload_id = None
         if activity.CountTotalWaypoints():
             req = {
-                    "data_type": "fit",
+                    "data_type": "fit.gz",
                     "activity_name": activity.Name,
                     "description": activity.Notes, # Paul Mach said so.
                     "activity_type": self._activityTypeMappings[activity.Type],
@@ -326,7 +327,8 @@ class StravaService(ServiceBase):
             else:
                 # TODO: put the fit back into PrerenderedFormats once there's more RAM to go around and there's a possibility of it actually being used.
                 fitData = FITIO.Dump(activity, drop_pauses=True)
-            files = {"file":("tap-sync-" + activity.UID + "-" + str(os.getpid()) + ("-" + source_svc if source_svc else "") + ".fit", fitData)}
+            # Strava takes gzipped uploads, which saves a good deal of time on the long ones
+            files = {"file":("tap-sync-" + activity.UID + "-" + str(os.getpid()) + ("-" + source_svc if source_svc else "") + ".fit" + ActivityFileCompression.Extension, ActivityFileCompression.Compress(fitData))}
 
             response = requests.post("https://www.strava.com/api/v3/uploads", data=req, files=files, headers=self._apiHeaders(serviceRecord))
             if response.status_code != 201:
@@ -127,6 +127,7 @@ class TrainAsONEService(ServiceBase):
             TCXIO.Parse(resp.content, activity)
         except ValueError as e:
             raise APIExcludeActivity("TCX parse error " + str(e), user_exception=UserException(UserExceptionType.Corrupt))
+        activity.PrerenderedFormats["tcx"] = resp.content
 
         return activity
 
@@ -138,6 +138,7 @@ class TrainerRoadService(ServiceBase):
             TCXIO.Parse(res.content, activity)
         except ValueError as e:
             raise APIExcludeActivity("TCX parse error " + str(e), user_exception=UserException(UserExceptionType.Corrupt))
+        activity.PrerenderedFormats["tcx"] = res.content
 
         return activity
 
@@ -3,6 +3,7 @@ from tapiriik.services.service_base import ServiceAuthenticationType, ServiceBas
 from tapiriik.services.interchange import UploadedActivity, ActivityType, ActivityStatistic, ActivityStatisticUnit
 from tapiriik.services.api import APIException, UserException, UserExceptionType
 from tapiriik.services.pwx import PWXIO
+from tapiriik.services.compression import ActivityFileCompression
 from tapiriik.services.sessioncache import SessionCache
 
 from datetime import datetime, timedelta
@@ -10,8 +11,6 @@ from urllib.parse import urlencode
 import dateutil.parser
 import requests
 import logging
-from io import BytesIO
-import gzip
 import base64
 import json
 
@@ -190,9 +189,7 @@ class TrainingPeaksService(ServiceBase):
         return activities, exclusions
 
     def UploadActivity(self, svcRecord, activity):
-        pwxdata_gz = BytesIO()
-        with gzip.GzipFile(fileobj=pwxdata_gz, mode="w") as gzf:
-          gzf.write(PWXIO.Dump(activity).encode("utf-8"))
+        pwxdata_gz = ActivityFileCompression.CompressDump(PWXIO.Dump, activity)
 
         headers = self._apiHeaders(svcRecord)
         headers.update({"Content-Type": "application/json"})
@@ -201,7 +198,7 @@ class TrainingPeaksService(ServiceBase):
             "Filename": "tap-%s.pwx" % activity.UID,
             "SetWorkoutPublic": not activity.Private,
             # NB activity notes and name are in the PWX.
-            "Data": base64.b64encode(pwxdata_gz.getvalue()).decode("ascii")
+            "Data": base64.b64encode(pwxdata_gz).decode("ascii")
         }
 
         resp = requests.post(TRAININGPEAKS_API_BASE_URL + "/v1/file", data=json.dumps(data), headers=headers)
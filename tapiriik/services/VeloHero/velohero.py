@@ -6,11 +6,11 @@ from tapiriik.services.fit import FITIO
 from tapiriik.services.pwx import PWXIO
 from tapiriik.services.tcx import TCXIO
 from tapiriik.services.gpx import GPXIO
+from tapiriik.services.timestamp_parser import TimestampParser
 from lxml import etree
 
 from django.core.urlresolvers import reverse
 from datetime import datetime, timedelta
-import dateutil.parser
 import requests
 import time
 import json
@@ -131,7 +131,7 @@ class VeloHeroService(ServiceBase):
 
 
     def _parseDateTime(self, date):
-        return datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        return TimestampParser.Parse(date, ignoretz=True)
 
 
     def _durationToSeconds(self, dur):
@@ -259,29 +259,37 @@ class VeloHeroService(ServiceBase):
         Maximum file size per file is 16 MB.
         """
         
-        has_location = has_distance = has_speed = False
-
-        for lap in activity.Laps:
-            for wp in lap.Waypoints:
-                if wp.Location and wp.Location.Latitude and wp.Location.Longitude:
-                    has_location = True
-                if wp.Distance:
-                    has_distance = True
-                if wp.Speed:
-                    has_speed = True
-
-        if has_location and has_distance and has_speed:
-            format = "fit"
-            data = FITIO.Dump(activity)
-        elif has_location and has_distance:
-            format = "tcx"
-            data = TCXIO.Dump(activity)
-        elif has_location:
-            format = "gpx"
-            data = GPXIO.Dump(activity)
+        # It takes files in any of these formats, so the original file the activity came from beats anything we'd render ourselves
+        # (whatever sync has merged into the notes and type since goes along separately below - it has no use for the name)
+        prerenderedFormat = next((x for x in ("fit", "tcx", "gpx") if x in activity.PrerenderedFormats), None)
+        if prerenderedFormat:
+            logger.debug("Using prerendered %s" % prerenderedFormat.upper())
+            format = prerenderedFormat
+            data = activity.PrerenderedFormats[prerenderedFormat]
         else:
-            format = "fit"
-            data = FITIO.Dump(activity)
+            has_location = has_distance = has_speed = False
+
+            for lap in activity.Laps:
+                for wp in lap.Waypoints:
+                    if wp.Location and wp.Location.Latitude and wp.Location.Longitude:
+                        has_location = True
+                    if wp.Distance:
+                        has_distance = True
+                    if wp.Speed:
+                        has_speed = True
+
+            if has_location and has_distance and has_speed:
+                format = "fit"
+                data = FITIO.Dump(activity)
+            elif has_location and has_distance:
+                format = "tcx"
+                data = TCXIO.Dump(activity)
+            elif has_location:
+                format = "gpx"
+                data = GPXIO.Dump(activity)
+            else:
+                format = "fit"
+                data = FITIO.Dump(activity)
 
         # Upload
         files = {"file": ("tap-sync-" + str(os.getpid()) + "-" + activity.UID + "." + format, data)}
@@ -0,0 +1,40 @@
+from io import BytesIO
+import gzip
+import zlib
+
+
+class ActivityFileCompression:
+    """ gzips activity files on their way to services that'll take them that way, and un-gzips them on the way back in """
+    Extension = ".gz"
+    # What Decompress() might raise on a damaged file
+    DecompressionErrors = (OSError, EOFError, zlib.error)
+
+    # Trading a little size for a lot of speed over the default of 9 - and with no timestamp in the header, the same activity always compresses to the same bytes
+    _compressLevel = 6
+
+    def _open(buffer):
+        return gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=ActivityFileCompression._compressLevel, mtime=0)
+
+    def IsCompressed(data):
+        return data[:2] == b"\x1f\x8b"
+
+    def Compress(data):
+        if isinstance(data, str):
+            data = data.encode("UTF-8")
+        buffer = BytesIO()
+        with ActivityFileCompression._open(buffer) as gzf:
+            gzf.write(data)
+        return buffer.getvalue()
+
+    def CompressDump(dumper, activity):
+        """ Has one of the XML writers (TCXIO.Dump, GPXIO.Dump, PWXIO.Dump) write the activity straight into the compressor, so the uncompressed file never exists in full """
+        buffer = BytesIO()
+        with ActivityFileCompression._open(buffer) as gzf:
+            dumper(activity, gzf)
+        return buffer.getvalue()
+
+    def Decompress(data):
+        """ Anything that isn't gzipped comes back as it was, so callers needn't care which they were handed """
+        if not ActivityFileCompression.IsCompressed(data):
+            return data
+        return gzip.decompress(data)
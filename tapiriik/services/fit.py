@@ -1,6 +1,8 @@
 from datetime import datetime, timedelta
-from .interchange import WaypointType, ActivityStatisticUnit, ActivityType, LapIntensity, LapTriggerMethod
+from .interchange import Activity, ActivityStatistics, ActivityStatistic, ActivityStatisticUnit, ActivityType, Lap, LapIntensity, LapTriggerMethod, Location, Waypoint, WaypointList, WaypointType
 from .devices import DeviceIdentifier, DeviceIdentifierType
+import collections
+import io
 import struct
 import sys
 import pytz
@@ -19,6 +21,7 @@ class FITEvent:
 class FITEventType:
 	Start = 0
 	Stop = 1
+	StopAll = 4
 
 # It's not a coincidence that these enums match the ones in interchange perfectly
 class FITLapIntensity:
@@ -57,6 +60,34 @@ class FITMessageDataType:
 		self.PackFormat = packFormat
 		self.Formatter = formatter
 		self.InvalidValue = invalid
+		# Turns whatever we were given into the value that gets packed
+		if formatter:
+			self.Convert = formatter
+		elif packFormat in ["B","b", "H", "h", "I", "i"]:
+			self.Convert = lambda value: invalid if value is None else round(value)
+		else:
+			self.Convert = lambda value: invalid if value is None else value
+
+class FITLocalMessageDefinition:
+	def __init__(self, local_no, global_message, field_names, types, compressedTimestamp=False):
+		self.Name = global_message.Name
+		self.Number = local_no
+		self.CompressedTimestamp = compressedTimestamp
+		self.FieldNameList = [x for x in global_message.FieldNameList if x in field_names]
+		self.FieldNameSet = frozenset(self.FieldNameList)
+		self.Types = [types[global_message.Fields[x]["Type"]] for x in self.FieldNameList]
+		# The timestamp's already been converted by the time we get here, so we can check whether it'll compress
+		self.Converters = [None if x == "timestamp" else field_type.Convert for x, field_type in zip(self.FieldNameList, self.Types)]
+		# Record header + every field, in one go
+		self.Struct = struct.Struct("<B" + "".join(x.PackFormat for x in self.Types))
+		self.Header = 0 if not compressedTimestamp else (0b10000000 | (local_no << 5))
+		if not compressedTimestamp:
+			self.Header |= local_no
+
+		pack_tuple = (0b01000000 | local_no, 0, 0, global_message.Number, len(self.FieldNameList)) # Reserved, little-endian
+		for field_name, field_type in zip(self.FieldNameList, self.Types):
+			pack_tuple += (global_message.Fields[field_name]["Number"], field_type.Size, field_type.TypeField)
+		self.DefinitionMessage = struct.pack("<BBBHB" + ("BBB" * len(self.FieldNameList)), *pack_tuple)
 
 class FITMessageTemplate:
 	def __init__(self, name, number, *args, fields=None):
@@ -84,48 +115,64 @@ class FITMessageGenerator:
 	def __init__(self):
 		self._types = {}
 		self._messageTemplates = {}
-		self._definitions = {}
-		self._result = []
-		# All our convience functions for preparing the field types to be packed.
+		# Local message numbers 0-3 are kept for records with compressed timestamps (only they fit in the compressed header), the rest for everything else
+		# Each pool is in least-recently-used order, so when one runs out we can redefine whichever local message number has gone unused the longest
+		self._definitions = collections.OrderedDict()
+		self._compressedDefinitions = collections.OrderedDict()
+		self._lastTimestamp = None
+		self._buffer = bytearray(0x10000)
+		self._length = 0
+		self._crc = 0 # Of everything written so far, kept up as we go
+		epoch = datetime(hour=0, minute=0, month=12, day=31, year=1989)
+		# All our convience functions for preparing the field types to be packed - they return the value to pack, not the packed bytes.
 		def stringFormatter(input):
 			raise Exception("Not implemented")
 		def dateTimeFormatter(input):
 			# UINT32
 			# Seconds since UTC 00:00 Dec 31 1989. If <0x10000000 = system time
 			if input is None:
-				return struct.pack("<I", 0xFFFFFFFF)
-			delta = round((input - datetime(hour=0, minute=0, month=12, day=31, year=1989)).total_seconds())
-			return struct.pack("<I", delta)
+				return 0xFFFFFFFF
+			return round((input - epoch).total_seconds())
 		def msecFormatter(input):
 			# UINT32
 			if input is None:
-				return struct.pack("<I", 0xFFFFFFFF)
-			return struct.pack("<I", round((input if type(input) is not timedelta else input.total_seconds()) * 1000))
+				return 0xFFFFFFFF
+			return round((input if type(input) is not timedelta else input.total_seconds()) * 1000)
 		def mmPerSecFormatter(input):
 			# UINT16
 			if input is None:
-				return struct.pack("<H", 0xFFFF)
-			return struct.pack("<H", round(input * 1000))
+				return 0xFFFF
+			return round(input * 1000)
 		def cmFormatter(input):
 			# UINT32
 			if input is None:
-				return struct.pack("<I", 0xFFFFFFFF)
-			return struct.pack("<I", round(input * 100))
+				return 0xFFFFFFFF
+			return round(input * 100)
 		def altitudeFormatter(input):
 			# UINT16
 			if input is None:
-				return struct.pack("<H", 0xFFFF)
-			return struct.pack("<H", round((input + 500) * 5)) # Increments of 1/5, offset from -500m :S
+				return 0xFFFF
+			return round((input + 500) * 5) # Increments of 1/5, offset from -500m :S
 		def semicirclesFormatter(input):
 			# SINT32
 			if input is None:
-				return struct.pack("<i", 0x7FFFFFFF) # FIT-defined invalid value
-			return struct.pack("<i", round(input * (2 ** 31 / 180)))
+				return 0x7FFFFFFF # FIT-defined invalid value
+			return round(input * (2 ** 31 / 180))
 		def versionFormatter(input):
 			# UINT16
 			if input is None:
-				return struct.pack("<H", 0xFFFF)
-			return struct.pack("<H", round(input * 100))
+				return 0xFFFF
+			return round(input * 100)
+		def mmPerSec32Formatter(input):
+			# UINT32
+			if input is None:
+				return 0xFFFFFFFF
+			return round(input * 1000)
+		def altitude32Formatter(input):
+			# UINT32
+			if input is None:
+				return 0xFFFFFFFF
+			return round((input + 500) * 5)
 
 
 		def defType(name, *args, **kwargs):
@@ -151,13 +198,15 @@ class FITMessageGenerator:
 		defType("byte", 0x0D, 1, "B", 0xFF) # This isn't totally correct, docs say "an array of bytes"
 
 		# Not strictly FIT fields, but convenient.
-		defType("date_time", 0x86, 4, None, 0xFFFFFFFF, formatter=dateTimeFormatter)
-		defType("duration_msec", 0x86, 4, None, 0xFFFFFFFF, formatter=msecFormatter)
-		defType("distance_cm", 0x86, 4, None, 0xFFFFFFFF, formatter=cmFormatter)
-		defType("mmPerSec", 0x84, 2, None, 0xFFFF, formatter=mmPerSecFormatter)
-		defType("semicircles", 0x85, 4, None, 0x7FFFFFFF, formatter=semicirclesFormatter)
-		defType("altitude", 0x84, 2, None, 0xFFFF, formatter=altitudeFormatter)
-		defType("version", 0x84, 2, None, 0xFFFF, formatter=versionFormatter)
+		defType("date_time", 0x86, 4, "I", 0xFFFFFFFF, formatter=dateTimeFormatter)
+		defType("duration_msec", 0x86, 4, "I", 0xFFFFFFFF, formatter=msecFormatter)
+		defType("distance_cm", 0x86, 4, "I", 0xFFFFFFFF, formatter=cmFormatter)
+		defType("mmPerSec", 0x84, 2, "H", 0xFFFF, formatter=mmPerSecFormatter)
+		defType("semicircles", 0x85, 4, "i", 0x7FFFFFFF, formatter=semicirclesFormatter)
+		defType("altitude", 0x84, 2, "H", 0xFFFF, formatter=altitudeFormatter)
+		defType("version", 0x84, 2, "H", 0xFFFF, formatter=versionFormatter)
+		defType("mmPerSec32", 0x86, 4, "I", 0xFFFFFFFF, formatter=mmPerSec32Formatter)
+		defType("altitude32", 0x86, 4, "I", 0xFFFFFFFF, formatter=altitude32Formatter)
 
 		def defMsg(name, *args):
 			self._messageTemplates[name] = FITMessageTemplate(name, *args)
@@ -252,6 +301,8 @@ class FITMessageGenerator:
 			7, "power", "uint16",
 			13, "temperature", "sint8",
 			33, "calories", "uint16",
+			73, "enhanced_speed", "mmPerSec32", # Newer devices write these instead of (or as well as) the 16-bit versions
+			78, "enhanced_altitude", "altitude32",
 			)
 
 		defMsg("event", 21,
@@ -269,96 +320,91 @@ class FITMessageGenerator:
 			5, "software_version", "version"
 			)
 
+	def _reserve(self, length):
+		# Grows the buffer as required, returning the offset to write at
+		offset = self._length
+		self._length += length
+		if self._length > len(self._buffer):
+			self._buffer.extend(bytes(max(len(self._buffer), length)))
+		return offset
+
 	def _write(self, contents):
-		self._result.append(contents)
+		offset = self._reserve(len(contents))
+		self._buffer[offset:self._length] = contents
+		self._crc = FITIO._calculateCRC(contents, self._crc)
 
 	def GetResult(self):
-		return b''.join(self._result)
+		return bytes(self._buffer[:self._length])
+
+	def GetCRC(self):
+		# The CRC of GetResult() alone - FITIO._combineCRC can put the header in front of it
+		return self._crc
 
-	def _defineMessage(self, local_no, global_message, field_names):
-		assert local_no < 16 and local_no >= 0
+	def _defineMessage(self, global_message, field_names, compressedTimestamp=False):
 		if set(field_names) - set(global_message.FieldNameList):
 			raise ValueError("Attempting to use undefined fields %s" % (set(field_names) - set(global_message.FieldNameList)))
-		messageHeader = 0b01000000
-		messageHeader = messageHeader | local_no
-
-		local_fields = {}
-
-		arch = 0 # Little-endian
-		global_no = global_message.Number
-		field_count = len(field_names)
-		pack_tuple = (messageHeader, 0, arch, global_no, field_count)
-		for field_name in global_message.FieldNameList:
-			if field_name in field_names:
-				field = global_message.Fields[field_name]
-				field_type = self._types[field["Type"]]
-				pack_tuple += (field["Number"], field_type.Size, field_type.TypeField)
-				local_fields[field_name] = field
-		self._definitions[local_no] = FITMessageTemplate(global_message.Name, local_no, local_fields)
-		self._write(struct.pack("<BBBHB" + ("BBB" * field_count), *pack_tuple))
-		return self._definitions[local_no]
-
+		pool = self._compressedDefinitions if compressedTimestamp else self._definitions
+		pool_range = range(0, 4) if compressedTimestamp else range(4, 16)
+		if len(pool) < len(pool_range):
+			local_no = pool_range[len(pool)]
+		else:
+			# Out of local message numbers - redefine the one used least recently
+			local_no = pool.popitem(last=False)[1].Number
+		definition = FITLocalMessageDefinition(local_no, global_message, field_names, self._types, compressedTimestamp=compressedTimestamp)
+		pool[(definition.Name, definition.FieldNameSet)] = definition
+		self._write(definition.DefinitionMessage)
+		return definition
 
 	def GenerateMessage(self, name, **kwargs):
-		globalDefn = self._messageTemplates[name]
+		timestamp = kwargs.get("timestamp", None)
+		if timestamp is not None:
+			timestamp = self._types["date_time"].Convert(timestamp)
 
-		# Create a subset of the global message's fields
-		localFieldNamesSet = set()
-		for fieldName in kwargs:
-			localFieldNamesSet.add(fieldName)
-
-		# I'll look at this later
-		compressTS = False
+		# Records can leave the timestamp out entirely if it's within 31 seconds of the last one written, and put the difference in the header instead
+		compressTS = name == "record" and timestamp is not None and self._lastTimestamp is not None and 0 <= timestamp - self._lastTimestamp < 32
+		if compressTS:
+			pool = self._compressedDefinitions
+			key = (name, frozenset(kwargs).difference(("timestamp",)))
+		else:
+			pool = self._definitions
+			key = (name, frozenset(kwargs))
 
 		# Are these fields covered by an existing local message type?
-		active_definition = None
-		for defn_n in self._definitions:
-			defn = self._definitions[defn_n]
-			if defn.Name == name:
-				if defn.FieldNameSet == localFieldNamesSet:
-					active_definition = defn
-
-		# If not, create a new local message type with these fields
-		if not active_definition:
-			active_definition_no = len(self._definitions)
-			active_definition = self._defineMessage(active_definition_no, globalDefn, localFieldNamesSet)
-
-		if compressTS and active_definition.Number > 3:
-			raise Exception("Can't use compressed timestamp when local message number > 3")
-
-		messageHeader = 0
-		if compressTS:
-			messageHeader = messageHeader | (1 << 7)
-			tsOffsetVal = -1 # TODO
-			messageHeader = messageHeader | (active_definition.Number << 4)
+		active_definition = pool.get(key)
+		if active_definition:
+			pool.move_to_end(key)
 		else:
-			messageHeader = messageHeader | active_definition.Number
+			# If not, create a new local message type with these fields
+			active_definition = self._defineMessage(self._messageTemplates[name], key[1], compressedTimestamp=compressTS)
+
+		if timestamp is not None:
+			self._lastTimestamp = timestamp
 
-		packResult = [struct.pack("<B", messageHeader)]
-		for field_name in active_definition.FieldNameList:
-			field = active_definition.Fields[field_name]
-			field_type = self._types[field["Type"]]
+		values = [active_definition.Header | (timestamp & 0x1F) if compressTS else active_definition.Header]
+		for field_name, convert in zip(active_definition.FieldNameList, active_definition.Converters):
+			if convert is None:
+				values.append(timestamp if timestamp is not None else 0xFFFFFFFF)
+				continue
 			try:
-				if field_type.Formatter:
-					result = field_type.Formatter(kwargs[field_name])
-				else:
-					sanitized_value = kwargs[field_name]
-					if sanitized_value is None:
-						result = struct.pack("<" + field_type.PackFormat, field_type.InvalidValue)
-					else:
-						if field_type.PackFormat in ["B","b", "H", "h", "I", "i"]:
-							sanitized_value = round(sanitized_value)
-						try:
-							result = struct.pack("<" + field_type.PackFormat, sanitized_value)
-						except struct.error as e: # I guess more specific exception types were too much to ask for.
-							if "<=" in str(e) or "out of range" in str(e):
-								result = struct.pack("<" + field_type.PackFormat, field_type.InvalidValue)
-							else:
-								raise
+				values.append(convert(kwargs[field_name]))
 			except Exception as e:
 				raise Exception("Failed packing %s=%s - %s" % (field_name, kwargs[field_name], e))
-			packResult.append(result)
-		self._write(b''.join(packResult))
+
+		offset = self._reserve(active_definition.Struct.size)
+		try:
+			active_definition.Struct.pack_into(self._buffer, offset, *values)
+		except struct.error:
+			# Something's out of range - work out what, and either blank it or give up
+			for idx, (field_name, field_type) in enumerate(zip(active_definition.FieldNameList, active_definition.Types)):
+				try:
+					struct.pack("<" + field_type.PackFormat, values[idx + 1])
+				except struct.error as e: # I guess more specific exception types were too much to ask for.
+					if not field_type.Formatter and ("<=" in str(e) or "out of range" in str(e)):
+						values[idx + 1] = field_type.InvalidValue
+					else:
+						raise Exception("Failed packing %s=%s - %s" % (field_name, kwargs[field_name], e))
+			active_definition.Struct.pack_into(self._buffer, offset, *values)
+		self._crc = FITIO._calculateCRC(memoryview(self._buffer)[offset:self._length], self._crc)
 
 
 class FITIO:
@@ -374,18 +420,44 @@ class FITIO:
 	_subSportMap = {
 		# ActivityType.MountainBiking: 8 there's an issue with cadence upload and this type with GC, so...
 	}
+	def _generateCRCTable():
+		crc_table = []
+		for byte in range(256):
+			crc = byte
+			for bit in range(8):
+				crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+			crc_table.append(crc)
+		return crc_table
+	_crcTable = _generateCRCTable()
+
 	def _calculateCRC(bytestring, crc=0):
-		crc_table = [0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401, 0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400]
+		# CRC-16/ARC (reflected 0x8005), a byte at a time
+		crc_table = FITIO._crcTable
 		for byte in bytestring:
-			tmp = crc_table[crc & 0xF]
-			crc = (crc >> 4) & 0x0FFF
-			crc = crc ^ tmp ^ crc_table[byte & 0xF]
-
-			tmp = crc_table[crc & 0xF]
-			crc = (crc >> 4) & 0x0FFF
-			crc = crc ^ tmp ^ crc_table[(byte >> 4) & 0xF]
+			crc = (crc >> 8) ^ crc_table[(crc ^ byte) & 0xFF]
 		return crc
 
+	def _combineCRC(crc, next_crc, next_length):
+		# Works out the CRC of A + B from the CRCs of A and B, without going back over either
+		# Running a CRC over a zero byte is linear in the CRC, so we can square our way up to next_length of them, zlib-style
+		def apply(matrix, vector):
+			result = 0
+			for column in matrix:
+				if not vector:
+					break
+				if vector & 1:
+					result ^= column
+				vector >>= 1
+			return result
+		zero_byte = [FITIO._calculateCRC(b"\x00", 1 << bit) for bit in range(16)]
+		while next_length:
+			if next_length & 1:
+				crc = apply(zero_byte, crc)
+			next_length >>= 1
+			if next_length:
+				zero_byte = [apply(zero_byte, column) for column in zero_byte]
+		return crc ^ next_crc
+
 	def _generateHeader(dataLength):
 		# We need to call this once the final records are assembled and their length is known, to avoid having to seek back
 		header_len = 12
@@ -394,8 +466,288 @@ class FITIO:
 		tag = ".FIT"
 		return struct.pack("<BBHI4s", header_len, protocolVer, profileVer, dataLength, tag.encode("ASCII"))
 
-	def Parse(raw_file):
-		raise Exception("Not implemented")
+	# Base types by their number (the low 5 bits of the base type byte): pack format, size, invalid value
+	_baseTypes = {
+		0x00: ("B", 1, 0xFF), # enum
+		0x01: ("b", 1, 0x7F), # sint8
+		0x02: ("B", 1, 0xFF), # uint8
+		0x03: ("h", 2, 0x7FFF), # sint16
+		0x04: ("H", 2, 0xFFFF), # uint16
+		0x05: ("i", 4, 0x7FFFFFFF), # sint32
+		0x06: ("I", 4, 0xFFFFFFFF), # uint32
+		0x08: ("f", 4, None), # float32 - invalid is all-ones, which is a NaN
+		0x09: ("d", 8, None), # float64
+		0x0A: ("B", 1, 0x00), # uint8z
+		0x0B: ("H", 2, 0x0000), # uint16z
+		0x0C: ("I", 4, 0x00000000), # uint32z
+		0x0D: ("B", 1, 0xFF), # byte
+		0x0E: ("q", 8, 0x7FFFFFFFFFFFFFFF), # sint64
+		0x0F: ("Q", 8, 0xFFFFFFFFFFFFFFFF), # uint64
+		0x10: ("Q", 8, 0x0000000000000000), # uint64z
+		# Strings (0x07) and arrays of anything are left as bytes - we don't need them
+	}
+
+	_epoch = datetime(hour=0, minute=0, month=12, day=31, year=1989, tzinfo=pytz.utc)
+
+	# The reverse of the formatters in FITMessageGenerator
+	_decoders = {
+		"date_time": lambda value: FITIO._epoch + timedelta(seconds=value),
+		"duration_msec": lambda value: value / 1000,
+		"distance_cm": lambda value: value / 100,
+		"mmPerSec": lambda value: value / 1000,
+		"mmPerSec32": lambda value: value / 1000,
+		"semicircles": lambda value: value * (180 / 2 ** 31),
+		"altitude": lambda value: value / 5 - 500,
+		"altitude32": lambda value: value / 5 - 500,
+		"version": lambda value: value / 100
+	}
+
+	_messageTemplates = None
+
+	def _compileDefinition(global_no, big_endian, fields, developer_fields):
+		# Compiles the definition into a single struct, and what to do with each value it unpacks
+		# Anything we don't know about (including developer fields, arrays and strings) is read as bytes and dropped
+		if FITIO._messageTemplates is None:
+			FITIO._messageTemplates = {template.Number: template for template in FITMessageGenerator()._messageTemplates.values()}
+		template = FITIO._messageTemplates.get(global_no)
+		template_fields = {field["Number"]: field for field in template.Fields.values()} if template else {}
+
+		pack_format = ">" if big_endian else "<"
+		decoders = []
+		for field_no, size, base_type in fields:
+			base_type_info = FITIO._baseTypes.get(base_type & 0x1F)
+			if field_no in template_fields and base_type_info and base_type_info[1] == size:
+				pack_format += base_type_info[0]
+				field = template_fields[field_no]
+				decoders.append((field["Name"], base_type_info[2], FITIO._decoders.get(field["Type"])))
+			else:
+				pack_format += "%ds" % size
+				decoders.append(None)
+		for field_no, size, developer_index in developer_fields:
+			pack_format += "%ds" % size
+			decoders.append(None)
+		return (template.Name if template else None, struct.Struct(pack_format), decoders)
+
+	def _readMessages(stream):
+		# Yields (message name, {field name: value}) for each data message we know about, reading as we go rather than holding the whole file
+		def read(length):
+			data = stream.read(length)
+			if len(data) != length:
+				raise ValueError("Truncated FIT file")
+			return data
+
+		header_len = read(1)[0]
+		if header_len < 12:
+			raise ValueError("Invalid FIT header")
+		protocolVer, profileVer, data_len, tag = struct.unpack("<BHI4s", read(header_len - 1)[:11])
+		if tag != b".FIT":
+			raise ValueError("Not a FIT file")
+
+		definitions = {}
+		last_timestamp = None
+		remaining = data_len
+		while remaining > 0:
+			record_header = read(1)[0]
+			remaining -= 1
+			timestamp = None
+			if record_header & 0x80:
+				# Compressed timestamp header - a data message, with a 5-bit offset from the last full timestamp in place of its own
+				local_no = (record_header >> 5) & 0x3
+				if last_timestamp is None:
+					raise ValueError("Compressed timestamp without a preceding timestamp")
+				offset = record_header & 0x1F
+				timestamp = (last_timestamp & 0xFFFFFFE0) + offset
+				if offset < (last_timestamp & 0x1F):
+					timestamp += 0x20 # Rolled over
+				last_timestamp = timestamp
+			elif record_header & 0x40:
+				# Definition message
+				local_no = record_header & 0x0F
+				fixed = read(5)
+				big_endian = fixed[1] == 1
+				global_no = struct.unpack(">H" if big_endian else "<H", fixed[2:4])[0]
+				fields = read(3 * fixed[4])
+				remaining -= 5 + len(fields)
+				developer_fields = b""
+				if record_header & 0x20:
+					developer_fields = read(read(1)[0] * 3)
+					remaining -= 1 + len(developer_fields)
+				definitions[local_no] = FITIO._compileDefinition(global_no, big_endian,
+					[tuple(fields[idx:idx + 3]) for idx in range(0, len(fields), 3)],
+					[tuple(developer_fields[idx:idx + 3]) for idx in range(0, len(developer_fields), 3)])
+				continue
+			else:
+				local_no = record_header & 0x0F
+
+			if local_no not in definitions:
+				raise ValueError("Data message for undefined local message type %d" % local_no)
+			name, message_struct, decoders = definitions[local_no]
+			values = message_struct.unpack(read(message_struct.size))
+			remaining -= message_struct.size
+			if name is None:
+				continue
+
+			message = {}
+			for value, decoder in zip(values, decoders):
+				if decoder is None:
+					continue
+				field_name, invalid, decode = decoder
+				if value == invalid or value != value: # (NaN)
+					continue
+				if field_name == "timestamp":
+					last_timestamp = value
+				message[field_name] = decode(value) if decode else value
+			if timestamp is not None:
+				message["timestamp"] = FITIO._decoders["date_time"](timestamp)
+			yield name, message
+
+	def Parse(raw_file, activity=None):
+		""" Reads a FIT activity file - either bytes, or a file-like object to stream from """
+		if isinstance(raw_file, (bytes, bytearray)):
+			raw_file = io.BytesIO(raw_file)
+		act = activity if activity else Activity()
+		act.Laps = []
+		act.GPS = False
+
+		sportMap = {v: k for k, v in FITIO._sportMap.items() if k not in (ActivityType.MountainBiking,)}
+		intensityMap = {
+			FITLapIntensity.Active: LapIntensity.Active,
+			FITLapIntensity.Rest: LapIntensity.Rest,
+			FITLapIntensity.Warmup: LapIntensity.Warmup,
+			FITLapIntensity.Cooldown: LapIntensity.Cooldown,
+		}
+		triggerMap = {
+			FITLapTriggerMethod.Manual: LapTriggerMethod.Manual,
+			FITLapTriggerMethod.Time: LapTriggerMethod.Time,
+			FITLapTriggerMethod.Distance: LapTriggerMethod.Distance,
+			FITLapTriggerMethod.PositionStart: LapTriggerMethod.PositionStart,
+			FITLapTriggerMethod.PositionLap: LapTriggerMethod.PositionLap,
+			FITLapTriggerMethod.PositionWaypoint: LapTriggerMethod.PositionWaypoint,
+			FITLapTriggerMethod.PositionMarked: LapTriggerMethod.PositionMarked,
+			FITLapTriggerMethod.SessionEnd: LapTriggerMethod.SessionEnd,
+			FITLapTriggerMethod.FitnessEquipment: LapTriggerMethod.FitnessEquipment,
+		}
+
+		def _readStats(message):
+			# Laps and sessions share all the field names, if not the numbers
+			get = message.get
+			stats = ActivityStatistics(distance=get("total_distance"), timer_time=get("total_timer_time"), moving_time=get("total_moving_time"),
+				max_elevation=get("max_altitude"), min_elevation=get("min_altitude"), gained_elevation=get("total_ascent"), lost_elevation=get("total_descent"),
+				avg_hr=get("avg_heart_rate"), max_hr=get("max_heart_rate"), avg_cadence=get("avg_cadence"), max_cadence=get("max_cadence"),
+				avg_temp=get("avg_temperature"), max_temp=get("max_temperature"), kcal=get("total_calories"), avg_power=get("avg_power"), max_power=get("max_power"))
+			if get("avg_speed") is not None or get("max_speed") is not None:
+				stats.Speed = ActivityStatistic(ActivityStatisticUnit.MetersPerSecond, avg=get("avg_speed"), max=get("max_speed"))
+			return stats
+
+		pendingWaypoints = WaypointList()
+		inPause = False
+		resumed = False
+		sessionStart = sessionEnd = None
+		sessionStats = None
+		for name, message in FITIO._readMessages(raw_file):
+			if name == "record":
+				if "timestamp" not in message:
+					continue # Not much we can do with these
+				wp = Waypoint(timestamp=message["timestamp"])
+				if inPause:
+					wp.Type = WaypointType.Pause
+				elif resumed:
+					wp.Type = WaypointType.Resume
+					resumed = False
+				altitude = message.get("enhanced_altitude", message.get("altitude"))
+				if "position_lat" in message and "position_long" in message:
+					wp.Location = Location(message["position_lat"], message["position_long"], altitude)
+					act.GPS = True
+				elif altitude is not None:
+					wp.Location = Location(None, None, altitude)
+				wp.HR = message.get("heart_rate")
+				wp.Cadence = message.get("cadence")
+				wp.Power = message.get("power")
+				wp.Temp = message.get("temperature")
+				wp.Calories = message.get("calories")
+				wp.Distance = message.get("distance")
+				wp.Speed = message.get("enhanced_speed", message.get("speed"))
+				pendingWaypoints.append(wp)
+			elif name == "event":
+				if message.get("event") == FITEvent.Timer:
+					if message.get("event_type") == FITEventType.Start:
+						resumed = inPause
+						inPause = False
+					elif message.get("event_type") in (FITEventType.Stop, FITEventType.StopAll):
+						inPause = True
+			elif name == "lap":
+				# Laps come after the records they cover
+				lap = Lap(startTime=message.get("start_time"), endTime=message.get("timestamp"), stats=_readStats(message))
+				if lap.StartTime is None and len(pendingWaypoints):
+					lap.StartTime = pendingWaypoints[0].Timestamp
+				lap.Intensity = intensityMap.get(message.get("intensity"), LapIntensity.Active)
+				lap.Trigger = triggerMap.get(message.get("lap_trigger"), LapTriggerMethod.Manual)
+				lap.Waypoints = pendingWaypoints
+				pendingWaypoints = WaypointList()
+				act.Laps.append(lap)
+			elif name == "session":
+				if sessionStart is None:
+					if not act.Type or act.Type == ActivityType.Other:
+						act.Type = sportMap.get(message.get("sport"), ActivityType.Other)
+					sessionStart = message.get("start_time")
+					sessionStats = _readStats(message)
+				if "start_time" in message and "total_elapsed_time" in message:
+					sessionEnd = message["start_time"] + timedelta(seconds=message["total_elapsed_time"])
+				else:
+					sessionEnd = message.get("timestamp", sessionEnd)
+			elif name == "activity":
+				if "local_timestamp" in message and "timestamp" in message:
+					# local_timestamp is written as if it were UTC
+					act.FallbackTZ = pytz.FixedOffset(round((message["local_timestamp"] - message["timestamp"]).total_seconds() / 60))
+			elif name == "file_id":
+				if message.get("type", FITFileType.Activity) != FITFileType.Activity:
+					raise ValueError("FIT file is not an activity")
+
+		if len(pendingWaypoints):
+			# Records after the last lap message (or no lap messages at all)
+			if len(act.Laps):
+				act.Laps[-1].Waypoints.extend(pendingWaypoints)
+			else:
+				act.Laps.append(Lap(startTime=pendingWaypoints[0].Timestamp, endTime=pendingWaypoints[-1].Timestamp))
+				act.Laps[0].Waypoints = pendingWaypoints
+
+		if act.Type in (ActivityType.Running, ActivityType.Walking, ActivityType.Hiking):
+			# FIT only has the one cadence field, which is steps in these cases
+			def _moveRunCadence(stats):
+				if "Cadence" in stats.Present():
+					stats.RunCadence = ActivityStatistic(ActivityStatisticUnit.StepsPerMinute, avg=stats.Cadence.Average, max=stats.Cadence.Max)
+					del stats.Cadence
+			for lap in act.Laps:
+				lap.Waypoints.MoveColumn("Cadence", "RunCadence")
+				_moveRunCadence(lap.Stats)
+			if sessionStats:
+				_moveRunCadence(sessionStats)
+
+		act.StartTime = sessionStart if sessionStart else (act.Laps[0].StartTime if len(act.Laps) else act.StartTime)
+		act.EndTime = sessionEnd if sessionEnd else (act.Laps[-1].EndTime if len(act.Laps) else act.EndTime)
+
+		if act.CountTotalWaypoints():
+			act.Stationary = False
+			act.GetFlatWaypoints()[0].Type = WaypointType.Start
+			act.GetFlatWaypoints()[-1].Type = WaypointType.End
+		else:
+			act.Stationary = True
+
+		if sessionStats:
+			sessionStats.update(act.Stats) # External source is authorative
+			act.Stats = sessionStats
+		if len(act.Laps) == 1:
+			act.Laps[0].Stats.update(act.Stats) # Session is authorative
+			act.Stats = act.Laps[0].Stats
+		elif not sessionStats:
+			sum_stats = ActivityStatistics()
+			for lap in act.Laps:
+				sum_stats.sumWith(lap.Stats)
+			sum_stats.update(act.Stats)
+			act.Stats = sum_stats
+
+		act.CalculateUID()
+		return act
 
 	def Dump(act, drop_pauses=False):
 		def toUtc(ts):
@@ -481,37 +833,41 @@ class FITIO:
 
 		inPause = False
 		for lap in act.Laps:
-			for wp in lap.Waypoints:
-				if wp.Type == WaypointType.Resume and inPause:
-					fmg.GenerateMessage("event", timestamp=toUtc(wp.Timestamp), event=FITEvent.Timer, event_type=FITEventType.Start)
+			# Going down the lap's columns is a lot quicker than going through each waypoint
+			columns = [lap.Waypoints.Column(name) for name in ("Timestamp", "Type", "Latitude", "Longitude", "Altitude", "HR", "RunCadence", "Cadence", "Power", "Temp", "Calories", "Distance", "Speed")]
+			for timestamp, wpType, latitude, longitude, altitude, hr, runCadence, cadence, power, temp, calories, distance, speed in zip(*columns):
+				timestamp = toUtc(timestamp)
+				if wpType == WaypointType.Resume and inPause:
+					fmg.GenerateMessage("event", timestamp=timestamp, event=FITEvent.Timer, event_type=FITEventType.Start)
 					inPause = False
-				elif wp.Type == WaypointType.Pause and not inPause:
-					fmg.GenerateMessage("event", timestamp=toUtc(wp.Timestamp), event=FITEvent.Timer, event_type=FITEventType.Stop)
+				elif wpType == WaypointType.Pause and not inPause:
+					fmg.GenerateMessage("event", timestamp=timestamp, event=FITEvent.Timer, event_type=FITEventType.Stop)
 					inPause = True
 				if inPause and drop_pauses:
 					continue
 
-				rec_contents = {"timestamp": toUtc(wp.Timestamp)}
-				if wp.Location:
-					rec_contents.update({"position_lat": wp.Location.Latitude, "position_long": wp.Location.Longitude})
-					if wp.Location.Altitude is not None:
-						rec_contents.update({"altitude": wp.Location.Altitude})
-				if wp.HR is not None:
-					rec_contents.update({"heart_rate": wp.HR})
-				if wp.RunCadence is not None:
-					rec_contents.update({"cadence": wp.RunCadence})
-				if wp.Cadence is not None:
-					rec_contents.update({"cadence": wp.Cadence})
-				if wp.Power is not None:
-					rec_contents.update({"power": wp.Power})
-				if wp.Temp is not None:
-					rec_contents.update({"temperature": wp.Temp})
-				if wp.Calories is not None:
-					rec_contents.update({"calories": wp.Calories})
-				if wp.Distance is not None:
-					rec_contents.update({"distance": wp.Distance})
-				if wp.Speed is not None:
-					rec_contents.update({"speed": wp.Speed})
+				rec_contents = {"timestamp": timestamp}
+				if latitude is not None or longitude is not None:
+					rec_contents["position_lat"] = latitude
+					rec_contents["position_long"] = longitude
+				if altitude is not None:
+					rec_contents["altitude"] = altitude
+				if hr is not None:
+					rec_contents["heart_rate"] = hr
+				if runCadence is not None:
+					rec_contents["cadence"] = runCadence
+				if cadence is not None:
+					rec_contents["cadence"] = cadence
+				if power is not None:
+					rec_contents["power"] = power
+				if temp is not None:
+					rec_contents["temperature"] = temp
+				if calories is not None:
+					rec_contents["calories"] = calories
+				if distance is not None:
+					rec_contents["distance"] = distance
+				if speed is not None:
+					rec_contents["speed"] = speed
 				fmg.GenerateMessage("record", **rec_contents)
 			# Man, I love copy + paste and multi-cursor editing
 			# But seriously, I'm betting that, some time down the road, a stat will pop up in X but not in Y, so I won't feel so bad about the C&P abuse
@@ -565,5 +921,5 @@ class FITIO:
 
 		records = fmg.GetResult()
 		header = FITIO._generateHeader(len(records))
-		crc = FITIO._calculateCRC(records, FITIO._calculateCRC(header))
+		crc = FITIO._combineCRC(FITIO._calculateCRC(header), fmg.GetCRC(), len(records))
 		return header + records + struct.pack("<H", crc)
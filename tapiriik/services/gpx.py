@@ -1,10 +1,11 @@
 from lxml import etree
 from pytz import UTC
-import copy
-import dateutil.parser
+import io
 from datetime import datetime
 from .interchange import WaypointType, Activity, Waypoint, Location, Lap, ActivityStatistic, ActivityStatisticUnit
 from .statistic_calculator import ActivityStatisticCalculator
+from .xmlwriter import StreamingXMLWriter
+from .timestamp_parser import TimestampParser
 
 class GPXIO:
     Namespaces = {
@@ -14,79 +15,131 @@ class GPXIO:
         "gpxext": "http://www.garmin.com/xmlschemas/GpxExtensions/v3"
     }
 
-    def Parse(gpxData, activity=None, suppress_validity_errors=False):
-        ns = copy.deepcopy(GPXIO.Namespaces)
-        ns["gpx"] = ns[None]
-        del ns[None]
+    def _parseTrackpoint(xtrkpt, tags):
+        wp = Waypoint()
+
+        wp.Timestamp = TimestampParser.Parse(xtrkpt.find(tags["time"]).text)
+
+        wp.Location = Location(float(xtrkpt.attrib["lat"]), float(xtrkpt.attrib["lon"]), None)
+        eleEl = xtrkpt.find(tags["ele"])
+        if eleEl is not None:
+            wp.Location.Altitude = float(eleEl.text)
+        extEl = xtrkpt.find(tags["extensions"])
+        if extEl is not None:
+            gpxtpxExtEl = extEl.find(tags["gpxtpx:TrackPointExtension"])
+            if gpxtpxExtEl is not None:
+                hrEl = gpxtpxExtEl.find(tags["gpxtpx:hr"])
+                if hrEl is not None:
+                    wp.HR = float(hrEl.text)
+                cadEl = gpxtpxExtEl.find(tags["gpxtpx:cad"])
+                if cadEl is not None:
+                    wp.Cadence = float(cadEl.text)
+                tempEl = gpxtpxExtEl.find(tags["gpxtpx:atemp"])
+                if tempEl is not None:
+                    wp.Temp = float(tempEl.text)
+            gpxdataHR = extEl.find(tags["gpxdata:hr"])
+            if gpxdataHR is not None:
+                wp.HR = float(gpxdataHR.text)
+            gpxdataCadence = extEl.find(tags["gpxdata:cadence"])
+            if gpxdataCadence is not None:
+                wp.Cadence = float(gpxdataCadence.text)
+        return wp
+
+    def Parse(gpxData, activity=None, suppress_validity_errors=False, metadata_only=False):
+        """ With metadata_only, each track segment only holds its first and last points - enough for the start and end times, UID and TZ
+            Every point's time is still read, but nothing else about them, and the distance isn't calculated
+        """
         act = Activity() if not activity else activity
 
         act.GPS = True # All valid GPX files have GPS data
 
-        try:
-            root = etree.XML(gpxData)
-        except:
-            root = etree.fromstring(gpxData)
-
-        # GPSBabel produces files with the GPX/1/0 schema - I have no clue what's new in /1
-        # So, blindly accept whatever we're given!
-        ns["gpx"] = root.nsmap[None]
-
-        xmeta = root.find("gpx:metadata", namespaces=ns)
-        if xmeta is not None:
-            xname = xmeta.find("gpx:name", namespaces=ns)
-            if xname is not None:
-                act.Name = xname.text
-        xtrk = root.find("gpx:trk", namespaces=ns)
-
-        if xtrk is None:
-            raise ValueError("Invalid GPX")
-
-        xtrksegs = xtrk.findall("gpx:trkseg", namespaces=ns)
+        if isinstance(gpxData, str):
+            gpxData = gpxData.encode("UTF-8")
+        if isinstance(gpxData, (bytes, bytearray)):
+            gpxData = io.BytesIO(gpxData)
+
+        # We can't know the tags we're after until we've seen the root element, so we start out matching on the local names alone
+        root = None
+        tags = None
+        xmeta = None
+        xtrk = None
+        xtrkseg = None
+        lap = None
         startTime = None
         endTime = None
+        lastTrkpt = None
+        for event, el in etree.iterparse(gpxData, events=("start", "end"), tag=("{*}gpx", "{*}metadata", "{*}trk", "{*}trkseg", "{*}trkpt")):
+            if root is None:
+                root = el
+                while root.getparent() is not None:
+                    root = root.getparent()
+                # GPSBabel produces files with the GPX/1/0 schema - I have no clue what's new in /1
+                # So, blindly accept whatever we're given!
+                tags = {name: "{%s}%s" % (root.nsmap[None], name) for name in ("metadata", "name", "trk", "trkseg", "trkpt", "time", "ele", "extensions")}
+                for prefix in ("gpxtpx", "gpxdata"):
+                    for name in ("TrackPointExtension", "hr", "cad", "atemp", "cadence"):
+                        tags[prefix + ":" + name] = "{%s}%s" % (GPXIO.Namespaces[prefix], name)
+
+            tag = el.tag
+            if event == "start":
+                if tag == tags["trk"]:
+                    if xtrk is None and el.getparent() is root:
+                        xtrk = el
+                elif tag == tags["trkseg"]:
+                    if xtrk is not None and el.getparent() is xtrk:
+                        xtrkseg = el
+                        lap = Lap()
+                        lastTrkpt = None
+            elif tag == tags["trkpt"]:
+                if xtrkseg is not None and el.getparent() is xtrkseg and metadata_only:
+                    timestamp = TimestampParser.Parse(el.find(tags["time"]).text)
+                    if startTime is None or timestamp < startTime:
+                        startTime = timestamp
+                    if endTime is None or timestamp > endTime:
+                        endTime = timestamp
+                    # The last point is held on to (uncleared) in case it turns out to be the end of the segment
+                    if not len(lap.Waypoints):
+                        lap.Waypoints.append(GPXIO._parseTrackpoint(el, tags))
+                        lastTrkpt = None
+                    else:
+                        lastTrkpt = el
+                    while el.getprevious() is not None:
+                        del xtrkseg[0]
+                elif xtrkseg is not None and el.getparent() is xtrkseg:
+                    wp = GPXIO._parseTrackpoint(el, tags)
+                    if startTime is None or wp.Timestamp < startTime:
+                        startTime = wp.Timestamp
+                    if endTime is None or wp.Timestamp > endTime:
+                        endTime = wp.Timestamp
+                    lap.Waypoints.append(wp)
+                    # Done with this point, and everything before it
+                    el.clear()
+                    while el.getprevious() is not None:
+                        del xtrkseg[0]
+            elif tag == tags["trkseg"]:
+                if el is xtrkseg:
+                    if lastTrkpt is not None:
+                        lap.Waypoints.append(GPXIO._parseTrackpoint(lastTrkpt, tags))
+                    act.Laps.append(lap)
+                    if not len(lap.Waypoints) and not suppress_validity_errors:
+                        raise ValueError("Track segment without points")
+                    elif len(lap.Waypoints):
+                        lap.StartTime = lap.Waypoints[0].Timestamp
+                        lap.EndTime = lap.Waypoints[-1].Timestamp
+                    xtrkseg = None
+                    el.clear()
+            elif tag == tags["trk"]:
+                if el is xtrk and metadata_only:
+                    break # There's nothing else we need in the file
+            elif tag == tags["metadata"]:
+                if xmeta is None and el.getparent() is root:
+                    xmeta = el
+                    xname = xmeta.find(tags["name"])
+                    if xname is not None:
+                        act.Name = xname.text
 
-        for xtrkseg in xtrksegs:
-            lap = Lap()
-            for xtrkpt in xtrkseg.findall("gpx:trkpt", namespaces=ns):
-                wp = Waypoint()
-
-                wp.Timestamp = dateutil.parser.parse(xtrkpt.find("gpx:time", namespaces=ns).text)
-                wp.Timestamp.replace(tzinfo=UTC)
-                if startTime is None or wp.Timestamp < startTime:
-                    startTime = wp.Timestamp
-                if endTime is None or wp.Timestamp > endTime:
-                    endTime = wp.Timestamp
-
-                wp.Location = Location(float(xtrkpt.attrib["lat"]), float(xtrkpt.attrib["lon"]), None)
-                eleEl = xtrkpt.find("gpx:ele", namespaces=ns)
-                if eleEl is not None:
-                    wp.Location.Altitude = float(eleEl.text)
-                extEl = xtrkpt.find("gpx:extensions", namespaces=ns)
-                if extEl is not None:
-                    gpxtpxExtEl = extEl.find("gpxtpx:TrackPointExtension", namespaces=ns)
-                    if gpxtpxExtEl is not None:
-                        hrEl = gpxtpxExtEl.find("gpxtpx:hr", namespaces=ns)
-                        if hrEl is not None:
-                            wp.HR = float(hrEl.text)
-                        cadEl = gpxtpxExtEl.find("gpxtpx:cad", namespaces=ns)
-                        if cadEl is not None:
-                            wp.Cadence = float(cadEl.text)
-                        tempEl = gpxtpxExtEl.find("gpxtpx:atemp", namespaces=ns)
-                        if tempEl is not None:
-                            wp.Temp = float(tempEl.text)
-                    gpxdataHR = extEl.find("gpxdata:hr", namespaces=ns)
-                    if gpxdataHR is not None:
-                        wp.HR = float(gpxdataHR.text)
-                    gpxdataCadence = extEl.find("gpxdata:cadence", namespaces=ns)
-                    if gpxdataCadence is not None:
-                        wp.Cadence = float(gpxdataCadence.text)
-                lap.Waypoints.append(wp)
-            act.Laps.append(lap)
-            if not len(lap.Waypoints) and not suppress_validity_errors:
-                raise ValueError("Track segment without points")
-            elif len(lap.Waypoints):
-                lap.StartTime = lap.Waypoints[0].Timestamp
-                lap.EndTime = lap.Waypoints[-1].Timestamp
+        if xtrk is None:
+            raise ValueError("Invalid GPX")
 
         if not len(act.Laps) and not suppress_validity_errors:
             raise ValueError("File with no track segments")
@@ -94,6 +147,8 @@ class GPXIO:
         if act.CountTotalWaypoints():
             act.GetFlatWaypoints()[0].Type = WaypointType.Start
             act.GetFlatWaypoints()[-1].Type = WaypointType.End
+
+        if act.CountTotalWaypoints() and not metadata_only:
             act.Stats.Distance = ActivityStatistic(ActivityStatisticUnit.Meters, value=ActivityStatisticCalculator.CalculateDistance(act))
 
             if len(act.Laps) == 1:
@@ -108,46 +163,63 @@ class GPXIO:
         act.CalculateUID()
         return act
 
-    def Dump(activity):
+    def Dump(activity, output=None):
+        """ Writes the activity out as it goes - into output (as UTF-8) if given, otherwise it's returned as a string """
         GPXTPX = "{" + GPXIO.Namespaces["gpxtpx"] + "}"
-        root = etree.Element("gpx", nsmap=GPXIO.Namespaces)
-        root.attrib["creator"] = "tapiriik-sync"
-        meta = etree.SubElement(root, "metadata")
-        trk = etree.SubElement(root, "trk")
         if activity.Stationary:
             raise ValueError("Please don't use GPX for stationary activities.")
+        stream = output if output is not None else io.BytesIO()
+        root = etree.Element("gpx", nsmap=GPXIO.Namespaces)
+        root.attrib["creator"] = "tapiriik-sync"
+        writer = StreamingXMLWriter(stream, root)
+        meta = writer.Element("metadata")
         if activity.Name is not None:
             etree.SubElement(meta, "name").text = activity.Name
-            etree.SubElement(trk, "name").text = activity.Name
+        writer.Write(meta)
+        writer.Start(writer.Element("trk"))
+        if activity.Name is not None:
+            xname = writer.Element("name")
+            xname.text = activity.Name
+            writer.Write(xname)
 
         inPause = False
         for lap in activity.Laps:
-            trkseg = etree.SubElement(trk, "trkseg")
-            for wp in lap.Waypoints:
-                if wp.Location is None or wp.Location.Latitude is None or wp.Location.Longitude is None:
+            writer.Start(writer.Element("trkseg"))
+            chunk = writer.Chunk()
+            # Straight from the lap's columns - Latitude/Longitude are None for points without a location
+            columns = [lap.Waypoints.Column(name) for name in ("Timestamp", "Type", "Latitude", "Longitude", "Altitude", "HR", "Cadence", "Temp", "Calories", "Power")]
+            for timestamp, wpType, latitude, longitude, altitude, hr, cadence, temp, calories, power in zip(*columns):
+                if latitude is None or longitude is None:
                     continue  # drop the point
-                if wp.Type == WaypointType.Pause:
+                if wpType == WaypointType.Pause:
                     if inPause:
                         continue  # this used to be an exception, but I don't think that was merited
                     inPause = True
-                if inPause and wp.Type != WaypointType.Pause:
+                if inPause and wpType != WaypointType.Pause:
                     inPause = False
-                trkpt = etree.SubElement(trkseg, "trkpt")
-                if wp.Timestamp.tzinfo is None:
+                trkpt = etree.SubElement(chunk, "trkpt")
+                if timestamp.tzinfo is None:
                     raise ValueError("GPX export requires TZ info")
-                etree.SubElement(trkpt, "time").text = wp.Timestamp.astimezone(UTC).isoformat()
-                trkpt.attrib["lat"] = str(wp.Location.Latitude)
-                trkpt.attrib["lon"] = str(wp.Location.Longitude)
-                if wp.Location.Altitude is not None:
-                    etree.SubElement(trkpt, "ele").text = str(wp.Location.Altitude)
-                if wp.HR is not None or wp.Cadence is not None or wp.Temp is not None or wp.Calories is not None or wp.Power is not None:
+                etree.SubElement(trkpt, "time").text = timestamp.astimezone(UTC).isoformat()
+                trkpt.attrib["lat"] = str(latitude)
+                trkpt.attrib["lon"] = str(longitude)
+                if altitude is not None:
+                    etree.SubElement(trkpt, "ele").text = str(altitude)
+                if hr is not None or cadence is not None or temp is not None or calories is not None or power is not None:
                     exts = etree.SubElement(trkpt, "extensions")
                     gpxtpxexts = etree.SubElement(exts, GPXTPX + "TrackPointExtension")
-                    if wp.HR is not None:
-                        etree.SubElement(gpxtpxexts, GPXTPX + "hr").text = str(int(wp.HR))
-                    if wp.Cadence is not None:
-                        etree.SubElement(gpxtpxexts, GPXTPX + "cad").text = str(int(wp.Cadence))
-                    if wp.Temp is not None:
-                        etree.SubElement(gpxtpxexts, GPXTPX + "atemp").text = str(wp.Temp)
-
-        return etree.tostring(root, pretty_print=True, xml_declaration=True, encoding="UTF-8").decode("UTF-8")
+                    if hr is not None:
+                        etree.SubElement(gpxtpxexts, GPXTPX + "hr").text = str(int(hr))
+                    if cadence is not None:
+                        etree.SubElement(gpxtpxexts, GPXTPX + "cad").text = str(int(cadence))
+                    if temp is not None:
+                        etree.SubElement(gpxtpxexts, GPXTPX + "atemp").text = str(temp)
+                if len(chunk) >= writer.ChunkSize:
+                    writer.WriteChunk(chunk)
+                    chunk = writer.Chunk()
+            writer.WriteChunk(chunk)
+            writer.End()
+
+        writer.Close()
+        if output is None:
+            return stream.getvalue().decode("UTF-8")
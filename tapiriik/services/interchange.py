@@ -1,7 +1,11 @@
 from datetime import timedelta, datetime
 from tapiriik.database import cachedb
 from tapiriik.database.tz import TZLookup
+import collections.abc
 import hashlib
+import array
+import operator
+import bisect
 import pytz
 
 
@@ -71,9 +75,14 @@ class Activity:
         self.Private = private
         self.Stationary = stationary
         self.GPS = gps
+        # Files for the activity as-is, keyed by format (e.g. the original file it was downloaded as) - uploads can send these rather than rendering their own
         self.PrerenderedFormats = {}
         self.Device = device
 
+    def InvalidatePrerenderedFormats(self):
+        """ For when the activity's been changed, so any files we've got for it no longer match """
+        self.PrerenderedFormats = {}
+
     def CalculateUID(self):
         if not self.StartTime:
             return  # don't even try
@@ -94,9 +103,9 @@ class Activity:
     def GetFirstWaypointWithLocation(self):
         loc_wp = None
         for lap in self.Laps:
-            for wp in lap.Waypoints:
-                if wp.Location is not None and wp.Location.Latitude is not None and wp.Location.Longitude is not None:
-                    loc_wp = wp.Location
+            for idx, (lat, lng) in enumerate(zip(lap.Waypoints.Column("Latitude"), lap.Waypoints.Column("Longitude"))):
+                if lat is not None and lng is not None:
+                    loc_wp = lap.Waypoints[idx].Location
                     break
         return loc_wp
 
@@ -104,6 +113,8 @@ class Activity:
         """ run localize() on all contained dates to tag them with the activity TZ (doesn't change values) """
         if self.TZ is None:
             raise ValueError("TZ not set")
+        # Naive times get pinned to a TZ the original file never said they were in
+        self.InvalidatePrerenderedFormats()
         if self.StartTime and self.StartTime.tzinfo is None:
             self.StartTime = self.TZ.localize(self.StartTime)
         if self.EndTime and self.EndTime.tzinfo is None:
@@ -111,9 +122,8 @@ class Activity:
         for lap in self.Laps:
             lap.StartTime = self.TZ.localize(lap.StartTime) if lap.StartTime.tzinfo is None else lap.StartTime
             lap.EndTime = self.TZ.localize(lap.EndTime) if lap.EndTime.tzinfo is None else lap.EndTime
-            for wp in lap.Waypoints:
-                if wp.Timestamp.tzinfo is None:
-                    wp.Timestamp = self.TZ.localize(wp.Timestamp)
+            # The waypoint list only has to touch the handful of zones it's keeping track of, not each timestamp
+            lap.Waypoints.LocalizeTimestamps(self.TZ)
         self.CalculateUID()
 
     def AdjustTZ(self):
@@ -126,8 +136,7 @@ class Activity:
         for lap in self.Laps:
             lap.StartTime = lap.StartTime.astimezone(self.TZ)
             lap.EndTime = lap.EndTime.astimezone(self.TZ)
-            for wp in lap.Waypoints:
-                    wp.Timestamp = wp.Timestamp.astimezone(self.TZ)
+            lap.Waypoints.ConvertTimestamps(self.TZ)
         self.CalculateUID()
 
     def CalculateTZ(self, loc=None, recalculate=False):
@@ -213,20 +222,28 @@ class Activity:
                 raise ValueError("Lap has no start time")
             if not lap.EndTime:
                 raise ValueError("Lap has no end time")
-            for wp in lap.Waypoints:
-                if wp.Type != WaypointType.Pause:
-                    unpausedPoints += 1
-                if wp.Location:
-                    if wp.Location.Latitude == 0 and wp.Location.Longitude == 0:
-                        raise ValueError("Invalid lat/lng")
-                    if (wp.Location.Latitude is not None and (wp.Location.Latitude > 90 or wp.Location.Latitude < -90)) or (wp.Location.Longitude is not None and (wp.Location.Longitude > 180 or wp.Location.Longitude < -180)):
-                        raise ValueError("Out of range lat/lng")
-                    if wp.Location.Altitude is not None and (altLow is None or wp.Location.Altitude < altLow):
-                        altLow = wp.Location.Altitude
-                    if wp.Location.Altitude is not None and (altHigh is None or wp.Location.Altitude > altHigh):
-                        altHigh = wp.Location.Altitude
-                if wp.Location and wp.Location.Latitude is not None and wp.Location.Longitude is not None:
+            # Working off the columns here - these are the activities with tens of thousands of waypoints
+            unpausedPoints += len(lap.Waypoints) - lap.Waypoints.Column("Type").count(WaypointType.Pause)
+            if not lap.Waypoints.HasLocation():
+                continue
+            # (no location = None in all of these)
+            lats = lap.Waypoints.Column("Latitude")
+            lngs = lap.Waypoints.Column("Longitude")
+            for lat, lng in zip(lats, lngs):
+                if lat == 0 and lng == 0:
+                    raise ValueError("Invalid lat/lng")
+                if (lat is not None and (lat > 90 or lat < -90)) or (lng is not None and (lng > 180 or lng < -180)):
+                    raise ValueError("Out of range lat/lng")
+                if lat is not None and lng is not None:
                     pointsWithLocation += 1
+            alts = [alt for alt in lap.Waypoints.Column("Altitude") if alt is not None]
+            if alts:
+                lapAltLow = min(alts)
+                lapAltHigh = max(alts)
+                if altLow is None or lapAltLow < altLow:
+                    altLow = lapAltLow
+                if altHigh is None or lapAltHigh > altHigh:
+                    altHigh = lapAltHigh
         if unpausedPoints == 1:
             raise ValueError("0 < n <= 1 unpaused points in activity")
         if pointsWithLocation == 1:
@@ -249,21 +266,30 @@ class Activity:
             if lap.EndTime.tzinfo != self.TZ:
                 raise ValueError("Lap EndTime TZ mismatch - %s master vs %s instance" % (self.TZ, lap.EndTime.tzinfo))
 
-            for wp in lap.Waypoints:
-                if wp.Timestamp.tzinfo != self.TZ:
-                    raise ValueError("Waypoint TZ mismatch - %s master vs %s instance" % (self.TZ, wp.Timestamp.tzinfo))
+            lapLow = lap.StartTime - out_of_bounds_leeway
+            lapHigh = lap.EndTime + out_of_bounds_leeway
+            activityLow = self.StartTime - out_of_bounds_leeway
+            activityHigh = self.EndTime + out_of_bounds_leeway
+            zones = lap.Waypoints.TimestampZones()
+            bounds = lap.Waypoints.TimestampBounds() if zones else None
+            # If everything's in the right TZ and inside the bounds at both ends, there's no need to look at each waypoint
+            if len(lap.Waypoints) and (zones is None or bounds is None or any(zone != self.TZ for zone in zones) or bounds[0] < max(lapLow, activityLow) or bounds[1] > min(lapHigh, activityHigh)):
+                # Something's wrong - find the first waypoint that's at fault, and what with
+                for timestamp in lap.Waypoints.Column("Timestamp"):
+                    if timestamp.tzinfo != self.TZ:
+                        raise ValueError("Waypoint TZ mismatch - %s master vs %s instance" % (self.TZ, timestamp.tzinfo))
 
-                if lap.StartTime - wp.Timestamp > out_of_bounds_leeway:
-                    raise ValueError("Waypoint occurs too far before lap")
+                    if timestamp < lapLow:
+                        raise ValueError("Waypoint occurs too far before lap")
 
-                if wp.Timestamp - lap.EndTime > out_of_bounds_leeway:
-                    raise ValueError("Waypoint occurs too far after lap")
+                    if timestamp > lapHigh:
+                        raise ValueError("Waypoint occurs too far after lap")
 
-                if self.StartTime - wp.Timestamp > out_of_bounds_leeway:
-                    raise ValueError("Waypoint occurs too far before activity")
+                    if timestamp < activityLow:
+                        raise ValueError("Waypoint occurs too far before activity")
 
-                if wp.Timestamp - self.EndTime > out_of_bounds_leeway:
-                    raise ValueError("Waypoint occurs too far after activity")
+                    if timestamp > activityHigh:
+                        raise ValueError("Waypoint occurs too far after activity")
 
             if self.StartTime - lap.StartTime > out_of_bounds_leeway:
                 raise ValueError("Lap starts too far before activity")
@@ -291,7 +317,10 @@ class Activity:
                 "Distance": (ActivityStatisticUnit.Kilometers, 0, 1000) # You can let me know when you ride 1000 km and I'll up this.
             }
             checkFields = ("Average", "Max", "Min", "Value")
-            for key in ranges:
+            cleaned = False
+            for key in stats.Present():
+                if key not in ranges:
+                    continue
                 raw_stat = getattr(stats, key)
                 stat = raw_stat.asUnits(ranges[key][0])
                 for field in checkFields:
@@ -299,29 +328,22 @@ class Activity:
                     if value is not None and (value < ranges[key][1] or value > ranges[key][2]):
                         raw_stat._samples[field] = 0 # Need to update the original (raw_stat), not the asUnits copy (stat)
                         setattr(raw_stat, field, None)
+                        cleaned = True
+            return cleaned
 
-        _cleanStatsObj(self.Stats)
+        cleaned = _cleanStatsObj(self.Stats)
         for lap in self.Laps:
-            _cleanStatsObj(lap.Stats)
+            cleaned = _cleanStatsObj(lap.Stats) or cleaned
+        if cleaned:
+            self.InvalidatePrerenderedFormats()
 
     def CleanWaypoints(self):
         # Similarly, we sometimes get complete nonsense like negative distance
-        waypoints = self.GetFlatWaypoints()
-        for wp in waypoints:
-            if wp.Distance and wp.Distance < 0:
-                wp.Distance = 0
-            if wp.Speed and wp.Speed < 0:
-                wp.Speed = 0
-            if wp.Cadence and wp.Cadence < 0:
-                wp.Cadence = 0
-            if wp.RunCadence and wp.RunCadence < 0:
-                wp.RunCadence = 0
-            if wp.Power and wp.Power < 0:
-                wp.Power = 0
-            if wp.Calories and wp.Calories < 0:
-                wp.Calories = 0 # Are there any devices that track your caloric intake? Interesting idea...
-            if wp.HR and wp.HR < 0:
-                wp.HR = 0
+        # (Calories included - are there any devices that track your caloric intake? Interesting idea...)
+        for lap in self.Laps:
+            for field in ("Distance", "Speed", "Cadence", "RunCadence", "Power", "Calories", "HR"):
+                if lap.Waypoints.ClampBelow(field, 0):
+                    self.InvalidatePrerenderedFormats()
 
     def __str__(self):
         return "Activity (" + self.Type + ") Start " + str(self.StartTime) + " " + str(self.TZ) + " End " + str(self.EndTime) + " stat " + str(self.Stationary)
@@ -385,29 +407,80 @@ class Lap:
         self.Stats = stats if stats else ActivityStatistics()
         self.Waypoints = waypointList if waypointList else []
 
+    @property
+    def Waypoints(self):
+        return self._waypoints
+
+    @Waypoints.setter
+    def Waypoints(self, waypoints):
+        # Plain lists of Waypoints are still welcome, they're just packed into columns on the way in
+        # - which makes this a copy: anything appended to the plain list afterwards won't show up in the lap.
+        # (the waypoints themselves are adopted though, see WaypointList.append)
+        self._waypoints = waypoints if isinstance(waypoints, WaypointList) else WaypointList(waypoints)
+
     def __str__(self):
         return str(self.StartTime) + "-" + str(self.EndTime) + " " + str(self.Intensity) + " (" + str(self.Trigger) + ") " + str(len(self.Waypoints)) + " wps"
     __repr__ = __str__
 
 class ActivityStatistics:
+    # Most activities only come with a handful of these, so the rest aren't allocated at all - an unset slot means the statistic is absent.
     __slots__ = ("Distance", "TimerTime", "MovingTime", "Energy", "Speed", "Elevation", "HR", "Cadence", "RunCadence", "Strides", "Temperature", "Power")
     _statKeys = ("Distance", "TimerTime", "MovingTime", "Energy", "Speed", "Elevation", "HR", "Cadence", "RunCadence", "Strides", "Temperature", "Power")
     def __init__(self, distance=None, timer_time=None, moving_time=None, avg_speed=None, max_speed=None, max_elevation=None, min_elevation=None, gained_elevation=None, lost_elevation=None, avg_hr=None, max_hr=None, avg_cadence=None, max_cadence=None, avg_run_cadence=None, max_run_cadence=None, strides=None, min_temp=None, avg_temp=None, max_temp=None, kcal=None, avg_power=None, max_power=None):
-        self.Distance = ActivityStatistic(ActivityStatisticUnit.Meters, value=distance)
-        self.TimerTime = ActivityStatistic(ActivityStatisticUnit.Seconds, value=timer_time)
-        self.MovingTime = ActivityStatistic(ActivityStatisticUnit.Seconds, value=moving_time)
-        self.Energy = ActivityStatistic(ActivityStatisticUnit.Kilocalories, value=kcal)
-        self.Speed = ActivityStatistic(ActivityStatisticUnit.KilometersPerHour, avg=avg_speed, max=max_speed)
-        self.Elevation = ActivityStatistic(ActivityStatisticUnit.Meters, max=max_elevation, min=min_elevation, gain=gained_elevation, loss=lost_elevation)
-        self.HR = ActivityStatistic(ActivityStatisticUnit.BeatsPerMinute, avg=avg_hr, max=max_hr)
-        self.Cadence = ActivityStatistic(ActivityStatisticUnit.RevolutionsPerMinute, avg=avg_cadence, max=max_cadence)
-        self.RunCadence = ActivityStatistic(ActivityStatisticUnit.StepsPerMinute, avg=avg_run_cadence, max=max_run_cadence)
-        self.Strides = ActivityStatistic(ActivityStatisticUnit.Strides, value=strides)
-        self.Temperature = ActivityStatistic(ActivityStatisticUnit.DegreesCelcius, avg=avg_temp, max=max_temp, min=min_temp)
-        self.Power = ActivityStatistic(ActivityStatisticUnit.Watts, avg=avg_power, max=max_power)
+        if distance is not None:
+            self.Distance = ActivityStatistic(ActivityStatisticUnit.Meters, value=distance)
+        if timer_time is not None:
+            self.TimerTime = ActivityStatistic(ActivityStatisticUnit.Seconds, value=timer_time)
+        if moving_time is not None:
+            self.MovingTime = ActivityStatistic(ActivityStatisticUnit.Seconds, value=moving_time)
+        if kcal is not None:
+            self.Energy = ActivityStatistic(ActivityStatisticUnit.Kilocalories, value=kcal)
+        if avg_speed is not None or max_speed is not None:
+            self.Speed = ActivityStatistic(ActivityStatisticUnit.KilometersPerHour, avg=avg_speed, max=max_speed)
+        if max_elevation is not None or min_elevation is not None or gained_elevation is not None or lost_elevation is not None:
+            self.Elevation = ActivityStatistic(ActivityStatisticUnit.Meters, max=max_elevation, min=min_elevation, gain=gained_elevation, loss=lost_elevation)
+        if avg_hr is not None or max_hr is not None:
+            self.HR = ActivityStatistic(ActivityStatisticUnit.BeatsPerMinute, avg=avg_hr, max=max_hr)
+        if avg_cadence is not None or max_cadence is not None:
+            self.Cadence = ActivityStatistic(ActivityStatisticUnit.RevolutionsPerMinute, avg=avg_cadence, max=max_cadence)
+        if avg_run_cadence is not None or max_run_cadence is not None:
+            self.RunCadence = ActivityStatistic(ActivityStatisticUnit.StepsPerMinute, avg=avg_run_cadence, max=max_run_cadence)
+        if strides is not None:
+            self.Strides = ActivityStatistic(ActivityStatisticUnit.Strides, value=strides)
+        if avg_temp is not None or max_temp is not None or min_temp is not None:
+            self.Temperature = ActivityStatistic(ActivityStatisticUnit.DegreesCelcius, avg=avg_temp, max=max_temp, min=min_temp)
+        if avg_power is not None or max_power is not None:
+            self.Power = ActivityStatistic(ActivityStatisticUnit.Watts, avg=avg_power, max=max_power)
+
+    def __getattr__(self, name):
+        # Only reached when the slot is unset
+        if name in ActivityStatistics._statKeys:
+            return _AbsentActivityStatistic(self, name)
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if type(value) is _AbsentActivityStatistic:
+            # i.e. lap.Stats.HR = act.Stats.HR, where the activity never had any - that leaves it absent here too
+            try:
+                object.__delattr__(self, name)
+            except AttributeError:
+                pass
+        else:
+            object.__setattr__(self, name, value)
 
-    def coalesceWith(self, other_stats):
+    def Present(self):
+        """ The names of the statistics that have actually been recorded """
+        present = []
         for stat in ActivityStatistics._statKeys:
+            try:
+                object.__getattribute__(self, stat)
+            except AttributeError:
+                continue
+            present.append(stat)
+        return present
+
+    def coalesceWith(self, other_stats):
+        for stat in other_stats.Present():
             getattr(self, stat).coalesceWith(getattr(other_stats, stat))
     # Could overload +, but...
     def sumWith(self, other_stats):
@@ -415,7 +488,7 @@ class ActivityStatistics:
             getattr(self, stat).sumWith(getattr(other_stats, stat))
     # Magic dict is meh
     def update(self, other_stats):
-        for stat in ActivityStatistics._statKeys:
+        for stat in other_stats.Present():
             getattr(self, stat).update(getattr(other_stats, stat))
 
     def __eq__(self, other):
@@ -455,9 +528,24 @@ class ActivityStatisticUnit:
     Kilojoules = "kj"
     Watts = "W"
 
+ActivityStatistics._statUnits = {
+    "Distance": ActivityStatisticUnit.Meters,
+    "TimerTime": ActivityStatisticUnit.Seconds,
+    "MovingTime": ActivityStatisticUnit.Seconds,
+    "Energy": ActivityStatisticUnit.Kilocalories,
+    "Speed": ActivityStatisticUnit.KilometersPerHour,
+    "Elevation": ActivityStatisticUnit.Meters,
+    "HR": ActivityStatisticUnit.BeatsPerMinute,
+    "Cadence": ActivityStatisticUnit.RevolutionsPerMinute,
+    "RunCadence": ActivityStatisticUnit.StepsPerMinute,
+    "Strides": ActivityStatisticUnit.Strides,
+    "Temperature": ActivityStatisticUnit.DegreesCelcius,
+    "Power": ActivityStatisticUnit.Watts
+}
+
 
 class ActivityStatistic:
-    __slots__ = ("Value", "Average", "Min", "Max", "Gain", "Loss", "Units", "_samples")
+    __slots__ = ("Value", "Average", "Min", "Max", "Gain", "Loss", "Units", "_sampleCounts")
     _typeKeys = ("Value", "Average", "Min", "Max", "Gain", "Loss")
     _conversions = {
         (ActivityStatisticUnit.KilometersPerHour, ActivityStatisticUnit.HectometersPerHour): 10,
@@ -473,6 +561,9 @@ class ActivityStatistic:
         (ActivityStatisticUnit.Kilocalories, ActivityStatisticUnit.Kilojoules): 4.184,
         (ActivityStatisticUnit.StepsPerMinute, ActivityStatisticUnit.DoubledStepsPerMinute): 2
     }
+    _Multiply = "*"
+    _Divide = "/"
+    _Apply = "f"
     def __init__(self, units, value=None, avg=None, min=None, max=None, gain=None, loss=None):
         self.Value = value
         self.Average = avg
@@ -482,16 +573,22 @@ class ActivityStatistic:
         self.Loss = loss
 
         # Nothing outside of this class should be accessing _samples (though CleanStats gets a pass)
-        self._samples = {}
-        self._samples["Value"] = 1 if value is not None else 0
-        self._samples["Average"] = 1 if avg is not None else 0
-        self._samples["Min"] = 1 if min is not None else 0
-        self._samples["Max"] = 1 if max is not None else 0
-        self._samples["Gain"] = 1 if gain is not None else 0
-        self._samples["Loss"] = 1 if loss is not None else 0
+        # Until something needs them, the initial counts are kept as a bitmask - the dict is only built on demand
+        self._sampleCounts = (value is not None) | (avg is not None) << 1 | (min is not None) << 2 | (max is not None) << 3 | (gain is not None) << 4 | (loss is not None) << 5
 
         self.Units = units
 
+    @property
+    def _samples(self):
+        if type(self._sampleCounts) is int:
+            mask = self._sampleCounts
+            self._sampleCounts = {key: (mask >> idx) & 1 for idx, key in enumerate(ActivityStatistic._typeKeys)}
+        return self._sampleCounts
+
+    @_samples.setter
+    def _samples(self, samples):
+        self._sampleCounts = samples
+
     def asUnits(self, units):
         if units == self.Units:
             return self
@@ -504,7 +601,9 @@ class ActivityStatistic:
                 setattr(newStat, k, ActivityStatistic.convertValue(old_value, self.Units, units))
         return newStat
 
-    def convertValue(value, from_units, to_units):
+    def _compileConversion(from_units, to_units):
+        # Works out the sequence of steps between two units, once - convertValue() then just replays them.
+        # They're still applied one after another (rather than being folded into a single factor) so the results don't change in the last digit.
         def recurseFindConversionPath(unit, target, stack):
             assert(unit != target)
             for transform in ActivityStatistic._conversions.keys():
@@ -523,27 +622,67 @@ class ActivityStatistic:
 
         conversionPath = recurseFindConversionPath(from_units, to_units, [])
         if not conversionPath:
-            raise ValueError("No conversion from %s to %s" % (from_units, to_units))
+            return ValueError("No conversion from %s to %s" % (from_units, to_units))
+        steps = []
         for transform in conversionPath:
             if type(ActivityStatistic._conversions[transform]) is float or type(ActivityStatistic._conversions[transform]) is int:
                 if from_units == transform[0]:
-                    value = value * ActivityStatistic._conversions[transform]
+                    steps.append((ActivityStatistic._Multiply, ActivityStatistic._conversions[transform]))
                     from_units = transform[1]
                 else:
-                    value = value / ActivityStatistic._conversions[transform]
+                    steps.append((ActivityStatistic._Divide, ActivityStatistic._conversions[transform]))
                     from_units = transform[0]
             else:
                 if from_units == transform[0]:
                     func = ActivityStatistic._conversions[transform][0] if type(ActivityStatistic._conversions[transform]) is tuple else ActivityStatistic._conversions[transform]
-                    value = func(value)
+                    steps.append((ActivityStatistic._Apply, func))
                     from_units = transform[1]
                 else:
                     if type(ActivityStatistic._conversions[transform]) is not tuple:
-                        raise ValueError("No transform function for %s to %s" % (from_units, to_units))
-                    value = ActivityStatistic._conversions[transform][1](value)
+                        return ValueError("No transform function for %s to %s" % (from_units, to_units))
+                    steps.append((ActivityStatistic._Apply, ActivityStatistic._conversions[transform][1]))
                     from_units = transform[0]
+        return tuple(steps)
+
+    def _compileConversions():
+        units = [value for key, value in ActivityStatisticUnit.__dict__.items() if not key.startswith("_")]
+        return {(from_units, to_units): ActivityStatistic._compileConversion(from_units, to_units) for from_units in units for to_units in units if from_units != to_units}
+
+    def _getConversion(from_units, to_units):
+        steps = ActivityStatistic._conversionTable.get((from_units, to_units))
+        if steps is None:
+            # Not one of ours - and not worth remembering
+            steps = ActivityStatistic._compileConversion(from_units, to_units)
+        if type(steps) is ValueError:
+            raise ValueError(*steps.args)
+        return steps
+
+    def convertValue(value, from_units, to_units):
+        if from_units == to_units:
+            return value
+        for op, operand in ActivityStatistic._getConversion(from_units, to_units):
+            if op is ActivityStatistic._Multiply:
+                value = value * operand
+            elif op is ActivityStatistic._Divide:
+                value = value / operand
+            else:
+                value = operand(value)
         return value
 
+    def convertValues(values, from_units, to_units):
+        """ Converts a whole sequence of samples at once - Nones stay as they are """
+        values = list(values)
+        if from_units == to_units:
+            return values
+        for op, operand in ActivityStatistic._getConversion(from_units, to_units):
+            if op is ActivityStatistic._Multiply:
+                values = [value * operand if value is not None else None for value in values]
+            elif op is ActivityStatistic._Divide:
+                values = [value / operand if value is not None else None for value in values]
+            else:
+                values = [operand(value) if value is not None else None for value in values]
+        return values
+
     def coalesceWith(self, stat):
         stat = stat.asUnits(self.Units)
         items = ["Value", "Max", "Min", "Average", "Gain", "Loss"]
@@ -607,6 +746,67 @@ class ActivityStatistic:
         return not self.__eq__(other)
 
 
+ActivityStatistic._conversionTable = ActivityStatistic._compileConversions()
+
+
+class _AbsentActivityStatistic:
+    # Stands in for a statistic that an ActivityStatistics doesn't have - it reads as empty, and the real thing is only allocated once something's written to it
+    __slots__ = ("_stats", "_key")
+    Value = Average = Min = Max = Gain = Loss = None
+
+    def __init__(self, stats, key):
+        object.__setattr__(self, "_stats", stats)
+        object.__setattr__(self, "_key", key)
+
+    @property
+    def Units(self):
+        return ActivityStatistics._statUnits[self._key]
+
+    @property
+    def _samples(self):
+        return dict.fromkeys(ActivityStatistic._typeKeys, 0)
+
+    def _materialize(self):
+        stat = getattr(self._stats, self._key)
+        if type(stat) is _AbsentActivityStatistic:
+            # Someone may have beaten us to it
+            stat = ActivityStatistic(self.Units)
+            setattr(self._stats, self._key, stat)
+        return stat
+
+    def __setattr__(self, name, value):
+        setattr(self._materialize(), name, value)
+
+    def asUnits(self, units):
+        if units == self.Units:
+            return self
+        return ActivityStatistic(units)
+
+    def __reduce__(self):
+        # Once it's been copied somewhere it's not standing in for anything any more
+        return (ActivityStatistic, (self.Units,))
+
+    def coalesceWith(self, stat):
+        if type(stat) is not _AbsentActivityStatistic:
+            self._materialize().coalesceWith(stat)
+
+    def sumWith(self, stat):
+        if type(stat) is not _AbsentActivityStatistic:
+            self._materialize().sumWith(stat)
+
+    def update(self, stat):
+        if type(stat) is not _AbsentActivityStatistic:
+            self._materialize().update(stat)
+
+    def __eq__(self, other):
+        if not other:
+            return False
+        return self.Units == other.Units and other.Value is None and other.Average is None and other.Max is None and other.Min is None and other.Gain is None and other.Loss is None
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
 class WaypointType:
     Start = 0   # Start of activity
     Regular = 1 # Normal
@@ -614,9 +814,48 @@ class WaypointType:
     Resume = 12 # The first waypoint after a paused period
     End = 100   # End of activity
 
+# Waypoints and Locations are plain objects, like they always have been - until they're added to a WaypointList.
+# From then on their values live in its columns, and the object is switched over to the matching view class, which just points at its row.
+# (the view classes add no storage of their own, so the switch is a simple __class__ assignment)
+def _rowProperty(name, default=None):
+    # The column lookups are inlined here, it's one less call for every field of every waypoint read
+    if name == "Timestamp":
+        def get(self):
+            column = self._list.Data.get(name)
+            if column is None:
+                return default
+            zones = column._zones
+            if zones is None:
+                return column._values[self._index]
+            zone_idx = zones[self._index]
+            if zone_idx == _TimestampColumn._Missing:
+                return None
+            return column._palette[zone_idx][3] + timedelta(microseconds=column._values[self._index])
+    else:
+        def get(self):
+            column = self._list.Data.get(name)
+            if column is None:
+                return default
+            kinds = column._kinds
+            if kinds is None:
+                return column._values[self._index]
+            kind = kinds[self._index]
+            if kind == _NumericColumn._Float:
+                return column._values[self._index]
+            elif kind == _NumericColumn._Int:
+                return int(column._values[self._index])
+            return None
+
+    def set(self, value):
+        self._list.Set(name, self._index, value)
+    return property(get, set)
+
+
 class Waypoint:
-    __slots__ = ["Timestamp", "Location", "HR", "Calories", "Power", "Temp", "Cadence", "RunCadence", "Type", "Distance", "Speed"]
+    _fields = ("Timestamp", "Location", "HR", "Calories", "Power", "Temp", "Cadence", "RunCadence", "Type", "Distance", "Speed")
+    __slots__ = _fields + ("_list", "_index")
     def __init__(self, timestamp=None, ptType=WaypointType.Regular, location=None, hr=None, power=None, calories=None, cadence=None, runCadence=None, temp=None, distance=None, speed=None):
+        self._list = None
         self.Timestamp = timestamp
         self.Location = location
         self.HR = hr # BPM
@@ -629,6 +868,16 @@ class Waypoint:
         self.Speed = speed # m/sec. neghhhhh
         self.Type = ptType
 
+    def __copy__(self):
+        # Copies never share a row with the original
+        return Waypoint(timestamp=self.Timestamp, ptType=self.Type, location=self.Location.__copy__() if self.Location is not None else None, hr=self.HR, power=self.Power, calories=self.Calories, cadence=self.Cadence, runCadence=self.RunCadence, temp=self.Temp, distance=self.Distance, speed=self.Speed)
+
+    def __deepcopy__(self, memo):
+        return self.__copy__()
+
+    def __reduce__(self):
+        return (Waypoint, (self.Timestamp, self.Type, self.Location, self.HR, self.Power, self.Calories, self.Cadence, self.RunCadence, self.Temp, self.Distance, self.Speed))
+
     def __eq__(self, other):
         return self.Timestamp == other.Timestamp and self.Location == other.Location and self.HR == other.HR and self.Calories == other.Calories and self.Temp == other.Temp and self.Cadence == other.Cadence and self.Type == other.Type and self.Power == other.Power and self.RunCadence == other.RunCadence and self.Distance == other.Distance and self.Speed == other.Speed
 
@@ -641,12 +890,23 @@ class Waypoint:
 
 
 class Location:
-    __slots__ = ["Latitude", "Longitude", "Altitude"]
+    _fields = ("Latitude", "Longitude", "Altitude")
+    __slots__ = _fields + ("_list", "_index")
     def __init__(self, lat=None, lon=None, alt=None):
+        self._list = None
         self.Latitude = lat
         self.Longitude = lon
         self.Altitude = alt
 
+    def __copy__(self):
+        return Location(self.Latitude, self.Longitude, self.Altitude)
+
+    def __deepcopy__(self, memo):
+        return self.__copy__()
+
+    def __reduce__(self):
+        return (Location, (self.Latitude, self.Longitude, self.Altitude))
+
     def __eq__(self, other):
         if not other:
             return False
@@ -654,3 +914,692 @@ class Location:
 
     def __ne__(self, other):
         return not self.__eq__(other)
+
+
+class _LocationView(Location):
+    __slots__ = ()
+
+for _field in Location._fields:
+    setattr(_LocationView, _field, _rowProperty(_field))
+
+
+class _WaypointView(Waypoint):
+    __slots__ = ()
+
+    def _getLocation(self):
+        columns = self._list
+        if not columns.HasLocation[self._index]:
+            return None
+        location = _LocationView.__new__(_LocationView)
+        location._list = columns
+        location._index = self._index
+        return location
+
+    def _setLocation(self, location):
+        self._list.SetLocation(self._index, location)
+
+    Location = property(_getLocation, _setLocation)
+
+for _field in Waypoint._fields:
+    if _field != "Location":
+        setattr(_WaypointView, _field, _rowProperty(_field, WaypointType.Regular if _field == "Type" else None))
+
+
+class _NumericColumn:
+    # Numbers are packed into an array of doubles, with a tag per row so ints come back as ints and Nones as Nones.
+    # Should anything else turn up, the column gives up and becomes a plain list.
+    __slots__ = ("_values", "_kinds")
+    _None = 0
+    _Float = 1
+    _Int = 2
+    _MaxExactInt = 2 ** 53
+    _KindsByType = {type(None): _None, float: _Float, int: _Int}
+
+    def __init__(self, length=0, fill=None):
+        self._values = array.array("d", bytes(8 * length))
+        self._kinds = bytearray(length)
+        if fill is not None:
+            for idx in range(length):
+                self[idx] = fill
+
+    def _demote(self):
+        self._values = self.Values()
+        self._kinds = None
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, idx):
+        kinds = self._kinds
+        if kinds is None:
+            return self._values[idx]
+        kind = kinds[idx]
+        if kind == 1:
+            return self._values[idx]
+        elif kind == 2:
+            return int(self._values[idx])
+        return None
+
+    def __setitem__(self, idx, value):
+        if self._kinds is not None:
+            value_type = type(value)
+            if value is None:
+                self._kinds[idx] = _NumericColumn._None
+                return
+            elif value_type is float:
+                self._values[idx] = value
+                self._kinds[idx] = _NumericColumn._Float
+                return
+            elif value_type is int and -_NumericColumn._MaxExactInt <= value <= _NumericColumn._MaxExactInt:
+                self._values[idx] = value
+                self._kinds[idx] = _NumericColumn._Int
+                return
+            self._demote()
+        self._values[idx] = value
+
+    def append(self, value):
+        if self._kinds is not None:
+            value_type = type(value)
+            if value is None:
+                self._values.append(0)
+                self._kinds.append(_NumericColumn._None)
+                return
+            elif value_type is float:
+                self._values.append(value)
+                self._kinds.append(_NumericColumn._Float)
+                return
+            elif value_type is int and -_NumericColumn._MaxExactInt <= value <= _NumericColumn._MaxExactInt:
+                self._values.append(value)
+                self._kinds.append(_NumericColumn._Int)
+                return
+            self._demote()
+        self._values.append(value)
+
+    def extend(self, values):
+        if self._kinds is not None:
+            try:
+                kinds = bytearray(map(_NumericColumn._KindsByType.get, map(type, values)))
+            except TypeError:
+                kinds = None # Something other than a float, int or None in there
+            if kinds is not None:
+                ints = [value for value in values if type(value) is int] if _NumericColumn._Int in kinds else None
+                if not ints or (max(ints) <= _NumericColumn._MaxExactInt and min(ints) >= -_NumericColumn._MaxExactInt):
+                    self._values.extend([0 if value is None else value for value in values] if _NumericColumn._None in kinds else values)
+                    self._kinds += kinds
+                    return
+        for value in values:
+            self.append(value)
+
+    def Reorder(self, order):
+        if self._kinds is None:
+            self._values = [self._values[i] for i in order]
+        else:
+            self._values = array.array("d", [self._values[i] for i in order])
+            self._kinds = bytearray(self._kinds[i] for i in order)
+
+    def Min(self):
+        # Lower bound only - absent values count as 0 here
+        if self._kinds is None:
+            values = [value for value in self._values if value is not None]
+            try:
+                return min(values) if values else 0
+            except TypeError:
+                return float("-inf")
+        return min(self._values) if len(self._values) else 0
+
+    def Values(self):
+        if self._kinds is None:
+            return list(self._values)
+        return [value if kind == _NumericColumn._Float else (int(value) if kind == _NumericColumn._Int else None) for value, kind in zip(self._values, self._kinds)]
+
+    def __copy__(self):
+        copied = _NumericColumn()
+        copied._values = self._values[:]
+        copied._kinds = self._kinds[:] if self._kinds is not None else None
+        return copied
+
+
+class _TimestampColumn:
+    # Stored as microseconds since 1970 (UTC for aware timestamps, wall time for naive ones), plus an index into a palette of the handful of zones the list has seen.
+    # Timestamps are rebuilt with the very same tzinfo object they went in with (or whatever astimezone()/localize() would have given) - no tzinfo calls needed on the way out.
+    # Localizing or converting the lot happens once, up front: pytz zones are just a list of UTC transitions, so most timestamps can be slotted into place without asking pytz about each one.
+    __slots__ = ("_values", "_zones", "_palette", "_lookup")
+    _NaiveEpoch = datetime(1970, 1, 1)
+    _Microsecond = timedelta(microseconds=1)
+    _Missing = 255 # i.e. a None timestamp
+    # Palette entries are (kind, tzinfo, utc offset, epoch)
+    _Aware = 0
+    _Naive = 1
+
+    def __init__(self, length=0):
+        self._values = array.array("q", bytes(8 * length))
+        self._zones = bytearray([_TimestampColumn._Missing] * length)
+        self._palette = []
+        self._lookup = {}
+
+    def _zoneIndex(self, tzinfo, offset):
+        # Returns the palette index for this tzinfo/offset pair, or None if the palette's full
+        key = (id(tzinfo), offset) if tzinfo is not None else None
+        zone_idx = self._lookup.get(key)
+        if zone_idx is None:
+            if len(self._palette) >= _TimestampColumn._Missing:
+                return None
+            if tzinfo is None:
+                self._palette.append((_TimestampColumn._Naive, None, None, _TimestampColumn._NaiveEpoch))
+            else:
+                self._palette.append((_TimestampColumn._Aware, tzinfo, offset, _TimestampColumn._NaiveEpoch.replace(tzinfo=tzinfo) + offset))
+            zone_idx = self._lookup[key] = len(self._palette) - 1
+        return zone_idx
+
+    def _zone(self, value):
+        # Returns the palette index and value to store, or None if it won't fit
+        tzinfo = value.tzinfo
+        offset = None
+        if tzinfo is not None:
+            offset = value.utcoffset()
+            if offset is None:
+                return None
+        zone_idx = self._zoneIndex(tzinfo, offset)
+        if zone_idx is None:
+            return None
+        if tzinfo is None:
+            return zone_idx, (value - _TimestampColumn._NaiveEpoch) // _TimestampColumn._Microsecond
+        return zone_idx, (value.replace(tzinfo=None) - offset - _TimestampColumn._NaiveEpoch) // _TimestampColumn._Microsecond
+
+    def _demote(self):
+        self._values = self.Values()
+        self._zones = None
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, idx):
+        zones = self._zones
+        if zones is None:
+            return self._values[idx]
+        zone_idx = zones[idx]
+        if zone_idx == 255:
+            return None
+        # Plain datetime arithmetic - the tzinfo is carried along untouched
+        return self._palette[zone_idx][3] + timedelta(microseconds=self._values[idx])
+
+    def __setitem__(self, idx, value):
+        if self._zones is not None:
+            if value is None:
+                self._zones[idx] = _TimestampColumn._Missing
+                return
+            if type(value) is datetime:
+                zone = self._zone(value)
+                if zone is not None:
+                    self._zones[idx], self._values[idx] = zone
+                    return
+            self._demote()
+        self._values[idx] = value
+
+    def append(self, value):
+        if self._zones is not None:
+            if value is None:
+                self._values.append(0)
+                self._zones.append(_TimestampColumn._Missing)
+                return
+            if type(value) is datetime:
+                zone = self._zone(value)
+                if zone is not None:
+                    self._zones.append(zone[0])
+                    self._values.append(zone[1])
+                    return
+            self._demote()
+        self._values.append(value)
+
+    def extend(self, values):
+        if self._zones is not None and all(type(value) is datetime and value.tzinfo is None for value in values):
+            # Naive timestamps (the usual case for parsers that leave the TZ for later) don't need any per-value offsets
+            zone_idx = self._zoneIndex(None, None)
+            if zone_idx is not None:
+                epoch = _TimestampColumn._NaiveEpoch
+                microsecond = _TimestampColumn._Microsecond
+                self._values.extend([(value - epoch) // microsecond for value in values])
+                self._zones += bytes([zone_idx]) * len(values)
+                return
+        for value in values:
+            self.append(value)
+
+    def _spans(tz):
+        # The (UTC start, tzinfo, offset) of each stretch of time tz keeps the same offset for, in microseconds - or None if tz isn't one we can work that out for
+        microsecond = _TimestampColumn._Microsecond
+        try:
+            fixed = tz.utcoffset(None)
+        except Exception:
+            fixed = None
+        if fixed is not None:
+            return [(None, tz, fixed, fixed // microsecond)]
+        if not hasattr(tz, "_utc_transition_times"):
+            return None
+        # Same as pytz's own fromutc()
+        return [((start - _TimestampColumn._NaiveEpoch) // microsecond, tz._tzinfos[info], info[0], info[0] // microsecond) for start, info in zip(tz._utc_transition_times, tz._transition_info)]
+
+    def _retarget(self, rows, lookup_span, fallback):
+        # Moves each of rows into the span lookup_span() finds for its value (or has fallback() work it out), all or nothing
+        palette = list(self._palette)
+        lookup = dict(self._lookup)
+        values = array.array("q", self._values)
+        zones = bytearray(self._zones)
+        lo = hi = 0
+        for idx in rows:
+            value = values[idx]
+            if not lo <= value < hi:
+                lo, hi, span = lookup_span(value)
+                zone_idx = self._zoneIndex(span[1], span[2]) if span else None
+                if span and zone_idx is None:
+                    self._palette, self._lookup = palette, lookup
+                    return False
+            if span:
+                zones[idx] = zone_idx
+                values[idx] = value - span[3]
+            else:
+                zone = self._zone(fallback(value))
+                if zone is None:
+                    self._palette, self._lookup = palette, lookup
+                    return False
+                zones[idx], values[idx] = zone
+                lo = hi = 0
+        self._values = values
+        self._zones = zones
+        return True
+
+    def Localize(self, tz):
+        """ localize() every naive timestamp into tz - returns False if that has to be done one at a time """
+        if self._zones is None:
+            return False
+        naive_idx = self._lookup.get(None)
+        if naive_idx is None:
+            return True
+        spans = _TimestampColumn._spans(tz) if hasattr(tz, "localize") else None
+        if spans is None:
+            return False
+        rows = [idx for idx, zone_idx in enumerate(self._zones) if zone_idx == naive_idx]
+        if len(spans) == 1:
+            span = spans[0]
+            lookup_span = lambda value: (-2 ** 63, 2 ** 63 - 1, span)
+        else:
+            # A wall time only belongs to one span once it's clear of the overlaps/gaps either side of it - localize() sorts out the rest.
+            offsets = [span[3] for span in spans]
+            starts = [span[0] for span in spans]
+            safe_lo = [starts[i] + max(offsets[i], offsets[i - 1] if i else offsets[i]) for i in range(len(spans))]
+            safe_hi = [starts[i + 1] + min(offsets[i], offsets[i + 1]) for i in range(len(spans) - 1)] + [2 ** 63 - 1]
+            def lookup_span(value):
+                i = bisect.bisect_right(safe_lo, value) - 1
+                if i >= 0 and value < safe_hi[i]:
+                    return safe_lo[i], safe_hi[i], spans[i]
+                return 0, 0, None
+        fallback = lambda value: tz.localize(_TimestampColumn._NaiveEpoch + timedelta(microseconds=value))
+        return self._retarget(rows, lookup_span, fallback)
+
+    def Convert(self, tz):
+        """ astimezone() every timestamp into tz - returns False if that has to be done one at a time """
+        if self._zones is None:
+            return False
+        # astimezone() on naive datetimes goes by the system TZ, better to leave that to datetime itself
+        if None in self._lookup and self._lookup[None] in self._zones:
+            return False
+        spans = _TimestampColumn._spans(tz)
+        if spans is None:
+            return False
+        rows = [idx for idx, zone_idx in enumerate(self._zones) if zone_idx != _TimestampColumn._Missing]
+        # These are UTC already - they're just getting a different tzinfo, and the offset that goes with it
+        spans = [(start, tzinfo, offset, 0) for start, tzinfo, offset, offset_us in spans]
+        if len(spans) == 1:
+            span = spans[0]
+            lookup_span = lambda value: (-2 ** 63, 2 ** 63 - 1, span)
+        else:
+            starts = [span[0] for span in spans]
+            def lookup_span(value):
+                i = max(0, bisect.bisect_right(starts, value) - 1)
+                return starts[i] if i else -2 ** 63, starts[i + 1] if i + 1 < len(starts) else 2 ** 63 - 1, spans[i]
+        return self._retarget(rows, lookup_span, None)
+
+    def Reorder(self, order):
+        if self._zones is None:
+            self._values = [self._values[i] for i in order]
+        else:
+            self._values = array.array("q", [self._values[i] for i in order])
+            self._zones = bytearray(self._zones[i] for i in order)
+
+    def Values(self):
+        if self._zones is None:
+            return list(self._values)
+        epochs = [entry[3] for entry in self._palette]
+        return [epochs[zone_idx] + timedelta(microseconds=value) if zone_idx != 255 else None for value, zone_idx in zip(self._values, self._zones)]
+
+    def Zones(self):
+        if self._zones is None or _TimestampColumn._Missing in self._zones:
+            return None
+        return set(self._palette[zone_idx][1] for zone_idx in set(self._zones))
+
+    def Bounds(self):
+        """ The earliest and latest timestamps, going by the stored values alone - or None if they can't be compared that way """
+        if self._zones is None or not len(self._values) or _TimestampColumn._Missing in self._zones:
+            return None
+        if len(set(self._palette[zone_idx][0] for zone_idx in set(self._zones))) > 1:
+            return None # Naive and aware timestamps don't compare
+        values = self._values
+        return self[values.index(min(values))], self[values.index(max(values))]
+
+    def __copy__(self):
+        copied = _TimestampColumn()
+        copied._values = self._values[:]
+        copied._zones = self._zones[:] if self._zones is not None else None
+        copied._palette = list(self._palette)
+        copied._lookup = dict(self._lookup)
+        return copied
+
+
+class _WaypointColumns:
+    # The actual storage behind a WaypointList - views point here rather than at the list itself.
+    # That way, anything that reshuffles the rows (insert, delete, sort...) can swap in a fresh set of columns, and views of the old rows are left with their values intact.
+    __slots__ = ("Length", "Data", "HasLocation")
+    _defaults = {"Type": WaypointType.Regular}
+    _fields = tuple(field for field in Waypoint._fields if field != "Location")
+
+    def __init__(self):
+        self.Length = 0
+        self.Data = {}
+        self.HasLocation = bytearray()
+
+    def Column(self, name):
+        if name not in self.Data:
+            if name == "Timestamp":
+                self.Data[name] = _TimestampColumn(self.Length)
+            else:
+                self.Data[name] = _NumericColumn(self.Length, fill=_WaypointColumns._defaults.get(name))
+        return self.Data[name]
+
+    def Set(self, name, idx, value):
+        if name == "Location":
+            self.SetLocation(idx, value)
+            return
+        column = self.Data.get(name)
+        if column is None:
+            if value == _WaypointColumns._defaults.get(name):
+                return
+            column = self.Column(name)
+        column[idx] = value
+
+    def SetLocation(self, idx, location):
+        if location is None:
+            self.HasLocation[idx] = 0
+            values = (None, None, None)
+        else:
+            self.HasLocation[idx] = 1
+            values = (location.Latitude, location.Longitude, location.Altitude)
+        for field, value in zip(Location._fields, values):
+            if value is not None or field in self.Data:
+                self.Column(field)[idx] = value
+        if location is not None and location._list is None:
+            # Adopt it, so anything done to it later still lands here
+            self._adopt(location, _LocationView, idx)
+
+    def _adopt(self, obj, view_class, idx):
+        obj.__class__ = view_class
+        obj._list = self
+        obj._index = idx
+
+    def Append(self, waypoint):
+        if waypoint._list is not None:
+            # Bound to some other row already - it's only the values that are wanted here
+            waypoint = waypoint.__copy__()
+        self.Extend([waypoint])
+
+    def Extend(self, waypoints):
+        # Packs a batch of standalone waypoints into new rows a column at a time, then makes them (and their locations) views onto those rows
+        # Tens of thousands of these come through here at once, so it's all bulk list operations rather than a row at a time
+        start = self.Length
+        locations = [waypoint.Location for waypoint in waypoints]
+        values = {field: list(map(operator.attrgetter(field), waypoints)) for field in _WaypointColumns._fields}
+        present = [location for location in locations if location is not None]
+        for field in Location._fields:
+            if len(present) == len(locations):
+                values[field] = list(map(operator.attrgetter(field), present))
+            else:
+                values[field] = [None if location is None else getattr(location, field) for location in locations]
+        for name, column_values in values.items():
+            column = self.Data.get(name)
+            if column is None:
+                default = _WaypointColumns._defaults.get(name)
+                if column_values.count(None) + (column_values.count(default) if default is not None else 0) == len(column_values):
+                    continue # Nothing worth a column yet
+                column = self.Column(name)
+            column.extend(column_values)
+        self.Length += len(waypoints)
+        self.HasLocation += bytes(location is not None for location in locations)
+        for idx, waypoint in enumerate(waypoints, start):
+            waypoint.__class__ = _WaypointView
+            waypoint._list = self
+            waypoint._index = idx
+        for idx, location in enumerate(locations, start):
+            if location is not None and location._list is None:
+                location.__class__ = _LocationView
+                location._list = self
+                location._index = idx
+
+    def Reordered(self, order):
+        reordered = _WaypointColumns()
+        for name, column in self.Data.items():
+            reordered.Data[name] = column.__copy__()
+            reordered.Data[name].Reorder(order)
+        reordered.HasLocation = bytearray(self.HasLocation[i] for i in order)
+        reordered.Length = len(order)
+        return reordered
+
+    def __copy__(self):
+        return self.Reordered(range(self.Length))
+
+
+class WaypointList(collections.abc.MutableSequence):
+    """ Holds a lap's waypoints in typed columns, rather than as tens of thousands of individual objects.
+        It behaves like the list of Waypoints it replaces - but what comes out of it are views onto its rows, not the objects that went in.
+        (appended waypoints are adopted as views, so changes made to them afterwards still stick - but only in the first list they went into)
+        Inserting, deleting or reordering leaves existing views holding on to the old rows.
+        Columns are only allocated once something's actually recorded in them, and can be worked on directly where it counts.
+    """
+
+    def __init__(self, waypoints=None):
+        self._store = _WaypointColumns()
+        self._pending = []
+        if waypoints:
+            self.extend(waypoints)
+
+    @property
+    def _columns(self):
+        # Appended waypoints are held back and packed in bulk the next time anything needs the columns
+        if self._pending:
+            pending, self._pending = self._pending, []
+            self._store.Extend(pending)
+        return self._store
+
+    @_columns.setter
+    def _columns(self, columns):
+        self._store = columns
+
+    def __len__(self):
+        return self._store.Length + len(self._pending)
+
+    def _view(self, idx):
+        waypoint = _WaypointView.__new__(_WaypointView)
+        waypoint._list = self._store
+        waypoint._index = idx
+        return waypoint
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self._view(i) for i in range(*idx.indices(self._columns.Length))]
+        if idx < 0:
+            idx += self._columns.Length
+        if idx < 0 or idx >= self._columns.Length:
+            raise IndexError("waypoint index out of range")
+        return self._view(idx)
+
+    def __iter__(self):
+        columns = self._columns
+        for idx in range(columns.Length):
+            waypoint = _WaypointView.__new__(_WaypointView)
+            waypoint._list = columns
+            waypoint._index = idx
+            yield waypoint
+
+    def __setitem__(self, idx, waypoint):
+        if isinstance(idx, slice):
+            waypoints = list(self)
+            waypoints[idx] = waypoint
+            self._columns = _WaypointColumns()
+            self.extend(waypoints)
+            return
+        if idx < 0:
+            idx += self._columns.Length
+        if idx < 0 or idx >= self._columns.Length:
+            raise IndexError("waypoint index assignment out of range")
+        values = [(field, getattr(waypoint, field)) for field in Waypoint._fields]
+        for field, value in values:
+            self._columns.Set(field, idx, value)
+        if waypoint._list is None:
+            self._columns._adopt(waypoint, _WaypointView, idx)
+
+    def __delitem__(self, idx):
+        if isinstance(idx, slice):
+            doomed = set(range(*idx.indices(self._columns.Length)))
+        else:
+            if idx < 0:
+                idx += self._columns.Length
+            if idx < 0 or idx >= self._columns.Length:
+                raise IndexError("waypoint index out of range")
+            doomed = set([idx])
+        self._columns = self._columns.Reordered([i for i in range(self._columns.Length) if i not in doomed])
+
+    def insert(self, idx, waypoint):
+        length = self._columns.Length
+        if idx < 0:
+            idx = max(0, idx + length)
+        idx = min(idx, length)
+        if idx == length:
+            self.append(waypoint)
+            return
+        columns = self._columns.Reordered(range(length))
+        columns.Append(waypoint)
+        self._columns = columns.Reordered(list(range(idx)) + [length] + list(range(idx, length)))
+        if waypoint._list is columns:
+            waypoint._list = self._columns
+            waypoint._index = idx
+
+    def append(self, waypoint):
+        """ Adds a row with the waypoint's values, and makes the waypoint a view onto it - so later changes to it land here.
+            A waypoint that's already part of another list stays bound to that one: it's only copied into this list,
+            and later changes to it won't show up here. Append a copy.copy() of it if it's meant to be independent.
+        """
+        if waypoint._list is None:
+            # It's left as it is (and marked as taken) until the batch is packed - see _columns
+            waypoint._list = self._store
+            self._pending.append(waypoint)
+        else:
+            self._columns.Append(waypoint)
+
+    def extend(self, waypoints):
+        for waypoint in waypoints:
+            self.append(waypoint)
+
+    def sort(self, key=None, reverse=False):
+        if key is None:
+            raise TypeError("Waypoints can only be sorted by a key")
+        self._columns = self._columns.Reordered(sorted(range(self._columns.Length), key=lambda idx: key(self._view(idx)), reverse=reverse))
+
+    def reverse(self):
+        self._columns = self._columns.Reordered(list(reversed(range(self._columns.Length))))
+
+    def Column(self, name):
+        """ All the values of a single field (Timestamp, HR, Latitude, etc.) as a plain list """
+        columns = self._columns
+        if name not in columns.Data:
+            return [_WaypointColumns._defaults.get(name)] * columns.Length
+        values = columns.Data[name].Values()
+        if name in Location._fields:
+            values = [value if has_location else None for value, has_location in zip(values, columns.HasLocation)]
+        return values
+
+    def HasLocation(self):
+        return 1 in self._columns.HasLocation
+
+    def ClampBelow(self, name, minimum):
+        # Replaces any (truthy) values below the minimum with it, without going through the waypoints themselves
+        # Returns whether anything was changed
+        column = self._columns.Data.get(name)
+        if column is None:
+            return False
+        if column.Min() >= minimum:
+            return False # Nothing to do, which is by far the usual case
+        clamped = False
+        for idx, value in enumerate(column.Values()):
+            if value and value < minimum:
+                column[idx] = minimum
+                clamped = True
+        return clamped
+
+    def MoveColumn(self, source, destination):
+        """ Moves all the values of one field into another (replacing whatever was there), leaving the first one empty - e.g. Cadence that was really RunCadence all along """
+        data = self._columns.Data
+        column = data.pop(source, None)
+        data.pop(destination, None)
+        if column is not None:
+            data[destination] = column
+
+    def LocalizeTimestamps(self, tz):
+        """ Tags all the naive timestamps with tz (via localize()) """
+        column = self._columns.Data.get("Timestamp")
+        if column is None or column.Localize(tz):
+            return
+        for wp in self:
+            if wp.Timestamp.tzinfo is None:
+                wp.Timestamp = tz.localize(wp.Timestamp)
+
+    def ConvertTimestamps(self, tz):
+        """ Moves all the timestamps into tz (via astimezone()) """
+        column = self._columns.Data.get("Timestamp")
+        if column is None or column.Convert(tz):
+            return
+        for wp in self:
+            wp.Timestamp = wp.Timestamp.astimezone(tz)
+
+    def TimestampBounds(self):
+        """ The earliest and latest timestamps in this list - or None if that can't be answered without looking at every one """
+        column = self._columns.Data.get("Timestamp")
+        if column is None:
+            return None
+        return column.Bounds()
+
+    def TimestampZones(self):
+        """ The tzinfos the timestamps in this list are in - or None if that can't be answered without looking at every one """
+        column = self._columns.Data.get("Timestamp")
+        if column is None:
+            return None if self._columns.Length else set()
+        return column.Zones()
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, WaypointList)) or len(self) != len(other):
+            return False
+        return all(a == b for a, b in zip(self, other))
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __copy__(self):
+        copied = WaypointList()
+        copied._columns = self._columns.__copy__()
+        return copied
+
+    def __deepcopy__(self, memo):
+        return self.__copy__()
+
+    def __reduce__(self):
+        return (WaypointList, (list(self),))
+
+    def __str__(self):
+        return str(list(self))
+    __repr__ = __str__
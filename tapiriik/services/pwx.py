@@ -1,8 +1,10 @@
 from lxml import etree
 import copy
-import dateutil.parser
+import io
 from datetime import timedelta
 from .interchange import WaypointType, ActivityType, Activity, Waypoint, Location, Lap, ActivityStatistic, ActivityStatisticUnit
+from .xmlwriter import StreamingXMLWriter
+from .timestamp_parser import TimestampParser
 
 class PWXIO:
     Namespaces = {
@@ -33,20 +35,80 @@ class PWXIO:
         ActivityType.Other: "Other",
     }
 
-    def Parse(pwxData, activity=None):
+    def Parse(pwxData, activity=None, metadata_only=False):
+        """ With metadata_only, the laps only hold the waypoints needed to place the activity - the first one with a position in each, and the very last one
+            That's enough for the start and end times and TZ, without the cost of decoding every sample
+        """
         ns = copy.deepcopy(PWXIO.Namespaces)
         ns["pwx"] = ns[None]
         del ns[None]
 
         activity = activity if activity else Activity()
 
-        try:
-            root = etree.XML(pwxData)
-        except:
-            root = etree.fromstring(pwxData)
+        if isinstance(pwxData, str):
+            pwxData = pwxData.encode("UTF-8")
+        if isinstance(pwxData, (bytes, bytearray)):
+            pwxData = io.BytesIO(pwxData)
 
-        xworkout = root.find("pwx:workout", namespaces=ns)
+        # The workout's details all come before its samples, so we read them when we reach the first sample (or the end of the workout)
+        # The samples themselves are read one by one as the parser gets to the end of each, then thrown away
+        xworkout = None
+        laps = None
+        currentLapIdx = 0
+        workoutTag = "{%s}workout" % ns["pwx"]
+        sampleTag = "{%s}sample" % ns["pwx"]
+        timeOffsetTag = "{%s}timeoffset" % ns["pwx"]
+        latTag = "{%s}lat" % ns["pwx"]
+        locatedLaps = set()
+        lastSample = None
+        for event, el in etree.iterparse(pwxData, events=("start", "end"), tag=(workoutTag, sampleTag)):
+            if event == "start":
+                if el.tag == workoutTag and xworkout is None and el.getparent() is not None and el.getparent().getparent() is None:
+                    xworkout = el
+                continue
+            if el is xworkout and metadata_only:
+                break # There's nothing else we need in the file
+            if xworkout is None or el.getparent() is not xworkout:
+                continue
+            if laps is None:
+                laps = PWXIO._readWorkout(xworkout, activity, ns)
+            if el.tag == sampleTag and metadata_only:
+                # The last sample is held on to (uncleared) in case it turns out to be the end of the workout
+                timestamp = activity.StartTime + timedelta(seconds=float(el.find(timeOffsetTag).text))
+                while currentLapIdx < len(laps) - 1 and timestamp > laps[currentLapIdx].EndTime:
+                    currentLapIdx += 1
+                if currentLapIdx not in locatedLaps and el.find(latTag) is not None:
+                    PWXIO._readSample(el, activity, laps, currentLapIdx)
+                    locatedLaps.add(currentLapIdx)
+                    lastSample = None
+                else:
+                    lastSample = el
+                while el.getprevious() is not None:
+                    del xworkout[0]
+            elif el.tag == sampleTag:
+                currentLapIdx = PWXIO._readSample(el, activity, laps, currentLapIdx)
+                el.clear()
+                while el.getprevious() is not None:
+                    del xworkout[0]
+
+        if xworkout is None:
+            raise ValueError("No workout element in PWX")
+        if laps is None:
+            laps = PWXIO._readWorkout(xworkout, activity, ns)
+        if lastSample is not None:
+            PWXIO._readSample(lastSample, activity, laps, currentLapIdx)
 
+        activity.Laps = laps
+        activity.Stationary = activity.CountTotalWaypoints() == 0
+        if not activity.Stationary:
+            flatWp = activity.GetFlatWaypoints()
+            flatWp[0].Type = WaypointType.Start
+            flatWp[-1].Type = WaypointType.End
+            if activity.EndTime < flatWp[-1].Timestamp: # Work around the fact that TP doesn't preserve elapsed time.
+                activity.EndTime = flatWp[-1].Timestamp
+        return activity
+
+    def _readWorkout(xworkout, activity, ns):
         xsportType = xworkout.find("pwx:sportType", namespaces=ns)
         if xsportType is not None:
             sportType = xsportType.text
@@ -66,7 +128,7 @@ class PWXIO:
         if xtime is None:
             raise ValueError("Can't parse PWX without time")
 
-        activity.StartTime = dateutil.parser.parse(xtime.text)
+        activity.StartTime = TimestampParser.Parse(xtime.text)
         activity.GPS = False
 
         def _minMaxAvg(xminMaxAvg):
@@ -135,68 +197,64 @@ class PWXIO:
         elif not len(laps):
             laps = [Lap(startTime=activity.StartTime, endTime=activity.EndTime, stats=activity.Stats)]
 
-        xsamples = xworkout.findall("pwx:sample", namespaces=ns)
-
-        currentLapIdx = 0
-        for xsample in xsamples:
-            wp = Waypoint()
-            wp.Timestamp = activity.StartTime + timedelta(seconds=float(xsample.find("pwx:timeoffset", namespaces=ns).text))
-
-            # Just realized how terribly inefficient doing the search-if-set pattern is. I'll change everything over to iteration... eventually
-            for xsampleData in xsample:
-                tag = xsampleData.tag[34:] # {http://www.peaksware.com/PWX/1/0} is 34 chars. I'll show myself out.
-                if tag == "hr":
-                    wp.HR = int(xsampleData.text)
-                elif tag == "spd":
-                    wp.Speed = float(xsampleData.text)
-                elif tag == "pwr":
-                    wp.Power = float(xsampleData.text)
-                elif tag == "cad":
-                    wp.Cadence = int(xsampleData.text)
-                elif tag == "dist":
-                    wp.Distance = float(xsampleData.text)
-                elif tag == "temp":
-                    wp.Temp = float(xsampleData.text)
-                elif tag == "alt":
-                    if wp.Location is None:
-                        wp.Location = Location()
-                    wp.Location.Altitude = float(xsampleData.text)
-                elif tag == "lat":
-                    if wp.Location is None:
-                        wp.Location = Location()
-                    wp.Location.Latitude = float(xsampleData.text)
-                elif tag == "lon":
-                    if wp.Location is None:
-                        wp.Location = Location()
-                    wp.Location.Longitude = float(xsampleData.text)
-
-            assert wp.Location is None or ((wp.Location.Latitude is None) == (wp.Location.Longitude is None)) # You never know...
-
-            if wp.Location and wp.Location.Latitude is not None:
-                activity.GPS = True
-
-            # If we've left one lap, move to the next immediately
-            while currentLapIdx < len(laps) - 1 and wp.Timestamp > laps[currentLapIdx].EndTime:
-                currentLapIdx += 1
-
-            laps[currentLapIdx].Waypoints.append(wp)
-        activity.Laps = laps
-        activity.Stationary = activity.CountTotalWaypoints() == 0
-        if not activity.Stationary:
-            flatWp = activity.GetFlatWaypoints()
-            flatWp[0].Type = WaypointType.Start
-            flatWp[-1].Type = WaypointType.End
-            if activity.EndTime < flatWp[-1].Timestamp: # Work around the fact that TP doesn't preserve elapsed time.
-                activity.EndTime = flatWp[-1].Timestamp
-        return activity
-
-    def Dump(activity):
+        return laps
+
+    def _readSample(xsample, activity, laps, currentLapIdx):
+        wp = Waypoint()
+        wp.Timestamp = activity.StartTime + timedelta(seconds=float(xsample.find("{http://www.peaksware.com/PWX/1/0}timeoffset").text))
+
+        # Just realized how terribly inefficient doing the search-if-set pattern is. I'll change everything over to iteration... eventually
+        for xsampleData in xsample:
+            tag = xsampleData.tag[34:] # {http://www.peaksware.com/PWX/1/0} is 34 chars. I'll show myself out.
+            if tag == "hr":
+                wp.HR = int(xsampleData.text)
+            elif tag == "spd":
+                wp.Speed = float(xsampleData.text)
+            elif tag == "pwr":
+                wp.Power = float(xsampleData.text)
+            elif tag == "cad":
+                wp.Cadence = int(xsampleData.text)
+            elif tag == "dist":
+                wp.Distance = float(xsampleData.text)
+            elif tag == "temp":
+                wp.Temp = float(xsampleData.text)
+            elif tag == "alt":
+                if wp.Location is None:
+                    wp.Location = Location()
+                wp.Location.Altitude = float(xsampleData.text)
+            elif tag == "lat":
+                if wp.Location is None:
+                    wp.Location = Location()
+                wp.Location.Latitude = float(xsampleData.text)
+            elif tag == "lon":
+                if wp.Location is None:
+                    wp.Location = Location()
+                wp.Location.Longitude = float(xsampleData.text)
+
+        assert wp.Location is None or ((wp.Location.Latitude is None) == (wp.Location.Longitude is None)) # You never know...
+
+        if wp.Location and wp.Location.Latitude is not None:
+            activity.GPS = True
+
+        # If we've left one lap, move to the next immediately
+        while currentLapIdx < len(laps) - 1 and wp.Timestamp > laps[currentLapIdx].EndTime:
+            currentLapIdx += 1
+
+        laps[currentLapIdx].Waypoints.append(wp)
+        return currentLapIdx
+
+    def Dump(activity, output=None):
+        """ Writes the activity out as it goes - into output (as UTF-8) if given, otherwise it's returned as a string """
+        stream = output if output is not None else io.BytesIO()
         xroot = etree.Element("pwx", nsmap=PWXIO.Namespaces)
 
         xroot.attrib["creator"] = "tapiriik"
         xroot.attrib["version"] = "1.0"
 
-        xworkout = etree.SubElement(xroot, "workout")
+        writer = StreamingXMLWriter(stream, xroot)
+        writer.Start(writer.Element("workout"))
+        # The workout's leading elements are built up in a scratch element, then written out ahead of the samples
+        xworkout = writer.Element("workout")
 
         if activity.Type in PWXIO._reverseSportTypeMappings:
             etree.SubElement(xworkout, "sportType").text = PWXIO._reverseSportTypeMappings[activity.Type]
@@ -260,37 +318,50 @@ class PWXIO:
             xsegment = etree.SubElement(xworkout, "segment")
             _writeSummaryData(xsegment, lap, time_ref=activity.StartTime)
 
-        for wp in activity.GetFlatWaypoints():
-            xsample = etree.SubElement(xworkout, "sample")
-            etree.SubElement(xsample, "timeoffset").text = str((wp.Timestamp - activity.StartTime).total_seconds())
-
-            if wp.HR is not None:
-                etree.SubElement(xsample, "hr").text = str(round(wp.HR))
-
-            if wp.Speed is not None:
-                etree.SubElement(xsample, "spd").text = str(wp.Speed)
+        for xchild in list(xworkout):
+            writer.Write(xchild)
+        writer.Discard(xworkout)
 
-            if wp.Power is not None:
-                etree.SubElement(xsample, "pwr").text = str(round(wp.Power))
-
-            if wp.Cadence is not None:
-                etree.SubElement(xsample, "cad").text = str(round(wp.Cadence))
-            else:
-                if wp.RunCadence is not None:
-                    etree.SubElement(xsample, "cad").text = str(round(wp.RunCadence))
-
-            if wp.Distance is not None:
-                etree.SubElement(xsample, "dist").text = str(wp.Distance)
-
-            if wp.Location is not None:
-                if wp.Location.Longitude is not None:
-                    etree.SubElement(xsample, "lat").text = str(wp.Location.Latitude)
-                    etree.SubElement(xsample, "lon").text = str(wp.Location.Longitude)
-                if wp.Location.Altitude is not None:
-                    etree.SubElement(xsample, "alt").text = str(wp.Location.Altitude)
-
-            if wp.Temp is not None:
-                etree.SubElement(xsample, "temp").text = str(wp.Temp)
-
-
-        return etree.tostring(xroot, pretty_print=True, xml_declaration=True, encoding="UTF-8").decode("UTF-8")
+        # Straight from each lap's columns - Latitude/Longitude/Altitude are None for points without a location
+        names = ("Timestamp", "HR", "Speed", "Power", "Cadence", "RunCadence", "Distance", "Latitude", "Longitude", "Altitude", "Temp")
+        for lap in activity.Laps:
+            chunk = writer.Chunk()
+            for timestamp, hr, speed, power, cadence, runCadence, distance, latitude, longitude, altitude, temp in zip(*[lap.Waypoints.Column(name) for name in names]):
+                xsample = etree.SubElement(chunk, "sample")
+                etree.SubElement(xsample, "timeoffset").text = str((timestamp - activity.StartTime).total_seconds())
+
+                if hr is not None:
+                    etree.SubElement(xsample, "hr").text = str(round(hr))
+
+                if speed is not None:
+                    etree.SubElement(xsample, "spd").text = str(speed)
+
+                if power is not None:
+                    etree.SubElement(xsample, "pwr").text = str(round(power))
+
+                if cadence is not None:
+                    etree.SubElement(xsample, "cad").text = str(round(cadence))
+                else:
+                    if runCadence is not None:
+                        etree.SubElement(xsample, "cad").text = str(round(runCadence))
+
+                if distance is not None:
+                    etree.SubElement(xsample, "dist").text = str(distance)
+
+                if longitude is not None:
+                    etree.SubElement(xsample, "lat").text = str(latitude)
+                    etree.SubElement(xsample, "lon").text = str(longitude)
+                if altitude is not None:
+                    etree.SubElement(xsample, "alt").text = str(altitude)
+
+                if temp is not None:
+                    etree.SubElement(xsample, "temp").text = str(temp)
+
+                if len(chunk) >= writer.ChunkSize:
+                    writer.WriteChunk(chunk)
+                    chunk = writer.Chunk()
+            writer.WriteChunk(chunk)
+
+        writer.Close()
+        if output is None:
+            return stream.getvalue().decode("UTF-8")
@@ -17,6 +17,13 @@ class RateLimit:
 				raise RateLimitExceededException()
 		rl_db.limits.update({"Key": key}, {"$inc": {"Count": 1}}, multi=True)
 
+	def Headroom(key):
+		# Fraction of the tightest limit that's still available (1 if there aren't any)
+		headroom = 1
+		for limit in rl_db.limits.find({"Key": key}, {"Max": 1, "Count": 1}):
+			headroom = min(headroom, max(0, limit["Max"] - limit["Count"]) / limit["Max"])
+		return headroom
+
 	def Refresh(key, limits):
 		# Limits is in format [(timespan, max-count),...]
 		# The windows are anchored at midnight
@@ -1,104 +1,112 @@
 from datetime import timedelta
 from .interchange import WaypointType
+import math
 
 class ActivityStatisticCalculator:
     ImplicitPauseTime = timedelta(minutes=1, seconds=5)
 
+    def _waypointRange(act, names, startWpt=None, endWpt=None):
+        # Works out the flat index range to calculate over, along with the columns (of those named) it needs
+        # Each lap's waypoints occupy [offset, offset + len) of the flattened activity - we search within the laps rather than building the flat list of waypoints
+        columns = dict((name, []) for name in set(names) | set(["Timestamp"]))
+        lapRanges = []
+        for lap in act.Laps:
+            offset = len(columns["Timestamp"])
+            for name, column in columns.items():
+                column += lap.Waypoints.Column(name)
+            lapRanges.append((lap, offset, len(columns["Timestamp"])))
+
+        def _indexOf(wpt):
+            for lap, offset, end in lapRanges:
+                # Only bother with a full comparison when the timestamps match up
+                for idx, timestamp in enumerate(columns["Timestamp"][offset:end]):
+                    if timestamp == wpt.Timestamp and lap.Waypoints[idx] == wpt:
+                        return offset + idx
+            raise ValueError("Waypoint is not in the activity")
+
+        if not columns["Timestamp"]:
+            raise IndexError("No waypoints")
+        start = _indexOf(startWpt) if startWpt else 0
+        end = _indexOf(endWpt) if endWpt else len(columns["Timestamp"]) - 1
+        return columns, start, end
+
     def CalculateDistance(act, startWpt=None, endWpt=None):
-        import math
+        columns, start, end = ActivityStatisticCalculator._waypointRange(act, ["Type", "Latitude", "Longitude", "Altitude"], startWpt, endWpt)
+        implicitPauseTime = ActivityStatisticCalculator.ImplicitPauseTime
+
         dist = 0
         altHold = None  # seperate from the lastLoc variable, since we want to hold the altitude as long as required
-        lastTimestamp = lastLoc = None
-
-        flatWaypoints = act.GetFlatWaypoints()
-
-        if not startWpt:
-            startWpt = flatWaypoints[0]
-        if not endWpt:
-            endWpt = flatWaypoints[-1]
-
-        for x in range(flatWaypoints.index(startWpt), flatWaypoints.index(endWpt) + 1):
-            timeDelta = flatWaypoints[x].Timestamp - lastTimestamp if lastTimestamp else None
-            lastTimestamp = flatWaypoints[x].Timestamp
+        lastLat = lastLng = lastAlt = None
+        lastTimestamp = None
 
-            if flatWaypoints[x].Type == WaypointType.Pause or (timeDelta and timeDelta > ActivityStatisticCalculator.ImplicitPauseTime):
-                lastLoc = None  # don't count distance while paused
+        for x in range(start, end + 1):
+            timestamp = columns["Timestamp"][x]
+            # Doesn't count while paused (explicitly, or implicitly by a long enough gap)
+            timeDelta = timestamp - lastTimestamp if lastTimestamp else None
+            lastTimestamp = timestamp
+            if columns["Type"][x] == WaypointType.Pause or (timeDelta and timeDelta > implicitPauseTime):
+                lastLat = None
                 continue
-
-            loc = flatWaypoints[x].Location
-            if loc is None or loc.Longitude is None or loc.Latitude is None:
-                # Used to throw an exception in this case, but the TCX schema allows for location-free waypoints, so we'll just patch over it.
+            lat = columns["Latitude"][x]
+            lng = columns["Longitude"][x]
+            # The TCX schema allows for location-free waypoints, so we'll just patch over them.
+            if lat is None or lng is None:
                 continue
-
-            if loc and lastLoc:
-                altHold = lastLoc.Altitude if lastLoc.Altitude is not None else altHold
-                latRads = loc.Latitude * math.pi / 180
+            alt = columns["Altitude"][x]
+            if lastLat is not None:
+                altHold = lastAlt if lastAlt is not None else altHold
+                latRads = lat * math.pi / 180
                 meters_lat_degree = 1000 * 111.13292 + 1.175 * math.cos(4 * latRads) - 559.82 * math.cos(2 * latRads)
                 meters_lon_degree = 1000 * 111.41284 * math.cos(latRads) - 93.5 * math.cos(3 * latRads)
-                dx = (loc.Longitude - lastLoc.Longitude) * meters_lon_degree
-                dy = (loc.Latitude - lastLoc.Latitude) * meters_lat_degree
-                if loc.Altitude is not None and altHold is not None:  # incorporate the altitude when possible
-                    dz = loc.Altitude - altHold
+                dx = (lng - lastLng) * meters_lon_degree
+                dy = (lat - lastLat) * meters_lat_degree
+                if alt is not None and altHold is not None:  # incorporate the altitude when possible
+                    dz = alt - altHold
                 else:
                     dz = 0
                 dist += math.sqrt(dx ** 2 + dy ** 2 + dz ** 2)
-            lastLoc = loc
-
+            lastLat, lastLng, lastAlt = lat, lng, alt
         return dist
 
     def CalculateTimerTime(act, startWpt=None, endWpt=None):
-        flatWaypoints = []
-        for lap in act.Laps:
-            flatWaypoints.append(lap.Waypoints)
-
-        if len(flatWaypoints) < 3:
+        if act.CountTotalWaypoints() < 3:
             # Either no waypoints, or one at the start and one at the end
             raise ValueError("Not enough waypoints to calculate timer time")
+        columns, start, end = ActivityStatisticCalculator._waypointRange(act, ["Type"], startWpt, endWpt)
+        implicitPauseTime = ActivityStatisticCalculator.ImplicitPauseTime
+
         duration = timedelta(0)
-        if not startWpt:
-            startWpt = flatWaypoints[0]
-        if not endWpt:
-            endWpt = flatWaypoints[-1]
         lastTimestamp = None
-        for x in range(flatWaypoints.index(startWpt), flatWaypoints.index(endWpt) + 1):
-            wpt = flatWaypoints[x]
-            delta = wpt.Timestamp - lastTimestamp if lastTimestamp else None
-            lastTimestamp = wpt.Timestamp
-            if wpt.Type is WaypointType.Pause:
+        for x in range(start, end + 1):
+            timestamp = columns["Timestamp"][x]
+            # The clock restarts with the first waypoint after a pause
+            delta = timestamp - lastTimestamp if lastTimestamp else None
+            lastTimestamp = timestamp
+            if columns["Type"][x] == WaypointType.Pause:
                 lastTimestamp = None
-            elif delta and delta > act.ImplicitPauseTime:
+            elif delta and delta > implicitPauseTime:
                 delta = None  # Implicit pauses
             if delta:
                 duration += delta
+
         if duration.total_seconds() == 0 and startWpt is None and endWpt is None:
             raise ValueError("Zero-duration activity")
         return duration
 
     def CalculateAverageMaxHR(act, startWpt=None, endWpt=None):
-        flatWaypoints = act.GetFlatWaypoints()
+        columns, start, end = ActivityStatisticCalculator._waypointRange(act, ["HR"], startWpt, endWpt)
 
         # Python can handle 600+ digit numbers, think it can handle this
         maxHR = 0
         cumulHR = 0
         samples = 0
-
-        if not startWpt:
-            startWpt = flatWaypoints[0]
-        if not endWpt:
-            endWpt = flatWaypoints[-1]
-
-        for x in range(flatWaypoints.index(startWpt), flatWaypoints.index(endWpt) + 1):
-            wpt = flatWaypoints[x]
-            if wpt.HR:
-                if wpt.HR > maxHR:
-                    maxHR = wpt.HR
-                cumulHR += wpt.HR
+        for hr in columns["HR"][start:end + 1]:
+            if hr:
+                if hr > maxHR:
+                    maxHR = hr
+                cumulHR += hr
                 samples += 1
 
         if not samples:
             return None, None
-
-        cumulHR = cumulHR / samples
-        return cumulHR, maxHR
-
-
+        return cumulHR / samples, maxHR
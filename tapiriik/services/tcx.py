@@ -1,10 +1,12 @@
 from lxml import etree
 from pytz import UTC
 import copy
-import dateutil.parser
+import io
 from datetime import timedelta
 from .interchange import WaypointType, Activity, ActivityStatistic, ActivityStatistics, ActivityStatisticUnit, ActivityType, Waypoint, Location, Lap, LapIntensity, LapTriggerMethod
 from .devices import DeviceIdentifier, DeviceIdentifierType, Device
+from .xmlwriter import StreamingXMLWriter
+from .timestamp_parser import TimestampParser
 
 
 class TCXIO:
@@ -17,199 +19,254 @@ class TCXIO:
         "xsi": "http://www.w3.org/2001/XMLSchema-instance"
     }
 
-    def Parse(tcxData, act=None):
+    # The decoder matches elements by their fully-qualified tags, rather than resolving namespace prefixes for every lookup
+    def _qualifyTags(namespace, *names):
+        return {name: "{%s}%s" % (namespace, name) for name in names}
+    _tags = _qualifyTags(Namespaces[None], "Activities", "Activity", "Lap", "Track", "Trackpoint", "Time", "Position", "LatitudeDegrees", "LongitudeDegrees",
+        "AltitudeMeters", "DistanceMeters", "HeartRateBpm", "Value", "Cadence", "Extensions")
+    _tpxTags = _qualifyTags(Namespaces["tpx"], "TPX", "Watts", "Speed", "RunCadence")
+
+    def _parseLap(xlap, lap, ns):
+        lap.StartTime = TimestampParser.Parse(xlap.attrib["StartTime"])
+        totalTimeEL = xlap.find("tcx:TotalTimeSeconds", namespaces=ns)
+        if totalTimeEL is None:
+            raise ValueError("Missing lap TotalTimeSeconds")
+        lap.Stats.TimerTime = ActivityStatistic(ActivityStatisticUnit.Seconds, float(totalTimeEL.text))
+
+        lap.EndTime = lap.StartTime + timedelta(seconds=float(totalTimeEL.text))
+
+        distEl = xlap.find("tcx:DistanceMeters", namespaces=ns)
+        energyEl = xlap.find("tcx:Calories", namespaces=ns)
+        triggerEl = xlap.find("tcx:TriggerMethod", namespaces=ns)
+        intensityEl = xlap.find("tcx:Intensity", namespaces=ns)
+
+        # Some applications slack off and omit these, despite the fact that they're required in the spec.
+        # I will, however, require lap distance, because, seriously.
+        if distEl is None:
+            raise ValueError("Missing lap DistanceMeters")
+
+        lap.Stats.Distance = ActivityStatistic(ActivityStatisticUnit.Meters, float(distEl.text))
+        if energyEl is not None and energyEl.text:
+            lap.Stats.Energy = ActivityStatistic(ActivityStatisticUnit.Kilocalories, float(energyEl.text))
+            if lap.Stats.Energy.Value == 0:
+                lap.Stats.Energy.Value = None # It's dumb to make this required, but I digress.
+
+        if intensityEl is not None:
+            lap.Intensity = LapIntensity.Active if intensityEl.text == "Active" else LapIntensity.Rest
+        else:
+            lap.Intensity = LapIntensity.Active
+
+        if triggerEl is not None:
+            lap.Trigger = ({
+                "Manual": LapTriggerMethod.Manual,
+                "Distance": LapTriggerMethod.Distance,
+                "Location": LapTriggerMethod.PositionMarked,
+                "Time": LapTriggerMethod.Time,
+                "HeartRate": LapTriggerMethod.Manual # I guess - no equivalent in FIT
+                })[triggerEl.text]
+        else:
+            lap.Trigger = LapTriggerMethod.Manual # One would presume
+
+        maxSpdEl = xlap.find("tcx:MaximumSpeed", namespaces=ns)
+        if maxSpdEl is not None:
+            lap.Stats.Speed = ActivityStatistic(ActivityStatisticUnit.MetersPerSecond, max=float(maxSpdEl.text))
+
+        avgHREl = xlap.find("tcx:AverageHeartRateBpm", namespaces=ns)
+        if avgHREl is not None:
+            lap.Stats.HR = ActivityStatistic(ActivityStatisticUnit.BeatsPerMinute, avg=float(avgHREl.find("tcx:Value", namespaces=ns).text))
+
+        maxHREl = xlap.find("tcx:MaximumHeartRateBpm", namespaces=ns)
+        if maxHREl is not None:
+            lap.Stats.HR.update(ActivityStatistic(ActivityStatisticUnit.BeatsPerMinute, max=float(maxHREl.find("tcx:Value", namespaces=ns).text)))
+
+        # WF fills these in with invalid values.
+        lap.Stats.HR.Max = lap.Stats.HR.Max if lap.Stats.HR.Max and lap.Stats.HR.Max > 10 else None
+        lap.Stats.HR.Average = lap.Stats.HR.Average if lap.Stats.HR.Average and lap.Stats.HR.Average > 10 else None
+
+        cadEl = xlap.find("tcx:Cadence", namespaces=ns)
+        if cadEl is not None:
+            lap.Stats.Cadence = ActivityStatistic(ActivityStatisticUnit.RevolutionsPerMinute, avg=float(cadEl.text))
+
+        extsEl = xlap.find("tcx:Extensions", namespaces=ns)
+        if extsEl is not None:
+            lxEls = extsEl.findall("tpx:LX", namespaces=ns)
+            for lxEl in lxEls:
+                avgSpeedEl = lxEl.find("tpx:AvgSpeed", namespaces=ns)
+                if avgSpeedEl is not None:
+                    lap.Stats.Speed.update(ActivityStatistic(ActivityStatisticUnit.MetersPerSecond, avg=float(avgSpeedEl.text)))
+                maxBikeCadEl = lxEl.find("tpx:MaxBikeCadence", namespaces=ns)
+                if maxBikeCadEl is not None:
+                    lap.Stats.Cadence.update(ActivityStatistic(ActivityStatisticUnit.RevolutionsPerMinute, max=float(maxBikeCadEl.text)))
+                maxPowerEl = lxEl.find("tpx:MaxWatts", namespaces=ns)
+                if maxPowerEl is not None:
+                    lap.Stats.Power.update(ActivityStatistic(ActivityStatisticUnit.Watts, max=float(maxPowerEl.text)))
+                avgPowerEl = lxEl.find("tpx:AvgWatts", namespaces=ns)
+                if avgPowerEl is not None:
+                    lap.Stats.Power.update(ActivityStatistic(ActivityStatisticUnit.Watts, avg=float(avgPowerEl.text)))
+                maxRunCadEl = lxEl.find("tpx:MaxRunCadence", namespaces=ns)
+                if maxRunCadEl is not None:
+                    lap.Stats.RunCadence.update(ActivityStatistic(ActivityStatisticUnit.StepsPerMinute, max=float(maxRunCadEl.text)))
+                avgRunCadEl = lxEl.find("tpx:AvgRunCadence", namespaces=ns)
+                if avgRunCadEl is not None:
+                    lap.Stats.RunCadence.update(ActivityStatistic(ActivityStatisticUnit.StepsPerMinute, avg=float(avgRunCadEl.text)))
+                stepsEl = lxEl.find("tpx:Steps", namespaces=ns)
+                if stepsEl is not None:
+                    lap.Stats.Strides.update(ActivityStatistic(ActivityStatisticUnit.Strides, value=float(stepsEl.text)))
+
+    def _parseTrackpoint(xtrkpt):
+        tags = TCXIO._tags
+        tpxTags = TCXIO._tpxTags
+        wp = Waypoint()
+        tsEl = xtrkpt.find(tags["Time"])
+        if tsEl is None:
+            raise ValueError("Trackpoint without timestamp")
+        wp.Timestamp = TimestampParser.Parse(tsEl.text)
+        xpos = xtrkpt.find(tags["Position"])
+        if xpos is not None:
+            wp.Location = Location(float(xpos.find(tags["LatitudeDegrees"]).text), float(xpos.find(tags["LongitudeDegrees"]).text), None)
+        eleEl = xtrkpt.find(tags["AltitudeMeters"])
+        if eleEl is not None:
+            wp.Location = wp.Location if wp.Location else Location(None, None, None)
+            wp.Location.Altitude = float(eleEl.text)
+        distEl = xtrkpt.find(tags["DistanceMeters"])
+        if distEl is not None:
+            wp.Distance = float(distEl.text)
+
+        hrEl = xtrkpt.find(tags["HeartRateBpm"])
+        if hrEl is not None:
+            wp.HR = float(hrEl.find(tags["Value"]).text)
+        cadEl = xtrkpt.find(tags["Cadence"])
+        if cadEl is not None:
+            wp.Cadence = float(cadEl.text)
+        extsEl = xtrkpt.find(tags["Extensions"])
+        if extsEl is not None:
+            tpxEl = extsEl.find(tpxTags["TPX"])
+            if tpxEl is not None:
+                powerEl = tpxEl.find(tpxTags["Watts"])
+                if powerEl is not None:
+                    wp.Power = float(powerEl.text)
+                speedEl = tpxEl.find(tpxTags["Speed"])
+                if speedEl is not None:
+                    wp.Speed = float(speedEl.text)
+                runCadEl = tpxEl.find(tpxTags["RunCadence"])
+                if runCadEl is not None:
+                    wp.RunCadence = float(runCadEl.text)
+        return wp, xpos is not None
+
+    def Parse(tcxData, act=None, metadata_only=False):
+        """ With metadata_only, the laps are read but each only holds the waypoints needed to place the activity - the first one with a position, and the last one
+            That's enough for the start and end times, UID and TZ, without the cost of decoding every trackpoint
+        """
         ns = copy.deepcopy(TCXIO.Namespaces)
         ns["tcx"] = ns[None]
         del ns[None]
+        tags = TCXIO._tags
 
         act = act if act else Activity()
 
         act.GPS = False
 
-        try:
-            root = etree.XML(tcxData)
-        except:
-            root = etree.fromstring(tcxData)
-
+        if isinstance(tcxData, str):
+            tcxData = tcxData.encode("UTF-8")
+        if isinstance(tcxData, (bytes, bytearray)):
+            tcxData = io.BytesIO(tcxData)
+
+        # We only want the first activity in the file, and only the first track in each of its laps - the same as the find()s we used to do
+        # Everything's read as the parser reaches the end of it, and thrown away once we're done with it
+        xacts = None
+        xact = None
+        xlap = None
+        xtrkseg = None
+        lap = None
+        lapLocated = False
+        lastTrkpt = None
+        for event, el in etree.iterparse(tcxData, events=("start", "end"), tag=(tags["Activities"], tags["Activity"], tags["Lap"], tags["Track"], tags["Trackpoint"])):
+            tag = el.tag
+            if event == "start":
+                if tag == tags["Activities"]:
+                    if xacts is None and el.getparent() is not None and el.getparent().getparent() is None:
+                        xacts = el
+                elif tag == tags["Activity"]:
+                    if xact is None and xacts is not None and el.getparent() is xacts:
+                        xact = el
+                        if not act.Type or act.Type == ActivityType.Other:
+                            if xact.attrib["Sport"] == "Biking":
+                                act.Type = ActivityType.Cycling
+                            elif xact.attrib["Sport"] == "Running":
+                                act.Type = ActivityType.Running
+                elif tag == tags["Lap"]:
+                    if xact is not None and el.getparent() is xact:
+                        xlap = el
+                        xtrkseg = None
+                        lap = Lap()
+                        act.Laps.append(lap)
+                        lapLocated = False
+                        lastTrkpt = None
+                elif tag == tags["Track"]:
+                    if xlap is not None and xtrkseg is None and el.getparent() is xlap:
+                        xtrkseg = el
+            elif tag == tags["Trackpoint"]:
+                if xtrkseg is not None and el.getparent() is xtrkseg and metadata_only:
+                    # The last trackpoint is held on to (uncleared) in case it turns out to be the end of the lap
+                    if not lapLocated and el.find(tags["Position"]) is not None:
+                        lap.Waypoints.append(TCXIO._parseTrackpoint(el)[0])
+                        act.GPS = lapLocated = True
+                        lastTrkpt = None
+                    else:
+                        lastTrkpt = el
+                    while el.getprevious() is not None:
+                        del xtrkseg[0]
+                elif xtrkseg is not None and el.getparent() is xtrkseg:
+                    wp, hasPosition = TCXIO._parseTrackpoint(el)
+                    if hasPosition:
+                        act.GPS = True
+                    lap.Waypoints.append(wp)
+                    # Done with this trackpoint, and everything before it
+                    el.clear()
+                    while el.getprevious() is not None:
+                        del xtrkseg[0]
+            elif tag == tags["Lap"]:
+                if el is xlap:
+                    if lastTrkpt is not None:
+                        lap.Waypoints.append(TCXIO._parseTrackpoint(lastTrkpt)[0])
+                        lastTrkpt = None
+                    TCXIO._parseLap(xlap, lap, ns)
+                    if xtrkseg is not None and len(lap.Waypoints):
+                        lap.EndTime = lap.Waypoints[-1].Timestamp
+                    xlap = None
+                    el.clear()
+                    while el.getprevious() is not None:
+                        del xact[0]
+            elif tag == tags["Activity"]:
+                if el is xact:
+                    xnotes = xact.find("tcx:Notes", namespaces=ns)
+                    if xnotes is not None and xnotes.text:
+                        xnotes_lines = xnotes.text.splitlines()
+                        act.Name = xnotes_lines[0]
+                        if len(xnotes_lines) > 1:
+                            act.Notes = '\n'.join(xnotes_lines[1:])
+
+                    xcreator = xact.find("tcx:Creator", namespaces=ns)
+                    if xcreator is not None and xcreator.attrib["{" + TCXIO.Namespaces["xsi"] + "}type"] == "Device_t":
+                        devId = DeviceIdentifier.FindMatchingIdentifierOfType(DeviceIdentifierType.TCX, {"ProductID": int(xcreator.find("tcx:ProductID", namespaces=ns).text)}) # Who knows if this is unique in the TCX ecosystem? We'll find out!
+                        xver = xcreator.find("tcx:Version", namespaces=ns)
+                        verMaj = None
+                        verMin = None
+                        if xver is not None:
+                            verMaj = int(xver.find("tcx:VersionMajor", namespaces=ns).text)
+                            verMin = int(xver.find("tcx:VersionMinor", namespaces=ns).text)
+                        act.Device = Device(devId, int(xcreator.find("tcx:UnitId", namespaces=ns).text), verMaj=verMaj, verMin=verMin) # ID vs Id: ???
+                    if metadata_only:
+                        break # There's nothing else we need in the file
+                el.clear()
+            # Anything else (the second activity onwards, and so on) is left be until it's cleared along with its parent
 
-        xacts = root.find("tcx:Activities", namespaces=ns)
         if xacts is None:
             raise ValueError("No activities element in TCX")
 
-        xact = xacts.find("tcx:Activity", namespaces=ns)
         if xact is None:
             raise ValueError("No activity element in TCX")
 
-        if not act.Type or act.Type == ActivityType.Other:
-            if xact.attrib["Sport"] == "Biking":
-                act.Type = ActivityType.Cycling
-            elif xact.attrib["Sport"] == "Running":
-                act.Type = ActivityType.Running
-
-        xnotes = xact.find("tcx:Notes", namespaces=ns)
-        if xnotes is not None and xnotes.text:
-            xnotes_lines = xnotes.text.splitlines()
-            act.Name = xnotes_lines[0]
-            if len(xnotes_lines) > 1:
-                act.Notes = '\n'.join(xnotes_lines[1:])
-
-        xcreator = xact.find("tcx:Creator", namespaces=ns)
-        if xcreator is not None and xcreator.attrib["{" + TCXIO.Namespaces["xsi"] + "}type"] == "Device_t":
-            devId = DeviceIdentifier.FindMatchingIdentifierOfType(DeviceIdentifierType.TCX, {"ProductID": int(xcreator.find("tcx:ProductID", namespaces=ns).text)}) # Who knows if this is unique in the TCX ecosystem? We'll find out!
-            xver = xcreator.find("tcx:Version", namespaces=ns)
-            verMaj = None
-            verMin = None
-            if xver is not None:
-                verMaj = int(xver.find("tcx:VersionMajor", namespaces=ns).text)
-                verMin = int(xver.find("tcx:VersionMinor", namespaces=ns).text)
-            act.Device = Device(devId, int(xcreator.find("tcx:UnitId", namespaces=ns).text), verMaj=verMaj, verMin=verMin) # ID vs Id: ???
-
-        xlaps = xact.findall("tcx:Lap", namespaces=ns)
-        startTime = None
-        endTime = None
-        for xlap in xlaps:
-
-            lap = Lap()
-            act.Laps.append(lap)
-
-            lap.StartTime = dateutil.parser.parse(xlap.attrib["StartTime"])
-            totalTimeEL = xlap.find("tcx:TotalTimeSeconds", namespaces=ns)
-            if totalTimeEL is None:
-                raise ValueError("Missing lap TotalTimeSeconds")
-            lap.Stats.TimerTime = ActivityStatistic(ActivityStatisticUnit.Seconds, float(totalTimeEL.text))
-
-            lap.EndTime = lap.StartTime + timedelta(seconds=float(totalTimeEL.text))
-
-            distEl = xlap.find("tcx:DistanceMeters", namespaces=ns)
-            energyEl = xlap.find("tcx:Calories", namespaces=ns)
-            triggerEl = xlap.find("tcx:TriggerMethod", namespaces=ns)
-            intensityEl = xlap.find("tcx:Intensity", namespaces=ns)
-
-            # Some applications slack off and omit these, despite the fact that they're required in the spec.
-            # I will, however, require lap distance, because, seriously.
-            if distEl is None:
-                raise ValueError("Missing lap DistanceMeters")
-
-            lap.Stats.Distance = ActivityStatistic(ActivityStatisticUnit.Meters, float(distEl.text))
-            if energyEl is not None and energyEl.text:
-                lap.Stats.Energy = ActivityStatistic(ActivityStatisticUnit.Kilocalories, float(energyEl.text))
-                if lap.Stats.Energy.Value == 0:
-                    lap.Stats.Energy.Value = None # It's dumb to make this required, but I digress.
-
-            if intensityEl is not None:
-                lap.Intensity = LapIntensity.Active if intensityEl.text == "Active" else LapIntensity.Rest
-            else:
-                lap.Intensity = LapIntensity.Active
-
-            if triggerEl is not None:
-                lap.Trigger = ({
-                    "Manual": LapTriggerMethod.Manual,
-                    "Distance": LapTriggerMethod.Distance,
-                    "Location": LapTriggerMethod.PositionMarked,
-                    "Time": LapTriggerMethod.Time,
-                    "HeartRate": LapTriggerMethod.Manual # I guess - no equivalent in FIT
-                    })[triggerEl.text]
-            else:
-                lap.Trigger = LapTriggerMethod.Manual # One would presume
-
-            maxSpdEl = xlap.find("tcx:MaximumSpeed", namespaces=ns)
-            if maxSpdEl is not None:
-                lap.Stats.Speed = ActivityStatistic(ActivityStatisticUnit.MetersPerSecond, max=float(maxSpdEl.text))
-
-            avgHREl = xlap.find("tcx:AverageHeartRateBpm", namespaces=ns)
-            if avgHREl is not None:
-                lap.Stats.HR = ActivityStatistic(ActivityStatisticUnit.BeatsPerMinute, avg=float(avgHREl.find("tcx:Value", namespaces=ns).text))
-
-            maxHREl = xlap.find("tcx:MaximumHeartRateBpm", namespaces=ns)
-            if maxHREl is not None:
-                lap.Stats.HR.update(ActivityStatistic(ActivityStatisticUnit.BeatsPerMinute, max=float(maxHREl.find("tcx:Value", namespaces=ns).text)))
-
-            # WF fills these in with invalid values.
-            lap.Stats.HR.Max = lap.Stats.HR.Max if lap.Stats.HR.Max and lap.Stats.HR.Max > 10 else None
-            lap.Stats.HR.Average = lap.Stats.HR.Average if lap.Stats.HR.Average and lap.Stats.HR.Average > 10 else None
-
-            cadEl = xlap.find("tcx:Cadence", namespaces=ns)
-            if cadEl is not None:
-                lap.Stats.Cadence = ActivityStatistic(ActivityStatisticUnit.RevolutionsPerMinute, avg=float(cadEl.text))
-
-            extsEl = xlap.find("tcx:Extensions", namespaces=ns)
-            if extsEl is not None:
-                lxEls = extsEl.findall("tpx:LX", namespaces=ns)
-                for lxEl in lxEls:
-                    avgSpeedEl = lxEl.find("tpx:AvgSpeed", namespaces=ns)
-                    if avgSpeedEl is not None:
-                        lap.Stats.Speed.update(ActivityStatistic(ActivityStatisticUnit.MetersPerSecond, avg=float(avgSpeedEl.text)))
-                    maxBikeCadEl = lxEl.find("tpx:MaxBikeCadence", namespaces=ns)
-                    if maxBikeCadEl is not None:
-                        lap.Stats.Cadence.update(ActivityStatistic(ActivityStatisticUnit.RevolutionsPerMinute, max=float(maxBikeCadEl.text)))
-                    maxPowerEl = lxEl.find("tpx:MaxWatts", namespaces=ns)
-                    if maxPowerEl is not None:
-                        lap.Stats.Power.update(ActivityStatistic(ActivityStatisticUnit.Watts, max=float(maxPowerEl.text)))
-                    avgPowerEl = lxEl.find("tpx:AvgWatts", namespaces=ns)
-                    if avgPowerEl is not None:
-                        lap.Stats.Power.update(ActivityStatistic(ActivityStatisticUnit.Watts, avg=float(avgPowerEl.text)))
-                    maxRunCadEl = lxEl.find("tpx:MaxRunCadence", namespaces=ns)
-                    if maxRunCadEl is not None:
-                        lap.Stats.RunCadence.update(ActivityStatistic(ActivityStatisticUnit.StepsPerMinute, max=float(maxRunCadEl.text)))
-                    avgRunCadEl = lxEl.find("tpx:AvgRunCadence", namespaces=ns)
-                    if avgRunCadEl is not None:
-                        lap.Stats.RunCadence.update(ActivityStatistic(ActivityStatisticUnit.StepsPerMinute, avg=float(avgRunCadEl.text)))
-                    stepsEl = lxEl.find("tpx:Steps", namespaces=ns)
-                    if stepsEl is not None:
-                        lap.Stats.Strides.update(ActivityStatistic(ActivityStatisticUnit.Strides, value=float(stepsEl.text)))
-
-            xtrkseg = xlap.find("tcx:Track", namespaces=ns)
-            if xtrkseg is None:
-                # Some TCX files have laps with no track - not sure if it's valid or not.
-                continue
-            for xtrkpt in xtrkseg.findall("tcx:Trackpoint", namespaces=ns):
-                wp = Waypoint()
-                tsEl = xtrkpt.find("tcx:Time", namespaces=ns)
-                if tsEl is None:
-                    raise ValueError("Trackpoint without timestamp")
-                wp.Timestamp = dateutil.parser.parse(tsEl.text)
-                wp.Timestamp.replace(tzinfo=UTC)
-                if startTime is None or wp.Timestamp < startTime:
-                    startTime = wp.Timestamp
-                if endTime is None or wp.Timestamp > endTime:
-                    endTime = wp.Timestamp
-                xpos = xtrkpt.find("tcx:Position", namespaces=ns)
-                if xpos is not None:
-                    act.GPS = True
-                    wp.Location = Location(float(xpos.find("tcx:LatitudeDegrees", namespaces=ns).text), float(xpos.find("tcx:LongitudeDegrees", namespaces=ns).text), None)
-                eleEl = xtrkpt.find("tcx:AltitudeMeters", namespaces=ns)
-                if eleEl is not None:
-                    wp.Location = wp.Location if wp.Location else Location(None, None, None)
-                    wp.Location.Altitude = float(eleEl.text)
-                distEl = xtrkpt.find("tcx:DistanceMeters", namespaces=ns)
-                if distEl is not None:
-                    wp.Distance = float(distEl.text)
-
-                hrEl = xtrkpt.find("tcx:HeartRateBpm", namespaces=ns)
-                if hrEl is not None:
-                    wp.HR = float(hrEl.find("tcx:Value", namespaces=ns).text)
-                cadEl = xtrkpt.find("tcx:Cadence", namespaces=ns)
-                if cadEl is not None:
-                    wp.Cadence = float(cadEl.text)
-                extsEl = xtrkpt.find("tcx:Extensions", namespaces=ns)
-                if extsEl is not None:
-                    tpxEl = extsEl.find("tpx:TPX", namespaces=ns)
-                    if tpxEl is not None:
-                        powerEl = tpxEl.find("tpx:Watts", namespaces=ns)
-                        if powerEl is not None:
-                            wp.Power = float(powerEl.text)
-                        speedEl = tpxEl.find("tpx:Speed", namespaces=ns)
-                        if speedEl is not None:
-                            wp.Speed = float(speedEl.text)
-                        runCadEl = tpxEl.find("tpx:RunCadence", namespaces=ns)
-                        if runCadEl is not None:
-                            wp.RunCadence = float(runCadEl.text)
-                lap.Waypoints.append(wp)
-                xtrkpt.clear()
-                del xtrkpt
-            if len(lap.Waypoints):
-                lap.EndTime = lap.Waypoints[-1].Timestamp
-
         act.StartTime = act.Laps[0].StartTime if len(act.Laps) else act.StartTime
         act.EndTime = act.Laps[-1].EndTime if len(act.Laps) else act.EndTime
 
@@ -232,24 +289,12 @@ class TCXIO:
         act.CalculateUID()
         return act
 
-    def Dump(activity):
-
-        root = etree.Element("TrainingCenterDatabase", nsmap=TCXIO.Namespaces)
-        activities = etree.SubElement(root, "Activities")
-        act = etree.SubElement(activities, "Activity")
-
-
-        author = etree.SubElement(root, "Author")
-        author.attrib["{" + TCXIO.Namespaces["xsi"] + "}type"] = "Application_t"
-        etree.SubElement(author, "Name").text = "tapiriik"
-        build = etree.SubElement(author, "Build")
-        version = etree.SubElement(build, "Version")
-        etree.SubElement(version, "VersionMajor").text = "0"
-        etree.SubElement(version, "VersionMinor").text = "0"
-        etree.SubElement(version, "BuildMajor").text = "0"
-        etree.SubElement(version, "BuildMinor").text = "0"
-        etree.SubElement(author, "LangID").text = "en"
-        etree.SubElement(author, "PartNumber").text = "000-00000-00"
+    def Dump(activity, output=None):
+        """ Writes the activity out as it goes - into output (as UTF-8) if given, otherwise it's returned as a string """
+        stream = output if output is not None else io.BytesIO()
+        writer = StreamingXMLWriter(stream, etree.Element("TrainingCenterDatabase", nsmap=TCXIO.Namespaces))
+        writer.Start(writer.Element("Activities"))
+        act = writer.Element("Activity")
 
         dateFormat = "%Y-%m-%dT%H:%M:%S.000Z"
 
@@ -259,8 +304,11 @@ class TCXIO:
             act.attrib["Sport"] = "Running"
         else:
             act.attrib["Sport"] = "Other"
+        writer.Start(act)
 
-        etree.SubElement(act, "Id").text = activity.StartTime.astimezone(UTC).strftime(dateFormat)
+        xid = writer.Element("Id")
+        xid.text = activity.StartTime.astimezone(UTC).strftime(dateFormat)
+        writer.Write(xid)
 
         def _writeStat(parent, elName, value, wrapValue=False, naturalValue=False, default=None):
                 if value is not None or default is not None:
@@ -270,12 +318,13 @@ class TCXIO:
                     value = value if value is not None else default
                     xstat.text = str(value) if not naturalValue else str(int(value))
 
-        xlaps = []
+        inPause = False
         for lap in activity.Laps:
-            xlap = etree.SubElement(act, "Lap")
-            xlaps.append(xlap)
-
+            # Each lap's written out in full before moving on to the next - its statistics (built up in a scratch element), then its track, then its extensions
+            xlap = writer.Element("Lap")
             xlap.attrib["StartTime"] = lap.StartTime.astimezone(UTC).strftime(dateFormat)
+            writer.Start(xlap)
+            xlap = writer.Element("Lap")
 
             _writeStat(xlap, "TotalTimeSeconds", lap.Stats.TimerTime.asUnits(ActivityStatisticUnit.Seconds).Value if lap.Stats.TimerTime.Value else None, default=(lap.EndTime - lap.StartTime).total_seconds())
             _writeStat(xlap, "DistanceMeters", lap.Stats.Distance.asUnits(ActivityStatisticUnit.Meters).Value)
@@ -300,9 +349,10 @@ class TCXIO:
                 LapTriggerMethod.FitnessEquipment: "Manual"
                 })[lap.Trigger]
 
+            lapExts = None
             if len([x for x in [lap.Stats.Cadence.Max, lap.Stats.RunCadence.Max, lap.Stats.RunCadence.Average, lap.Stats.Strides.Value, lap.Stats.Power.Max, lap.Stats.Power.Average, lap.Stats.Speed.Average] if x is not None]):
-                exts = etree.SubElement(xlap, "Extensions")
-                lapext = etree.SubElement(exts, "LX")
+                lapExts = writer.Element("Extensions")
+                lapext = etree.SubElement(lapExts, "LX")
                 lapext.attrib["xmlns"] = "http://www.garmin.com/xmlschemas/ActivityExtension/v2"
                 _writeStat(lapext, "MaxBikeCadence", lap.Stats.Cadence.Max, naturalValue=True)
                 # This dividing-by-two stuff is getting silly
@@ -313,66 +363,81 @@ class TCXIO:
                 _writeStat(lapext, "AvgWatts", lap.Stats.Power.asUnits(ActivityStatisticUnit.Watts).Average, naturalValue=True)
                 _writeStat(lapext, "AvgSpeed", lap.Stats.Speed.asUnits(ActivityStatisticUnit.MetersPerSecond).Average)
 
-        inPause = False
-        for lap in activity.Laps:
-            xlap = xlaps[activity.Laps.index(lap)]
-            track = None
-            for wp in lap.Waypoints:
-                if wp.Type == WaypointType.Pause:
+            for xstat in list(xlap):
+                writer.Write(xstat)
+            writer.Discard(xlap)
+
+            track = None # The chunk of trackpoints being built up, once there is a track
+            # Straight from the lap's columns - no need for a Waypoint (and Location) per point
+            # (Latitude/Longitude/Altitude come out as None for points without a location)
+            columns = [lap.Waypoints.Column(name) for name in ("Timestamp", "Type", "Latitude", "Longitude", "Altitude", "Distance", "HR", "Cadence", "Speed", "RunCadence", "Power")]
+            for timestamp, wpType, latitude, longitude, altitude, distance, hr, cadence, speed, runCadence, power in zip(*columns):
+                if wpType == WaypointType.Pause:
                     if inPause:
                         continue  # this used to be an exception, but I don't think that was merited
                     inPause = True
-                if inPause and wp.Type != WaypointType.Pause:
+                if inPause and wpType != WaypointType.Pause:
                     inPause = False
                 if track is None:  # Defer creating the track until there are points
-                    track = etree.SubElement(xlap, "Track") # TODO - pauses should create new tracks instead of new laps?
+                    writer.Start(writer.Element("Track")) # TODO - pauses should create new tracks instead of new laps?
+                    track = writer.Chunk()
                 trkpt = etree.SubElement(track, "Trackpoint")
-                if wp.Timestamp.tzinfo is None:
+                if timestamp.tzinfo is None:
                     raise ValueError("TCX export requires TZ info")
-                etree.SubElement(trkpt, "Time").text = wp.Timestamp.astimezone(UTC).strftime(dateFormat)
-                if wp.Location:
-                    if wp.Location.Latitude is not None and wp.Location.Longitude is not None:
-                        pos = etree.SubElement(trkpt, "Position")
-                        etree.SubElement(pos, "LatitudeDegrees").text = str(wp.Location.Latitude)
-                        etree.SubElement(pos, "LongitudeDegrees").text = str(wp.Location.Longitude)
-
-                    if wp.Location.Altitude is not None:
-                        etree.SubElement(trkpt, "AltitudeMeters").text = str(wp.Location.Altitude)
-
-                if wp.Distance is not None:
-                    etree.SubElement(trkpt, "DistanceMeters").text = str(wp.Distance)
-                if wp.HR is not None:
+                etree.SubElement(trkpt, "Time").text = timestamp.astimezone(UTC).strftime(dateFormat)
+                if latitude is not None and longitude is not None:
+                    pos = etree.SubElement(trkpt, "Position")
+                    etree.SubElement(pos, "LatitudeDegrees").text = str(latitude)
+                    etree.SubElement(pos, "LongitudeDegrees").text = str(longitude)
+
+                if altitude is not None:
+                    etree.SubElement(trkpt, "AltitudeMeters").text = str(altitude)
+
+                if distance is not None:
+                    etree.SubElement(trkpt, "DistanceMeters").text = str(distance)
+                if hr is not None:
                     xhr = etree.SubElement(trkpt, "HeartRateBpm")
                     xhr.attrib["{" + TCXIO.Namespaces["xsi"] + "}type"] = "HeartRateInBeatsPerMinute_t"
-                    etree.SubElement(xhr, "Value").text = str(int(wp.HR))
-                if wp.Cadence is not None:
-                    etree.SubElement(trkpt, "Cadence").text = str(int(wp.Cadence))
-                if wp.Power is not None or wp.RunCadence is not None or wp.Speed is not None:
+                    etree.SubElement(xhr, "Value").text = str(int(hr))
+                if cadence is not None:
+                    etree.SubElement(trkpt, "Cadence").text = str(int(cadence))
+                if power is not None or runCadence is not None or speed is not None:
                     exts = etree.SubElement(trkpt, "Extensions")
                     gpxtpxexts = etree.SubElement(exts, "TPX")
                     gpxtpxexts.attrib["xmlns"] = "http://www.garmin.com/xmlschemas/ActivityExtension/v2"
-                    if wp.Speed is not None:
-                        etree.SubElement(gpxtpxexts, "Speed").text = str(wp.Speed)
-                    if wp.RunCadence is not None:
-                        etree.SubElement(gpxtpxexts, "RunCadence").text = str(int(wp.RunCadence))
-                    if wp.Power is not None:
-                        etree.SubElement(gpxtpxexts, "Watts").text = str(int(wp.Power))
+                    if speed is not None:
+                        etree.SubElement(gpxtpxexts, "Speed").text = str(speed)
+                    if runCadence is not None:
+                        etree.SubElement(gpxtpxexts, "RunCadence").text = str(int(runCadence))
+                    if power is not None:
+                        etree.SubElement(gpxtpxexts, "Watts").text = str(int(power))
+                if len(track) >= writer.ChunkSize:
+                    writer.WriteChunk(track)
+                    track = writer.Chunk()
             if track is not None:
-                exts = xlap.find("Extensions")
-                if exts is not None:
-                    track.addnext(exts)
+                writer.WriteChunk(track)
+                writer.End()
+            if lapExts is not None:
+                writer.Write(lapExts)
+            writer.End()
 
+        xnotes = None
         if activity.Name is not None and activity.Notes is not None:
-            etree.SubElement(act, "Notes").text = '\n'.join((activity.Name, activity.Notes))
+            xnotes = writer.Element("Notes")
+            xnotes.text = '\n'.join((activity.Name, activity.Notes))
         elif activity.Name is not None:
-            etree.SubElement(act, "Notes").text = activity.Name
+            xnotes = writer.Element("Notes")
+            xnotes.text = activity.Name
         elif activity.Notes is not None:
-            etree.SubElement(act, "Notes").text = '\n' + activity.Notes
+            xnotes = writer.Element("Notes")
+            xnotes.text = '\n' + activity.Notes
+        if xnotes is not None:
+            writer.Write(xnotes)
 
         if activity.Device and activity.Device.Identifier:
             devId = DeviceIdentifier.FindEquivalentIdentifierOfType(DeviceIdentifierType.TCX, activity.Device.Identifier)
             if devId:
-                xcreator = etree.SubElement(act, "Creator")
+                xcreator = writer.Element("Creator")
                 xcreator.attrib["{" + TCXIO.Namespaces["xsi"] + "}type"] = "Device_t"
                 etree.SubElement(xcreator, "Name").text = devId.Name
                 etree.SubElement(xcreator, "UnitId").text = str(activity.Device.Serial) if activity.Device.Serial else "0"
@@ -382,6 +447,24 @@ class TCXIO:
                 etree.SubElement(xver, "VersionMinor").text = str(activity.Device.VersionMinor) if activity.Device.VersionMinor else "0"
                 etree.SubElement(xver, "BuildMajor").text = "0"
                 etree.SubElement(xver, "BuildMinor").text = "0"
+                writer.Write(xcreator)
+
+        writer.End() # Activity
+        writer.End() # Activities
 
+        author = writer.Element("Author")
+        author.attrib["{" + TCXIO.Namespaces["xsi"] + "}type"] = "Application_t"
+        etree.SubElement(author, "Name").text = "tapiriik"
+        build = etree.SubElement(author, "Build")
+        version = etree.SubElement(build, "Version")
+        etree.SubElement(version, "VersionMajor").text = "0"
+        etree.SubElement(version, "VersionMinor").text = "0"
+        etree.SubElement(version, "BuildMajor").text = "0"
+        etree.SubElement(version, "BuildMinor").text = "0"
+        etree.SubElement(author, "LangID").text = "en"
+        etree.SubElement(author, "PartNumber").text = "000-00000-00"
+        writer.Write(author)
 
-        return etree.tostring(root, pretty_print=True, xml_declaration=True, encoding="UTF-8").decode("UTF-8")
+        writer.Close()
+        if output is None:
+            return stream.getvalue().decode("UTF-8")
@@ -0,0 +1,90 @@
+from lxml import etree
+
+
+class StreamingXMLWriter:
+    """ Writes an XML document out a piece at a time, so the whole tree never needs to exist at once.
+        What comes out is byte-for-byte what etree.tostring(root, pretty_print=True, xml_declaration=True, encoding="UTF-8") of the equivalent tree would produce.
+    """
+    # How many elements to build up in a Chunk() before writing them out - enough that the per-serialization overhead vanishes, few enough that memory doesn't balloon
+    ChunkSize = 500
+    _ChunkTag = "chunk"
+
+    def __init__(self, output, root):
+        # root is the document element, with its namespaces and attributes but nothing inside it
+        self._output = output
+        self._root = root
+        self._stack = []
+        self._output.write(b"<?xml version='1.0' encoding='UTF-8'?>\n")
+        root.text = "-"
+        self._stack.append(self._tags(etree.tostring(root, encoding="UTF-8")))
+        root.text = None
+
+    def _tags(self, serialized):
+        # Given some text, an element comes out with separate start and end tags to keep (and attribute values can't contain a literal ">")
+        tagEnd = serialized.index(b">")
+        return [serialized[:tagEnd], serialized[tagEnd + 2:], False]
+
+    def _serializeChildren(self, chunk):
+        # Everything inside the chunk, as it'd appear in the full document
+        # The chunk's own start tag soaks up all the namespace declarations, so none of them end up on the elements inside it - no need to go looking for them
+        serialized = etree.tostring(chunk, encoding="UTF-8", with_tail=False)
+        self._root.remove(chunk)
+        return serialized[serialized.index(b">") + 1:serialized.rindex(b"</")]
+
+    def _beginChild(self):
+        parent = self._stack[-1]
+        if not parent[2]:
+            # Now we know the parent isn't empty
+            self._output.write(parent[0] + b">")
+            parent[2] = True
+        self._output.write(b"\n" + b"  " * len(self._stack))
+
+    def Element(self, tag, attrib=None):
+        """ A new element to fill in, then pass to Start() or Write() - it's created in the document's namespace context, so prefixes come out right """
+        return etree.SubElement(self._root, tag, attrib=attrib)
+
+    def Chunk(self):
+        """ Somewhere to build up a run of sibling elements (with etree.SubElement) for WriteChunk() to write out in one go """
+        return etree.SubElement(self._root, StreamingXMLWriter._ChunkTag)
+
+    def Start(self, element):
+        """ Opens an element whose contents will be written afterwards, until the matching End() """
+        self._beginChild()
+        element.text = "-"
+        chunk = self.Chunk()
+        chunk.append(element)
+        self._stack.append(self._tags(self._serializeChildren(chunk)))
+
+    def End(self):
+        start, end, hasChildren = self._stack.pop()
+        if hasChildren:
+            self._output.write(b"\n" + b"  " * len(self._stack) + end)
+        else:
+            self._output.write(start + b"/>")
+
+    def Write(self, element):
+        """ Writes out a complete element, and everything inside it """
+        chunk = self.Chunk()
+        chunk.append(element)
+        self.WriteChunk(chunk)
+
+    def WriteChunk(self, chunk):
+        """ Writes out all the elements in a Chunk() - one serialization for the lot, rather than one per element """
+        if not len(chunk):
+            self._root.remove(chunk)
+            return
+        self._beginChild()
+        etree.indent(chunk, space="  ", level=len(self._stack) - 1)
+        # _beginChild() took care of the whitespace before the first one, and there's none after the last
+        chunk.text = None
+        chunk[-1].tail = None
+        self._output.write(self._serializeChildren(chunk))
+
+    def Discard(self, element):
+        """ Throws away an element from Element() that was only used to build up others, without writing it """
+        self._root.remove(element)
+
+    def Close(self):
+        while self._stack:
+            self.End()
+        self._output.write(b"\n")
@@ -263,7 +263,27 @@ EMAIL_FILE_PATH = './sent_emails'
 
 WORKER_INDEX = int(os.environ.get("TAPIRIIK_WORKER_INDEX", 0))
 
+# Services with their own pool of sync workers - users are routed to the pool of whichever of these they have connected sees the most of their traffic, the rest go to the general queue
+# Don't list a service here without starting workers with TAPIRIIK_WORKER_AFFINITY set to its ID, or those users will never be synced
+SYNC_AFFINITY_SERVICES = []
+
+WORKER_AFFINITY = os.environ.get("TAPIRIIK_WORKER_AFFINITY", None)
+
+# Split each sync across separate worker pools - the regular workers list and dedupe, then hand activities off to the download pool, which hands them to the upload pool
+# Don't turn this on without starting workers with TAPIRIIK_WORKER_STAGE set to download and upload, or nothing will get synced
+SYNC_PIPELINE_STAGED = False
+
+WORKER_STAGE = os.environ.get("TAPIRIIK_WORKER_STAGE", None)
+
+# CPU available to each sync worker, as a percentage of one core (None for no limit)
+WORKER_CPU_LIMIT = int(os.environ["TAPIRIIK_WORKER_CPU_LIMIT"]) if "TAPIRIIK_WORKER_CPU_LIMIT" in os.environ else None
+
+# A delegated cgroup v2 directory (with the cpu controller enabled for its children) for the kernel to enforce WORKER_CPU_LIMIT in
+# Without one, workers throttle themselves
+WORKER_CGROUP = None
+
 # Used for distributing outgoing calls across multiple interfaces
+# May also be a dict of WORKER_AFFINITY -> addresses (None being the general pool), so each service's traffic stays on the interfaces provisioned for it
 
 HTTP_SOURCE_ADDR = "0.0.0.0"
 
@@ -1,8 +1,9 @@
 from tapiriik.database import db, cachedb, redis
 from tapiriik.messagequeue import mq
 from tapiriik.services import Service, ServiceRecord, APIExcludeActivity, ServiceException, ServiceExceptionScope, ServiceWarning, UserException, UserExceptionType
-from tapiriik.settings import USER_SYNC_LOGS, DISABLED_SERVICES, WITHDRAWN_SERVICES
+from tapiriik.settings import USER_SYNC_LOGS, DISABLED_SERVICES, WITHDRAWN_SERVICES, SYNC_AFFINITY_SERVICES, WORKER_AFFINITY, SYNC_PIPELINE_STAGED, WORKER_STAGE
 from .activity_record import ActivityRecord, ActivityServicePrescence
+from bson.objectid import ObjectId
 from datetime import datetime, timedelta
 import sys
 import os
@@ -16,9 +17,12 @@ import logging
 import logging.handlers
 import pymongo
 import pytz
+import pickle
+import zlib
 import kombu
 import json
 import bisect
+import threading
 
 # Set this up separate from the logger used in this scope, so services logging messages are caught and logged into user's files.
 _global_logger = logging.getLogger("tapiriik")
@@ -83,23 +87,137 @@ def _unpackUserException(raw):
         return None
     return UserException(raw["Type"], extra=raw["Extra"], intervention_required=raw["InterventionRequired"], clear_group=raw["ClearGroup"])
 
+def _packActivities(*activities):
+    # For handing activities between pipeline stages - compressed, since full activities can get very large.
+    # ServiceRecords don't survive pickling (nor should they, they'd drag credentials along), so the source connection is swapped out for its ID on the way through.
+    source_connections = []
+    for activity in activities:
+        source_connections.append(activity.__dict__.pop("SourceConnection", None))
+    try:
+        return zlib.compress(pickle.dumps((activities, [x._id if x else None for x in source_connections]), pickle.HIGHEST_PROTOCOL))
+    finally:
+        for activity, source_connection in zip(activities, source_connections):
+            if source_connection:
+                activity.SourceConnection = source_connection
+
+def _unpackActivities(packed, serviceConnections):
+    activities, source_connection_ids = pickle.loads(zlib.decompress(packed))
+    for activity, source_connection_id in zip(activities, source_connection_ids):
+        if source_connection_id:
+            activity.SourceConnection = [x for x in serviceConnections if x._id == source_connection_id][0]
+    return activities
+
 class Sync:
 
     SyncInterval = timedelta(hours=1)
     SyncIntervalJitter = timedelta(minutes=5)
     MinimumSyncInterval = timedelta(seconds=30)
+    MaximumSyncInterval = timedelta(hours=24)
+    SyncSlotLength = timedelta(minutes=1)
+    TriggeredSyncInterval = timedelta(hours=6) # When every source will tell us about new activities, polling is just a backstop
+    IdleSyncIntervalRatio = 14 # i.e. an account that's been idle for 2 weeks gets synced daily
     MaximumIntervalBeforeExhaustiveSync = timedelta(days=14)  # Based on the general page size of 50 activites, this would be >3/day...
+    SyncTimeBudget = timedelta(minutes=15) # After which a sync wraps up and requeues itself to finish the rest, so heavy users don't hog workers
+    LockedUserRetryInterval = timedelta(minutes=1)
+    BackfillTimeBudget = timedelta(minutes=5)
+    BackfillBatchSize = 25 # Activities downloaded per backfill slice
+    BackfillSliceInterval = timedelta(minutes=1)
+    BackfillRetryInterval = timedelta(minutes=10) # When the user is busy, or rate limits are getting tight
+    BackfillRateLimitReserve = 0.5 # Fraction of each service's global rate limits to leave for regular syncs
+    BackfillRetryCount = 3 # Slices that fail outright in a row before we give up and leave it to their next exhaustive sync
+    BackfillListingLifetime = timedelta(days=1) # Past this, relist rather than carrying on through a listing that's drifted too far from reality
+    CheckpointLifetime = timedelta(hours=12) # Don't resume from something this old, things will have changed too much
+    LockLeaseDuration = timedelta(seconds=30)
+    LockLeaseRenewalInterval = timedelta(seconds=10)
+    PipelineTransferLifetime = timedelta(hours=2) # Past this, a transfer is assumed to have been lost somewhere between stages
+
+    def LockedUserMongoQuery():
+        return {"SynchronizationWorker": {"$ne": None}, "SynchronizationLeaseExpiry": {"$gt": datetime.utcnow()}}
+
+    def UnlockedUserMongoQuery():
+        # $not matches missing fields too
+        return {"$or": [{"SynchronizationWorker": None}, {"SynchronizationLeaseExpiry": {"$not": {"$gt": datetime.utcnow()}}}]}
+
+    def IsUserLocked(user):
+        return user.get("SynchronizationWorker") is not None and user.get("SynchronizationLeaseExpiry") is not None and user["SynchronizationLeaseExpiry"] > datetime.utcnow()
+
+    def HasPendingTransfers(user):
+        # In staged mode, activities are still making their way through the download/upload workers after the sync proper finishes.
+        return db.sync_transfers.find_one({"UserID": user["_id"], "Expires": {"$gt": datetime.utcnow()}}, {"_id": 1}) is not None
 
     def ScheduleImmediateSync(user, exhaustive=None):
         if exhaustive is None:
-            db.users.update({"_id": user["_id"]}, {"$set": {"NextSynchronization": datetime.utcnow()}})
+            db.users.update({"_id": user["_id"]}, {"$set": {"NextSynchronization": datetime.utcnow()}, "$unset": {"NextSyncIsPeriodic": True}})
         else:
-            db.users.update({"_id": user["_id"]}, {"$set": {"NextSynchronization": datetime.utcnow(), "NextSyncIsExhaustive": exhaustive}})
+            db.users.update({"_id": user["_id"]}, {"$set": {"NextSynchronization": datetime.utcnow(), "NextSyncIsExhaustive": exhaustive}, "$unset": {"NextSyncIsPeriodic": True}})
 
     def SetNextSyncIsExhaustive(user, exhaustive=False):
         db.users.update({"_id": user["_id"]}, {"$set": {"NextSyncIsExhaustive": exhaustive}})
 
+    def _determineSyncInterval(user, latest_activity=None):
+        # Users who haven't done anything in ages don't need hourly polling - back off in proportion to how long they've been idle.
+        interval = Sync.SyncInterval
+        if latest_activity:
+            interval = max(interval, (datetime.utcnow() - latest_activity) / Sync.IdleSyncIntervalRatio)
+
+        # If every service that can supply new activities only gets synced when triggered anyways, a periodic sync won't find much.
+        sources = []
+        for conn in user["ConnectedServices"]:
+            try:
+                svc = Service.FromID(conn["Service"])
+            except ValueError:
+                continue
+            if svc.SuppliesActivities:
+                sources.append(svc)
+        if sources and all(svc.PartialSyncRequiresTrigger for svc in sources):
+            interval = max(interval, Sync.TriggeredSyncInterval)
+
+        return min(interval, Sync.MaximumSyncInterval)
+
+    def _enumerateSyncSlots(earliest, latest):
+        slot = earliest.replace(second=0, microsecond=0)
+        slots = []
+        while slot <= latest:
+            slots.append(slot)
+            slot += Sync.SyncSlotLength
+        return slots
+
+    def _leastLoadedSyncSlot(slots, bookings):
+        least_bookings = min(bookings.get(slot, 0) for slot in slots)
+        return random.choice([slot for slot in slots if bookings.get(slot, 0) == least_bookings])
+
+    def _allocateSyncSlot(earliest, latest):
+        # After an outage (or when lots of people are re-enabled at once), everyone comes due at the same time and stays that way, since they're all rescheduled an interval later.
+        # So, book them into whichever minute in their window has the fewest people already scheduled - over a few cycles this flattens everything out.
+        # The counts only ever go up, so users who get synced early (triggers, etc.) leave a phantom booking behind - but that's not a big deal for this purpose.
+        slots = Sync._enumerateSyncSlots(earliest, latest)
+        bookings = {x["_id"]: x["Count"] for x in db.sync_slots.find({"_id": {"$gte": slots[0], "$lte": slots[-1]}})}
+        slot = Sync._leastLoadedSyncSlot(slots, bookings)
+        db.sync_slots.update({"_id": slot}, {"$inc": {"Count": 1}}, upsert=True)
+        return max(earliest, min(latest, slot + timedelta(seconds=random.randint(0, int(Sync.SyncSlotLength.total_seconds()) - 1))))
+
+    def ReleaseElapsedSyncSlots():
+        db.sync_slots.remove({"_id": {"$lt": datetime.utcnow() - Sync.SyncSlotLength}})
+
+    def _affinityRoutingKey(service_id):
+        return "affinity-%s" % service_id
+
+    def GetRoutingKey(user):
+        if "SynchronizationHostRestriction" in user and user["SynchronizationHostRestriction"]:
+            return user["SynchronizationHostRestriction"]
+        # Keep users with the same heavy-hitting services on the same workers - so sessions, connections, rate limits, etc. stay warm.
+        connected_service_ids = [x["Service"] for x in user.get("ConnectedServices", [])]
+        candidate_service_ids = [x for x in SYNC_AFFINITY_SERVICES if x in connected_service_ids]
+        if not candidate_service_ids:
+            return ""
+        # Whichever of them we've been making the most requests to - until we know better, the order they're configured in decides
+        service_traffic = user.get("ServiceTraffic", {})
+        return Sync._affinityRoutingKey(max(candidate_service_ids, key=lambda x: service_traffic.get(x, 0)))
+
     def InitializeWorkerBindings():
+        if WORKER_AFFINITY and WORKER_AFFINITY not in SYNC_AFFINITY_SERVICES:
+            # Otherwise we'd be sitting on a queue nobody is publishing to
+            raise ValueError("Worker affinity %s is not one of SYNC_AFFINITY_SERVICES (%s)" % (WORKER_AFFINITY, ", ".join(SYNC_AFFINITY_SERVICES)))
         Sync._channel = mq.channel()
         Sync._exchange = kombu.Exchange("tapiriik-users", type="direct")(Sync._channel)
         Sync._exchange.declare()
@@ -110,15 +228,64 @@ class Sync:
         # Bind to worker-specific and general routing keys
         Sync._global_queue.bind_to(exchange="tapiriik-users", routing_key="")
         Sync._host_queue.bind_to(exchange="tapiriik-users", routing_key=socket.gethostname())
+        # Declare all the affinity queues, even if we're not consuming from them, so nothing published to them is dropped while the pool is down.
+        Sync._affinity_queues = {}
+        for service_id in SYNC_AFFINITY_SERVICES:
+            Sync._affinity_queues[service_id] = kombu.Queue("tapiriik-users-%s" % Sync._affinityRoutingKey(service_id))(Sync._channel)
+            Sync._affinity_queues[service_id].declare()
+            Sync._affinity_queues[service_id].bind_to(exchange="tapiriik-users", routing_key=Sync._affinityRoutingKey(service_id))
+        # ...and the staged pipeline's, since any worker might be handing something off to them
+        Sync._stage_exchange = kombu.Exchange("tapiriik-sync-stages", type="direct")(Sync._channel)
+        Sync._stage_exchange.declare()
+        Sync._stage_queues = {}
+        for stage in [SyncStep.Download, SyncStep.Upload]:
+            Sync._stage_queues[stage] = kombu.Queue("tapiriik-sync-%s" % stage)(Sync._channel)
+            Sync._stage_queues[stage].declare()
+            Sync._stage_queues[stage].bind_to(exchange="tapiriik-sync-stages", routing_key=stage)
+
+    def _removeTransfers(user_id, transfer_ids):
+        db.sync_transfers.remove({"_id": {"$in": transfer_ids}}, multi=True)
+        if db.sync_transfers.find_one({"UserID": user_id}, {"_id": 1}):
+            return
+        # Last one out turns off the lights - the extended auth details were only being kept around for the transfers
+        # (unless a sync has started up since, and will be needing them itself)
+        user = db.users.find_one({"_id": user_id}, {"ConnectedServices": True, "SynchronizationWorker": True, "SynchronizationLeaseExpiry": True})
+        if user and not Sync.IsUserLocked(user):
+            cachedb.extendedAuthDetails.remove({"ID": {"$in": [x["ID"] for x in user["ConnectedServices"]]}})
+
+    def ClearExpiredTransfers():
+        # Transfers lost somewhere in the staged pipeline stop holding their users back once they expire, but they still need clearing out
+        expired_transfers = list(db.sync_transfers.find({"Expires": {"$lt": datetime.utcnow()}}, {"UserID": True}))
+        for user_id in set(x["UserID"] for x in expired_transfers):
+            Sync._removeTransfers(user_id, [x["_id"] for x in expired_transfers if x["UserID"] == user_id])
+
+    def _publishTransfer(transfer_id, stage):
+        producer = kombu.Producer(Sync._channel, Sync._stage_exchange)
+        producer.publish({"transfer_id": str(transfer_id), "stage": stage}, routing_key=stage)
 
     def PerformGlobalSync(heartbeat_callback=None, version=None, max_users=None):
-        def _callback(body, message):
+        def _sync_callback(body, message):
             Sync._consumeSyncTask(body, message, heartbeat_callback, version)
 
+        def _stage_callback(body, message):
+            Sync._consumeStageTask(body, message, heartbeat_callback)
+
+        # Download/upload workers in staged mode take transfers, everyone else takes users
+        callback = _stage_callback if WORKER_STAGE else _sync_callback
+
+        if WORKER_STAGE:
+            # Listing is left to the regular workers
+            queues = [Sync._stage_queues[WORKER_STAGE]]
+        elif WORKER_AFFINITY:
+            # Workers in a service's pool only handle that service's users (plus anything pinned to this host)
+            queues = [Sync._host_queue, Sync._affinity_queues[WORKER_AFFINITY]]
+        else:
+            queues = [Sync._host_queue, Sync._global_queue]
+
         Sync._consumer = kombu.Consumer(
             channel=Sync._channel,
-            queues=[Sync._host_queue, Sync._global_queue],
-            callbacks=[_callback],
+            queues=queues,
+            callbacks=[callback],
             auto_declare=False
         )
 
@@ -146,6 +313,11 @@ class Sync:
             message.ack()
             return
 
+        if Sync.IsUserLocked(user) or Sync.HasPendingTransfers(user):
+            Sync._deferLockedUser(user)
+            message.ack()
+            return
+
         def heartbeat_callback(state):
             heartbeat_callback_direct(state, user_id)
 
@@ -166,53 +338,171 @@ class Sync:
             exhaustive = True
 
         result = None
+        lockTaken = True
         try:
             result = Sync.PerformUserSync(user, exhaustive, heartbeat_callback=heartbeat_callback)
+        except SynchronizationLockedException:
+            # The check above is only a shortcut - someone else can still get to them first, in which case there's nothing to reschedule from
+            lockTaken = False
+            Sync._deferLockedUser(user)
         finally:
-            nextSync = None
-            if User.HasActivePayment(user):
-                if User.GetConfiguration(user)["suppress_auto_sync"]:
-                    logger.info("Not scheduling auto sync for paid user")
-                else:
-                    nextSync = datetime.utcnow() + Sync.SyncInterval + timedelta(seconds=random.randint(-Sync.SyncIntervalJitter.total_seconds(), Sync.SyncIntervalJitter.total_seconds()))
-            if result and result.ForceNextSync:
-                logger.info("Forcing next sync at %s" % result.ForceNextSync)
-                nextSync = result.ForceNextSync
-            reschedule_update = {
-                "$set": {
-                    "NextSynchronization": nextSync,
-                    "LastSynchronization": datetime.utcnow(),
-                    "LastSynchronizationVersion": version
-                }, "$unset": {
-                    "QueuedAt": None # Set by sync_scheduler when the record enters the MQ
+            if lockTaken:
+                nextSync = None
+                nextSyncIsPeriodic = False
+                # Services that weren't listed this time around might have had something newer, so keep whichever we've seen most recently
+                latestActivity = user.get("LatestActivityTime")
+                if result and result.LatestActivityTime and (not latestActivity or result.LatestActivityTime > latestActivity):
+                    latestActivity = result.LatestActivityTime
+                if User.HasActivePayment(user):
+                    if User.GetConfiguration(user)["suppress_auto_sync"]:
+                        logger.info("Not scheduling auto sync for paid user")
+                    else:
+                        syncInterval = Sync._determineSyncInterval(user, latestActivity)
+                        logger.debug("Sync interval %s (latest activity %s)" % (syncInterval, latestActivity))
+                        nextSync = datetime.utcnow() + syncInterval
+                if result and result.ForceNextSync and (not nextSync or result.ForceNextSync < nextSync - Sync.SyncIntervalJitter):
+                    # With adaptive intervals the regular schedule might well come first
+                    logger.info("Forcing next sync at %s" % result.ForceNextSync)
+                    nextSync = result.ForceNextSync
+                elif nextSync:
+                    # Rather than scattering them randomly, put them wherever there's the least already going on.
+                    nextSync = Sync._allocateSyncSlot(nextSync - Sync.SyncIntervalJitter, nextSync + Sync.SyncIntervalJitter)
+                    # These are the first to be held back when the queue is backed up
+                    nextSyncIsPeriodic = True
+                reschedule_update = {
+                    "$set": {
+                        "NextSynchronization": nextSync,
+                        "LastSynchronization": datetime.utcnow(),
+                        "LastSynchronizationVersion": version,
+                        "NextSyncIsPeriodic": nextSyncIsPeriodic
+                    }, "$unset": {
+                        "QueuedAt": None # Set by sync_scheduler when the record enters the MQ
+                    }
                 }
-            }
 
-            if result and result.ForceExhaustive:
-                logger.info("Forcing next sync as exhaustive")
-                reschedule_update["$set"]["NextSyncIsExhaustive"] = True
-            else:
-                reschedule_update["$unset"]["NextSyncIsExhaustive"] = ""
+                if latestActivity:
+                    reschedule_update["$set"]["LatestActivityTime"] = latestActivity
 
-            scheduling_result = db.users.update(
-                {
-                    "_id": user["_id"]
-                }, reschedule_update)
-            reschedule_confirm_message = "User reschedule for %s returned %s" % (nextSync, scheduling_result)
+                if result and result.ForceExhaustive:
+                    logger.info("Forcing next sync as exhaustive")
+                    reschedule_update["$set"]["NextSyncIsExhaustive"] = True
+                else:
+                    reschedule_update["$unset"]["NextSyncIsExhaustive"] = ""
+
+                scheduling_result = db.users.update(
+                    {
+                        "_id": user["_id"]
+                    }, reschedule_update)
+                reschedule_confirm_message = "User reschedule for %s returned %s" % (nextSync, scheduling_result)
 
-            # Tack this on the end of the log file since otherwise it's lost for good (blegh, but nicer than moving logging out of the sync task?)
-            user_log = open(USER_SYNC_LOGS + str(user["_id"]) + ".log", "a+")
-            user_log.write("\n%s\n" % reschedule_confirm_message)
-            user_log.close()
+                # Tack this on the end of the log file since otherwise it's lost for good (blegh, but nicer than moving logging out of the sync task?)
+                user_log = open(USER_SYNC_LOGS + str(user["_id"]) + ".log", "a+")
+                user_log.write("\n%s\n" % reschedule_confirm_message)
+                user_log.close()
 
-            logger.debug(reschedule_confirm_message)
-            syncTime = (datetime.utcnow() - syncStart).total_seconds()
-            db.sync_worker_stats.insert({"Timestamp": datetime.utcnow(), "Worker": os.getpid(), "Host": socket.gethostname(), "TimeTaken": syncTime})
+                logger.debug(reschedule_confirm_message)
+                syncTime = (datetime.utcnow() - syncStart).total_seconds()
+                db.sync_worker_stats.insert({"Timestamp": datetime.utcnow(), "Worker": os.getpid(), "Host": socket.gethostname(), "TimeTaken": syncTime})
 
         message.ack()
 
+    def _deferLockedUser(user):
+        # Most likely they're partway through a backfill slice, or the staged pipeline - those don't take long, so check back shortly.
+        logger.info("User %s is locked, retrying later" % user["_id"])
+        db.users.update({"_id": user["_id"]}, {"$set": {"NextSynchronization": datetime.utcnow() + Sync.LockedUserRetryInterval}, "$unset": {"QueuedAt": None}})
+
+    def _consumeStageTask(body, message, heartbeat_callback_direct):
+        from tapiriik.auth import User
+
+        transfer = db.sync_transfers.find_one({"_id": ObjectId(body["transfer_id"])})
+        if not transfer or transfer["Stage"] != body["stage"]:
+            logger.warning("Transfer %s is gone or has moved on - bailing" % body["transfer_id"])
+            message.ack()
+            return
+
+        user = User.Get(transfer["UserID"])
+        if user is None:
+            logger.warning("Could not find user %s - bailing" % transfer["UserID"])
+            db.sync_transfers.remove({"_id": transfer["_id"]})
+            message.ack()
+            return
+
+        def heartbeat_callback(state):
+            heartbeat_callback_direct(state, str(transfer["UserID"]))
+
+        try:
+            SynchronizationTask(user).RunStage(transfer, heartbeat_callback=heartbeat_callback)
+        except:
+            # The next sync will pick it up again from scratch
+            Sync._removeTransfers(transfer["UserID"], [transfer["_id"]])
+            raise
+        finally:
+            message.ack()
+
     def PerformUserSync(user, exhaustive=False, heartbeat_callback=None):
-        return SynchronizationTask(user).Run(exhaustive=exhaustive, heartbeat_callback=heartbeat_callback)
+        return SynchronizationTask(user).Run(exhaustive=exhaustive, heartbeat_callback=heartbeat_callback, time_budget=Sync.SyncTimeBudget, staged=SYNC_PIPELINE_STAGED)
+
+    def CanBackfill(user):
+        # Backfills run unprompted, so they're for the same people periodic syncs are - everyone else gets their history from the exhaustive sync they start themselves.
+        from tapiriik.auth import User
+        return User.HasActivePayment(user) and not User.GetConfiguration(user)["suppress_auto_sync"]
+
+    def ScheduleBackfill(user):
+        # Bringing over the entire history of a newly connected account is done in the background, in small chronological batches, so their regular syncs aren't stuck behind it.
+        from sync_backfill_worker import schedule_backfill_task
+        db.users.update({"_id": user["_id"]}, {"$set": {"BackfillProgress": {"Requested": datetime.utcnow(), "Processed": 0, "Total": None}}})
+        db.sync_backfills.remove({"UserID": user["_id"]}) # Whatever was left of an earlier one doesn't include the new service
+        schedule_backfill_task(str(user["_id"]))
+
+    def _cancelBackfill(user):
+        # Their next exhaustive sync picks up wherever it got to.
+        db.users.update({"_id": user["_id"]}, {"$set": {"NextSyncIsExhaustive": True}, "$unset": {"BackfillProgress": None}})
+        db.sync_backfills.remove({"UserID": user["_id"]})
+
+    def _backfillRateLimitAvailable(user):
+        from tapiriik.services.ratelimiting import RateLimit
+        for conn in user["ConnectedServices"]:
+            try:
+                svc = Service.FromID(conn["Service"])
+            except ValueError:
+                continue
+            if svc.GlobalRateLimits and RateLimit.Headroom(svc.ID) < Sync.BackfillRateLimitReserve:
+                logger.info("Holding off backfill, %s rate limit is getting tight" % svc.ID)
+                return False
+        return True
+
+    def PerformUserBackfill(user, heartbeat_callback=None):
+        # Returns how long to wait before running the next slice, or None when it's done.
+        if "BackfillProgress" not in user:
+            return None
+        # Regular syncs always get first dibs on the user.
+        if Sync.IsUserLocked(user) or user.get("QueuedAt") or Sync.HasPendingTransfers(user) or not Sync._backfillRateLimitAvailable(user):
+            return Sync.BackfillRetryInterval
+
+        if not Sync.CanBackfill(user):
+            logger.info("User %s is no longer eligible for backfill" % user["_id"])
+            Sync._cancelBackfill(user)
+            return None
+
+        try:
+            result = SynchronizationTask(user).Run(exhaustive=True, backfill=True, heartbeat_callback=heartbeat_callback, time_budget=Sync.BackfillTimeBudget, activity_limit=Sync.BackfillBatchSize)
+        except SynchronizationLockedException:
+            # A regular sync got in after all
+            return Sync.BackfillRetryInterval
+        except Exception:
+            failures = user["BackfillProgress"].get("Failures", 0) + 1
+            logger.exception("Backfill slice for %s failed (%d in a row)" % (user["_id"], failures))
+            if failures >= Sync.BackfillRetryCount:
+                Sync._cancelBackfill(user)
+                return None
+            db.users.update({"_id": user["_id"]}, {"$set": {"BackfillProgress.Failures": failures}})
+            return Sync.BackfillRetryInterval
+
+        if result and result.Incomplete:
+            return Sync.BackfillSliceInterval
+
+        db.users.update({"_id": user["_id"]}, {"$unset": {"BackfillProgress": None}})
+        return None
 
 
 class SynchronizationTask:
@@ -221,17 +511,50 @@ class SynchronizationTask:
 
     def __init__(self, user):
         self.user = user
+        self._transfer = None # Set when running a single stage of the staged pipeline
+        self._serviceTraffic = {} # Downloads + uploads attempted per service, for Sync.GetRoutingKey
 
     def _lockUser(self):
-        db.users.update({"_id": self.user["_id"]}, {"$set": {"SynchronizationWorker": os.getpid(), "SynchronizationHost": socket.gethostname(), "SynchronizationStartTime": datetime.utcnow()}})
+        # The lock is a lease - it's renewed in the background for as long as we keep heartbeating, so if this process dies (or hangs) it lapses on its own.
+        # It's taken in one go, only if nobody else holds it - otherwise two workers could both check IsUserLocked, then both go ahead.
+        query = {"_id": self.user["_id"]}
+        query.update(Sync.UnlockedUserMongoQuery())
+        if db.users.find_one_and_update(query, {"$set": {"SynchronizationWorker": os.getpid(), "SynchronizationHost": socket.gethostname(), "SynchronizationStartTime": datetime.utcnow(), "SynchronizationLeaseExpiry": datetime.utcnow() + Sync.LockLeaseDuration}}, projection={"_id": True}) is None:
+            raise SynchronizationLockedException()
+        self._lastHeartbeat = (datetime.utcnow(), SyncStep.List)
+        self._leaseReleased = threading.Event()
+        self._leaseThread = threading.Thread(target=self._renewLease, daemon=True)
+        self._leaseThread.start()
+
+    def _renewLease(self):
+        while not self._leaseReleased.wait(Sync.LockLeaseRenewalInterval.total_seconds()):
+            heartbeat_time, heartbeat_step = self._lastHeartbeat
+            if datetime.utcnow() - heartbeat_time > SyncStep.StallTimeout(heartbeat_step):
+                # We're stuck somewhere - stop renewing for good and let someone else have a go at this user.
+                logger.warning("No heartbeat since %s, letting lease lapse" % heartbeat_time)
+                return
+            db.users.update({"_id": self.user["_id"], "SynchronizationWorker": os.getpid(), "SynchronizationHost": socket.gethostname()}, {"$set": {"SynchronizationLeaseExpiry": datetime.utcnow() + Sync.LockLeaseDuration}})
+
+    def _heartbeat(self, heartbeat_callback):
+        def _callback(step):
+            self._lastHeartbeat = (datetime.utcnow(), step)
+            if heartbeat_callback:
+                heartbeat_callback(step)
+        return _callback
+
+    def _releaseLease(self):
+        if hasattr(self, "_leaseReleased"):
+            self._leaseReleased.set()
 
     def _unlockUser(self):
+        self._releaseLease()
         unlock_result = db.users.update(
             {
                 "_id": self.user["_id"]
             }, {
                 "$unset": {
-                    "SynchronizationWorker": None
+                    "SynchronizationWorker": None,
+                    "SynchronizationLeaseExpiry": None
                 }
             })
         logger.debug("User unlock returned %s" % unlock_result)
@@ -243,10 +566,11 @@ class SynchronizationTask:
     def _updateSyncProgress(self, step, progress):
         db.users.update({"_id": self.user["_id"]}, {"$set": {"SynchronizationProgress": progress, "SynchronizationStep": step}})
 
-    def _initializeUserLogging(self):
+    def _initializeUserLogging(self, rollover=True):
         self._logging_file_handler = logging.handlers.RotatingFileHandler(USER_SYNC_LOGS + str(self.user["_id"]) + ".log", maxBytes=0, backupCount=5, encoding="utf-8")
         self._logging_file_handler.setFormatter(logging.Formatter(self._logFormat, self._logDateFormat))
-        self._logging_file_handler.doRollover()
+        if rollover:
+            self._logging_file_handler.doRollover()
         _global_logger.addHandler(self._logging_file_handler)
 
     def _closeUserLogging(self):
@@ -280,6 +604,40 @@ class SynchronizationTask:
             if conn.ExcludedActivities:
                 del conn.ExcludedActivities  # Otherwise the exception messages get really, really, really huge and break mongodb.
 
+    def _initializeStageSyncErrorsAndExclusions(self):
+        # The sync proper already wrote back everything it had - stages just add on to that, so they start from scratch and merge in what they've found afterwards.
+        self._syncErrors = {}
+        self._hasTransientSyncErrors = {}
+        self._syncExclusions = {}
+        self._stageExclusionBaseline = {}
+
+        for conn in self._serviceConnections:
+            self._syncErrors[conn._id] = []
+            self._syncExclusions[conn._id] = dict(conn.ExcludedActivities) if conn.ExcludedActivities else {}
+            self._stageExclusionBaseline[conn._id] = set(self._syncExclusions[conn._id].keys())
+
+    def _writeBackStageSyncErrorsAndExclusions(self):
+        nonblockingSyncErrorsCount = 0
+        forcingExhaustiveSyncErrorsCount = 0
+        blockingSyncErrorsCount = 0
+        syncExclusionCount = 0
+        for conn in self._serviceConnections:
+            update_values = {}
+            if self._syncErrors[conn._id]:
+                update_values["$push"] = {"SyncErrors": {"$each": self._syncErrors[conn._id]}}
+            new_exclusions = dict((k, v) for k, v in self._syncExclusions[conn._id].items() if k not in self._stageExclusionBaseline[conn._id])
+            if new_exclusions:
+                update_values["$set"] = dict(("ExcludedActivities.%s" % k, v) for k, v in new_exclusions.items())
+            if update_values:
+                db.connections.update({"_id": conn._id}, update_values)
+            nonblockingSyncErrorsCount += len([x for x in self._syncErrors[conn._id] if "Block" not in x or not x["Block"]])
+            blockingSyncErrorsCount += len([x for x in self._syncErrors[conn._id] if "Block" in x and x["Block"]])
+            forcingExhaustiveSyncErrorsCount += len([x for x in self._syncErrors[conn._id] if "Block" in x and x["Block"] and "TriggerExhaustive" in x and x["TriggerExhaustive"]])
+            syncExclusionCount += len(new_exclusions)
+
+        if nonblockingSyncErrorsCount or blockingSyncErrorsCount or syncExclusionCount:
+            db.users.update({"_id": self.user["_id"]}, {"$inc": {"NonblockingSyncErrorCount": nonblockingSyncErrorsCount, "BlockingSyncErrorCount": blockingSyncErrorsCount, "ForcingExhaustiveSyncErrorCount": forcingExhaustiveSyncErrorsCount, "SyncExclusionCount": syncExclusionCount}})
+
     def _writeBackSyncErrorsAndExclusions(self):
         nonblockingSyncErrorsCount = 0
         forcingExhaustiveSyncErrorsCount = 0
@@ -313,7 +671,7 @@ class SynchronizationTask:
 
         db.users.update({"_id": self.user["_id"]}, {"$set": {"NonblockingSyncErrorCount": nonblockingSyncErrorsCount, "BlockingSyncErrorCount": blockingSyncErrorsCount, "ForcingExhaustiveSyncErrorCount": forcingExhaustiveSyncErrorsCount, "SyncExclusionCount": syncExclusionCount}})
 
-    def _writeBackActivityRecords(self):
+    def _composeActivityRecord(self, record):
         def _activityPrescences(prescences):
             return dict([(svcId if svcId else "",
                 {
@@ -322,31 +680,46 @@ class SynchronizationTask:
                     "Exception": _packUserException(presc.UserException)
                 }) for svcId, presc in prescences.items()])
 
+        return {
+            "StartTime": record.StartTime,
+            "EndTime": record.EndTime,
+            "Type": record.Type,
+            "Name": record.Name,
+            "Notes": record.Notes,
+            "Private": record.Private,
+            "Stationary": record.Stationary,
+            "Distance": record.Distance,
+            "UIDs": list(record.UIDs),
+            "Prescence": _activityPrescences(record.PresentOnServices),
+            "Abscence": _activityPrescences(record.NotPresentOnServices),
+            "FailureCounts": record.FailureCounts
+        }
+
+    def _writeBackActivityRecord(self, record):
+        # Just the one, leaving the rest of their records as they are.
+        # The stages don't hold the user's lock, so this only goes through if the records are still the ones the transfer was made alongside - otherwise a sync has rewritten them since, and ours is out of date.
+        records_query = {"UserID": self.user["_id"], "Revision": self._transfer.get("RecordsRevision")}
+        composed_record = self._composeActivityRecord(record)
+        result = db.activity_records.update(dict(records_query, **{"Activities.UIDs": {"$in": list(record.UIDs)}}), {"$set": {"Activities.$": composed_record}})
+        if not result["n"]:
+            # It'll be sorted into place next time all the records are written back.
+            result = db.activity_records.update(records_query, {"$push": {"Activities": composed_record}})
+        if not result["n"]:
+            logger.warning("Activity records have been rewritten since this transfer was made, leaving them be")
+
+    def _writeBackActivityRecords(self):
         self._activityRecords.sort(key=lambda x: x.StartTime.replace(tzinfo=None), reverse=True)
-        composed_records = [
-            {
-                "StartTime": x.StartTime,
-                "EndTime": x.EndTime,
-                "Type": x.Type,
-                "Name": x.Name,
-                "Notes": x.Notes,
-                "Private": x.Private,
-                "Stationary": x.Stationary,
-                "Distance": x.Distance,
-                "UIDs": list(x.UIDs),
-                "Prescence": _activityPrescences(x.PresentOnServices),
-                "Abscence": _activityPrescences(x.NotPresentOnServices),
-                "FailureCounts": x.FailureCounts
-            }
-            for x in self._activityRecords
-        ]
+        composed_records = [self._composeActivityRecord(x) for x in self._activityRecords]
+        # Any transfers still making their way through the pipeline are working from the old ones, and mustn't write over these
+        self._activityRecordsRevision = ObjectId()
 
         db.activity_records.update(
             {"UserID": self.user["_id"]},
             {
                 "$set": {
                     "UserID": self.user["_id"],
-                    "Activities": composed_records
+                    "Activities": composed_records,
+                    "Revision": self._activityRecordsRevision
                 }
             },
             upsert=True
@@ -384,9 +757,83 @@ class SynchronizationTask:
         self._activityRecords.append(record)
         return record
 
+    def _initializeCheckpoint(self):
+        # If the last sync didn't make it to the end (killed, crashed, etc.) it'll have left a checkpoint behind.
+        self._checkpoint = self.user.get("SyncCheckpoint") if self.user else None
+        if self._checkpoint and self._checkpoint["Timestamp"] < datetime.utcnow() - Sync.CheckpointLifetime:
+            logger.info("Discarding stale checkpoint from %s" % self._checkpoint["Timestamp"])
+            self._clearCheckpoint()
+        if self._checkpoint:
+            logger.info("Resuming from checkpoint at %s (%d activities completed)" % (self._checkpoint["Timestamp"], len(self._checkpoint["Activities"])))
+        else:
+            self._checkpoint = {"Activities": {}}
+
+    def _resumeActivityFromCheckpoint(self, activity):
+        # Returns True if the activity was dealt with before the last sync died, after restoring what we knew about it then.
+        if "Downloading" in self._checkpoint and self._checkpoint["Downloading"]["UID"] in activity.UIDs:
+            # Whatever happened last time happened while we were working on this activity - consider it to be a failed download, so a poison activity can't keep killing workers.
+            conn = [x for x in self._serviceConnections if x._id == self._checkpoint["Downloading"]["Connection"]]
+            if conn:
+                logger.info("\t\t...was being downloaded from %s when the last sync died" % conn[0].Service.ID)
+                activity.Record.IncrementFailureCount(conn[0])
+            del self._checkpoint["Downloading"]
+
+        checkpoint_uid = [x for x in activity.UIDs if x in self._checkpoint["Activities"]]
+        if not checkpoint_uid:
+            return False
+        checkpoint = self._checkpoint["Activities"][checkpoint_uid[0]]
+        activity.Record.FailureCounts.update(checkpoint["FailureCounts"])
+        for conn in self._serviceConnections:
+            if conn._id in checkpoint["Uploaded"]:
+                activity.Record.MarkAsSynchronizedTo(conn)
+        logger.info("\t\t...was completed before the last sync died")
+        return True
+
+    def _checkpointDownload(self, activity, conn):
+        if self._transfer:
+            # The transfer itself serves as the checkpoint in the staged pipeline.
+            db.sync_transfers.update({"_id": self._transfer["_id"]}, {"$set": {"Downloading": conn._id}})
+            return
+        db.users.update({"_id": self.user["_id"]}, {"$set": {"SyncCheckpoint.Downloading": {"UID": activity.UID, "Connection": conn._id}, "SyncCheckpoint.Timestamp": datetime.utcnow()}})
+
+    def _checkpointActivity(self, activity, uploaded_conns):
+        checkpoint = {"Uploaded": [x._id for x in uploaded_conns], "FailureCounts": dict(activity.Record.FailureCounts)}
+        self._checkpoint["Activities"][activity.UID] = checkpoint
+        db.users.update({"_id": self.user["_id"]}, {"$set": {"SyncCheckpoint.Activities.%s" % activity.UID: checkpoint, "SyncCheckpoint.Timestamp": datetime.utcnow()}, "$unset": {"SyncCheckpoint.Downloading": True}})
+
+    def _clearCheckpoint(self):
+        self._checkpoint = {"Activities": {}}
+        db.users.update({"_id": self.user["_id"]}, {"$unset": {"SyncCheckpoint": True}})
+
     def _dropUntouchedActivityRecords(self):
         self._activityRecords[:] = [x for x in self._activityRecords if x.Touched]
 
+    def _countServiceTraffic(self, service):
+        self._serviceTraffic[service.ID] = self._serviceTraffic.get(service.ID, 0) + 1
+
+    def _writeBackServiceTraffic(self):
+        if not self._serviceTraffic:
+            return
+        db.users.update({"_id": self.user["_id"]}, {"$inc": dict(("ServiceTraffic.%s" % svcId, count) for svcId, count in self._serviceTraffic.items())})
+        self._serviceTraffic = {}
+
+    def _loadBackfillListing(self):
+        # Whatever the last backfill slice didn't get to - None if this slice needs to do the listing itself
+        listing = db.sync_backfills.find_one({"UserID": self.user["_id"]})
+        if not listing:
+            return None
+        if listing["Listed"] < datetime.utcnow() - Sync.BackfillListingLifetime:
+            logger.info("Backfill listing from %s is stale, relisting" % listing["Listed"])
+            return None
+        self._backfillListed = listing["Listed"]
+        return _unpackActivities(listing["Activities"], self._serviceConnections)
+
+    def _writeBackBackfillListing(self, activities):
+        if activities:
+            db.sync_backfills.update({"UserID": self.user["_id"]}, {"$set": {"Activities": _packActivities(*activities), "Listed": self._backfillListed}}, upsert=True)
+        else:
+            db.sync_backfills.remove({"UserID": self.user["_id"]})
+
     def _persistServiceTrigger(self, serviceRecord):
         self._persistTriggerServices[serviceRecord._id] = True
 
@@ -630,21 +1077,36 @@ class SynchronizationTask:
                 # The connection never gets saved in full again, so we can sub these in here at no risk.
                 conn.ExtendedAuthorization = extAuthDetails[0]
 
-    def _downloadActivityList(self, conn, exhaustive, no_add=False):
+    def _excludeUnavailableService(self, conn, blocking_errors=None):
+        # Returns True if the service has been excluded from this sync
         svc = conn.Service
         # Bail out as appropriate for the entire account (_syncErrors contains only blocking errors at this point)
-        if [x for x in self._syncErrors[conn._id] if x["Scope"] == ServiceExceptionScope.Account]:
+        # (the stages start _syncErrors afresh, so they hand over the blocking errors persisted on the connection instead)
+        blocking_errors = self._syncErrors[conn._id] if blocking_errors is None else blocking_errors
+        if [x for x in blocking_errors if x["Scope"] == ServiceExceptionScope.Account]:
             raise SynchronizationCompleteException()
 
         # ...and for this specific service
-        if [x for x in self._syncErrors[conn._id] if x["Scope"] == ServiceExceptionScope.Service]:
+        if [x for x in blocking_errors if x["Scope"] == ServiceExceptionScope.Service]:
             logger.info("Service %s is blocked:" % conn.Service.ID)
-            self._excludeService(conn, _unpackUserException([x for x in self._syncErrors[conn._id] if x["Scope"] == ServiceExceptionScope.Service][0]))
-            return
+            self._excludeService(conn, _unpackUserException([x for x in blocking_errors if x["Scope"] == ServiceExceptionScope.Service][0]))
+            return True
 
         if svc.ID in DISABLED_SERVICES or svc.ID in WITHDRAWN_SERVICES:
             logger.info("Service %s is widthdrawn" % conn.Service.ID)
             self._excludeService(conn, UserException(UserExceptionType.Other))
+            return True
+
+        if svc.RequiresExtendedAuthorizationDetails:
+            if not conn.ExtendedAuthorization:
+                logger.info("No extended auth details for " + svc.ID)
+                self._excludeService(conn, UserException(UserExceptionType.MissingCredentials))
+                return True
+        return False
+
+    def _downloadActivityList(self, conn, exhaustive, no_add=False):
+        svc = conn.Service
+        if self._excludeUnavailableService(conn):
             return
 
         if exhaustive and not svc.SupportsExhaustiveListing and not self._activities:
@@ -653,12 +1115,6 @@ class SynchronizationTask:
             self._excludeService(conn, UserException(UserExceptionType.Other))
             return
 
-        if svc.RequiresExtendedAuthorizationDetails:
-            if not conn.ExtendedAuthorization:
-                logger.info("No extended auth details for " + svc.ID)
-                self._excludeService(conn, UserException(UserExceptionType.MissingCredentials))
-                return
-
         try:
             logger.info("\tRetrieving list from " + svc.ID)
             if not exhaustive or not self._activities:
@@ -786,9 +1242,12 @@ class SynchronizationTask:
                 logger.info("\t\t...download retry count exceeded")
                 continue
 
+            self._checkpointDownload(activity, dlSvcRecord)
+
             workingCopy = copy.copy(activity)  # we can hope
             # Load in the service data in the same place they left it.
             workingCopy.ServiceData = workingCopy.ServiceDataCollection[dlSvcRecord._id] if dlSvcRecord._id in workingCopy.ServiceDataCollection else None
+            self._countServiceTraffic(dlSvc)
             try:
                 workingCopy = dlSvc.DownloadActivity(dlSvcRecord, workingCopy)
             except (ServiceException, ServiceWarning) as e:
@@ -849,6 +1308,7 @@ class SynchronizationTask:
     def _uploadActivity(self, activity, destinationServiceRec):
         destSvc = destinationServiceRec.Service
 
+        self._countServiceTraffic(destSvc)
         try:
             return destSvc.UploadActivity(destinationServiceRec, activity)
         except (ServiceException, ServiceWarning) as e:
@@ -880,10 +1340,182 @@ class SynchronizationTask:
 
         activity.Record.ResetFailureCount(destinationServiceRec)
 
-    def Run(self, exhaustive=False, null_next_sync_on_unlock=False, heartbeat_callback=None):
-        from tapiriik.auth import User
+    def _prepareDownloadedActivity(self, activity, full_activity):
+        # Returns False if it turns out it can't be synchronized after all.
+        full_activity.CleanStats()
+        full_activity.CleanWaypoints()
+
+        try:
+            full_activity.EnsureTZ()
+        except Exception as e:
+            logger.error("\tCould not determine TZ %s" % e)
+            self._accumulateExclusions(full_activity.SourceConnection, APIExcludeActivity("Could not determine TZ", activity=full_activity, permanent=False))
+            activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.UnknownTZ))
+            return False
+        else:
+            logger.debug("\tDetermined TZ %s" % full_activity.TZ)
+
+        try:
+            full_activity.CheckTimestampSanity()
+        except ValueError as e:
+            logger.warning("\t\t...failed timestamp sanity check - %s" % e)
+            # self._accumulateExclusions(full_activity.SourceConnection, APIExcludeActivity("Timestamp sanity check failed", activity=full_activity, permanent=True))
+            # activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.SanityError))
+            # return False
+
+        activity.Record.SetActivity(activity) # Update with whatever more accurate information we may have.
+
+        full_activity.Record = activity.Record # Some services don't return the same object, so this gets lost, which is meh, but...
+        return True
+
+    def _uploadActivityToDestinations(self, activity, full_activity, activitySource, destinations, heartbeat_callback=None):
         from tapiriik.services.interchange import ActivityStatisticUnit
 
+        successful_destination_service_ids = []
+
+        for destinationSvcRecord in destinations:
+            if heartbeat_callback:
+                heartbeat_callback(SyncStep.Upload)
+            destSvc = destinationSvcRecord.Service
+            if not destSvc.ReceivesStationaryActivities and full_activity.Stationary:
+                logger.info("\t\t...marked as stationary during download")
+                activity.Record.MarkAsNotPresentOn(destinationSvcRecord, UserException(UserExceptionType.StationaryUnsupported))
+                continue
+            if not full_activity.Stationary:
+                if not (destSvc.ReceivesNonGPSActivitiesWithOtherSensorData or full_activity.GPS):
+                    logger.info("\t\t...marked as non-GPS during download")
+                    activity.Record.MarkAsNotPresentOn(destinationSvcRecord, UserException(UserExceptionType.NonGPSUnsupported))
+                    continue
+
+            uploaded_external_id = None
+            logger.info("\t  Uploading to " + destSvc.ID)
+            try:
+                uploaded_external_id = self._uploadActivity(full_activity, destinationSvcRecord)
+            except UploadException:
+                continue # At this point it's already been added to the error collection, so we can just bail.
+            logger.info("\t  Uploaded")
+
+            activity.Record.MarkAsSynchronizedTo(destinationSvcRecord)
+            successful_destination_service_ids.append(destSvc.ID)
+
+            if uploaded_external_id:
+                # record external ID, for posterity (and later debugging)
+                db.uploaded_activities.insert({"ExternalID": uploaded_external_id, "Service": destSvc.ID, "UserExternalID": destinationSvcRecord.ExternalID, "Timestamp": datetime.utcnow()})
+            # flag as successful
+            db.connections.update({"_id": destinationSvcRecord._id},
+                                  {"$addToSet": {"SynchronizedActivities": {"$each": list(activity.UIDs)}}})
+
+            db.sync_stats.update({"ActivityID": activity.UID}, {"$addToSet": {"DestinationServices": destSvc.ID, "SourceServices": activitySource.ID}, "$set": {"Distance": activity.Stats.Distance.asUnits(ActivityStatisticUnit.Meters).Value, "Timestamp": datetime.utcnow()}}, upsert=True)
+
+        if len(successful_destination_service_ids):
+            self._pushRecentSyncActivity(full_activity, successful_destination_service_ids)
+        return successful_destination_service_ids
+
+    def _stageTransfer(self, activity, destinations):
+        self._stagedTransfers.append({
+            "UserID": self.user["_id"],
+            "UID": activity.UID,
+            "Stage": SyncStep.Download,
+            "Destinations": [x._id for x in destinations],
+            "Activity": _packActivities(activity)
+        })
+
+    def _dispatchStagedTransfers(self):
+        for transfer in self._stagedTransfers:
+            transfer["Expires"] = datetime.utcnow() + Sync.PipelineTransferLifetime
+            transfer["RecordsRevision"] = self._activityRecordsRevision
+            transfer["_id"] = db.sync_transfers.insert(transfer)
+            Sync._publishTransfer(transfer["_id"], SyncStep.Download)
+
+    def _finishTransfer(self, activity):
+        self._writeBackStageSyncErrorsAndExclusions()
+        self._writeBackActivityRecord(activity.Record)
+        self._writeBackServiceTraffic()
+        Sync._removeTransfers(self.user["_id"], [self._transfer["_id"]])
+
+    def _runDownloadStage(self, activity, heartbeat_callback=None):
+        if "Downloading" in self._transfer:
+            # Same deal as resuming from a checkpoint - don't let a poison activity keep killing workers.
+            conn = [x for x in self._serviceConnections if x._id == self._transfer["Downloading"]]
+            if conn:
+                logger.info("\t\t...was being downloaded from %s when its worker died" % conn[0].Service.ID)
+                activity.Record.IncrementFailureCount(conn[0])
+
+        if heartbeat_callback:
+            heartbeat_callback(SyncStep.Download)
+
+        full_activity, activitySource = self._downloadActivity(activity)
+        if full_activity is None or not self._prepareDownloadedActivity(activity, full_activity):
+            self._finishTransfer(activity)
+            return
+
+        # Anything we've learned so far is written back now, the upload stage only adds to it.
+        self._writeBackStageSyncErrorsAndExclusions()
+        self._writeBackActivityRecord(activity.Record)
+        self._writeBackServiceTraffic()
+        db.sync_transfers.update({"_id": self._transfer["_id"]}, {
+            "$set": {
+                "Stage": SyncStep.Upload,
+                "Source": activitySource.ID,
+                "Activity": _packActivities(activity, full_activity),
+                "Expires": datetime.utcnow() + Sync.PipelineTransferLifetime
+            }, "$unset": {
+                "Downloading": None
+            }})
+        Sync._publishTransfer(self._transfer["_id"], SyncStep.Upload)
+
+    def _runUploadStage(self, activity, full_activity, heartbeat_callback=None):
+        destinations = []
+        for conn in self._serviceConnections:
+            if conn._id not in self._transfer["Destinations"]:
+                continue
+            if self._isServiceExcluded(conn):
+                # It was fine when the transfer was staged, but not any more
+                logger.info("\t\tExcluded " + conn.Service.ID)
+                activity.Record.MarkAsNotPresentOn(conn, self._getServiceExclusionUserException(conn))
+                continue
+            destinations.append(conn)
+        self._uploadActivityToDestinations(activity, full_activity, Service.FromID(self._transfer["Source"]), destinations, heartbeat_callback)
+        self._finishTransfer(activity)
+
+    def RunStage(self, transfer, heartbeat_callback=None):
+        self._transfer = transfer
+        self._initializeUserLogging(rollover=False)
+        logger.info("Beginning %s stage for %s (worker %d)" % (transfer["Stage"], self.user["_id"], os.getpid()))
+        try:
+            self._loadServiceData()
+            self._loadExtendedAuthData()
+            self._excludedServices = {}
+            self._initializeStageSyncErrorsAndExclusions()
+
+            activities = _unpackActivities(transfer["Activity"], self._serviceConnections)
+            logger.info(str(activities[0]) + " " + str(activities[0].UID[:3]))
+
+            # Same as the sync proper - credentials that aren't persisted need filling in, and services that have since become unavailable are left out
+            try:
+                for conn in self._serviceConnections:
+                    self._primeExtendedAuthDetails(conn)
+                    self._excludeUnavailableService(conn, [x for x in getattr(conn, "SyncErrors", []) if "Block" in x and x["Block"]])
+            except SynchronizationCompleteException:
+                logger.info("Account is blocked, dropping the transfer")
+                self._finishTransfer(activities[0])
+                return
+
+            if transfer["Stage"] == SyncStep.Download:
+                self._runDownloadStage(activities[0], heartbeat_callback)
+            else:
+                self._runUploadStage(activities[0], activities[1], heartbeat_callback)
+        except:
+            logger.exception("Core sync exception")
+            raise
+        else:
+            logger.info("Finished %s stage for %s" % (transfer["Stage"], self.user["_id"]))
+        finally:
+            self._closeUserLogging()
+
+    def Run(self, exhaustive=False, null_next_sync_on_unlock=False, heartbeat_callback=None, time_budget=None, activity_limit=None, backfill=False, staged=False):
+        from tapiriik.auth import User
+
         if len(self.user["ConnectedServices"]) <= 1:
             return # Done and done!
 
@@ -894,13 +1526,14 @@ class SynchronizationTask:
 
         # Mark this user as in-progress.
         self._lockUser()
+        heartbeat_callback = self._heartbeat(heartbeat_callback)
 
         # Reset their progress
         self._updateSyncProgress(SyncStep.List, 0)
 
         self._initializeUserLogging()
 
-        logger.info("Beginning sync for " + str(self.user["_id"]) + "(exhaustive: " + str(exhaustive) + ")")
+        logger.info("Beginning sync for " + str(self.user["_id"]) + "(exhaustive: " + str(exhaustive) + ", backfill: " + str(backfill) + ")")
 
         # Sets up serviceConnections
         self._loadServiceData()
@@ -911,56 +1544,84 @@ class SynchronizationTask:
         self._excludedServices = {}
         self._deferredServices = []
         self._persistTriggerServices = {}
+        self._stagedTransfers = []
 
         self._initializePersistedSyncErrorsAndExclusions()
 
         self._initializeActivityRecords()
 
-        try:
-            try:
-                # Sort services that don't support exhaustive listing last.
-                # That way, we can provide them with the proper bounds for listing based
-                # on activities from other services.
-                for conn in sorted(self._serviceConnections,
-                                   key=lambda x: x.Service.SupportsExhaustiveListing,
-                                   reverse=True):
-                    # If we're not going to be doing anything anyways, stop now
-                    if len(self._serviceConnections) - len(self._excludedServices) <= 1:
-                        raise SynchronizationCompleteException()
+        self._initializeCheckpoint()
 
-                    self._primeExtendedAuthDetails(conn)
+        # Backfills only list everything the once, then work their way through that listing a slice at a time
+        backfill_listing = self._loadBackfillListing() if backfill else None
 
-                    logger.info("Ensuring partial sync poll subscription")
-                    self._ensurePartialSyncPollingSubscription(conn)
-
-                    if not exhaustive and conn.Service.PartialSyncRequiresTrigger and "TriggerPartialSync" not in conn.__dict__ and not conn.Service.ShouldForcePartialSyncTrigger(conn):
-                        logger.info("Service %s has not been triggered" % conn.Service.ID)
-                        self._deferredServices.append(conn._id)
-                        continue
+        try:
+            try:
+                if backfill_listing is not None:
+                    logger.info("Continuing backfill with %d activities left from the listing at %s" % (len(backfill_listing), self._backfillListed))
+                    for conn in self._serviceConnections:
+                        if len(self._serviceConnections) - len(self._excludedServices) <= 1:
+                            raise SynchronizationCompleteException()
+                        self._primeExtendedAuthDetails(conn)
+                        self._excludeUnavailableService(conn)
+                    self._activities = backfill_listing
+                else:
+                    self._backfillListed = datetime.utcnow()
+                    # Sort services that don't support exhaustive listing last.
+                    # That way, we can provide them with the proper bounds for listing based
+                    # on activities from other services.
+                    for conn in sorted(self._serviceConnections,
+                                       key=lambda x: x.Service.SupportsExhaustiveListing,
+                                       reverse=True):
+                        # If we're not going to be doing anything anyways, stop now
+                        if len(self._serviceConnections) - len(self._excludedServices) <= 1:
+                            raise SynchronizationCompleteException()
+
+                        self._primeExtendedAuthDetails(conn)
+
+                        logger.info("Ensuring partial sync poll subscription")
+                        self._ensurePartialSyncPollingSubscription(conn)
+
+                        if not exhaustive and conn.Service.PartialSyncRequiresTrigger and "TriggerPartialSync" not in conn.__dict__ and not conn.Service.ShouldForcePartialSyncTrigger(conn):
+                            logger.info("Service %s has not been triggered" % conn.Service.ID)
+                            self._deferredServices.append(conn._id)
+                            continue
 
-                    if heartbeat_callback:
-                        heartbeat_callback(SyncStep.List)
+                        if heartbeat_callback:
+                            heartbeat_callback(SyncStep.List)
 
-                    self._updateSyncProgress(SyncStep.List, conn.Service.ID)
-                    self._downloadActivityList(conn, exhaustive)
+                        self._updateSyncProgress(SyncStep.List, conn.Service.ID)
+                        self._downloadActivityList(conn, exhaustive)
 
-                self._applyFallbackTZ()
+                    self._applyFallbackTZ()
 
                 # Makes reading the logs much easier.
-                self._activities = sorted(self._activities, key=lambda v: v.StartTime.replace(tzinfo=None), reverse=True)
+                # Backfills work through history in order, regular syncs start with whatever's most recent.
+                self._activities = sorted(self._activities, key=lambda v: v.StartTime.replace(tzinfo=None), reverse=not backfill)
+
+                # Used to decide how often this user needs syncing - close enough to UTC for that purpose, but don't let bogus future-dated activities count.
+                if len(self._activities):
+                    sync_result.LatestActivityTime = min(datetime.utcnow(), self._activities[0].StartTime.replace(tzinfo=None))
 
                 totalActivities = len(self._activities)
                 processedActivities = 0
+                consideredActivities = 0
+                # The budget only covers this part - listing takes as long as it takes, and counting it would leave nothing for the activities in the slowest accounts
+                slice_start = datetime.utcnow()
 
                 for activity in self._activities:
                     logger.info(str(activity) + " " + str(activity.UID[:3]) + " from " + str([[y.Service.ID for y in self._serviceConnections if y._id == x][0] for x in activity.ServiceDataCollection.keys()]))
                     logger.info(" Name: %s Notes: %s Distance: %s%s" % (activity.Name[:15] if activity.Name else "", activity.Notes[:15] if activity.Notes else "", activity.Stats.Distance.Value, activity.Stats.Distance.Units))
+                    consideredActivities += 1
                     try:
                         activity.Record = self._findOrCreateActivityRecord(activity) # Make it a member of the activity, to avoid passing it around as a seperate parameter everywhere.
 
                         self._updateSynchronizedActivities(activity)
                         self._updateActivityRecordInitialPrescence(activity)
 
+                        if self._resumeActivityFromCheckpoint(activity):
+                            raise ActivityShouldNotSynchronizeException()
+
                         actAvailableFromConnIds = activity.ServiceDataCollection.keys()
                         actAvailableFromConns = [[x for x in self._serviceConnections if x._id == dlSvcRecId][0] for dlSvcRecId in actAvailableFromConnIds]
 
@@ -1059,6 +1720,14 @@ class SynchronizationTask:
                         if heartbeat_callback:
                             heartbeat_callback(SyncStep.Download)
 
+                        # Regular syncs are sorted newest-first, so whatever's left over is the stuff people are least likely to be waiting on.
+                        # Every slice gets at least one activity done, so we can't end up requeueing forever without getting anywhere.
+                        if processedActivities and ((time_budget and datetime.utcnow() - slice_start > time_budget) or (activity_limit and processedActivities >= activity_limit)):
+                            logger.info("Reached slice limit (%s, %s activities), leaving %d activities for the next slice" % (time_budget, activity_limit, totalActivities - processedActivities))
+                            sync_result.Incomplete = True
+                            consideredActivities -= 1
+                            raise SynchronizationCompleteException()
+
                         if processedActivities == 0:
                             syncProgress = 0
                         elif totalActivities <= 0:
@@ -1070,77 +1739,28 @@ class SynchronizationTask:
                         # The second most important line of logging in the application...
                         logger.info("\t\t...to " + str([x.Service.ID for x in recipientServices]))
 
+                        if staged:
+                            # The download/upload workers take it from here, once we're done below.
+                            self._stageTransfer(activity, eligibleServices)
+                            processedActivities += 1
+                            raise ActivityShouldNotSynchronizeException()
+
                         # Download the full activity record
                         full_activity, activitySource = self._downloadActivity(activity)
 
                         if full_activity is None:  # couldn't download it from anywhere, or the places that had it said it was broken
                             # The activity record gets updated in _downloadActivity
                             processedActivities += 1  # we tried
+                            self._checkpointActivity(activity, [])
                             raise ActivityShouldNotSynchronizeException()
 
-                        full_activity.CleanStats()
-                        full_activity.CleanWaypoints()
-
-                        try:
-                            full_activity.EnsureTZ()
-                        except Exception as e:
-                            logger.error("\tCould not determine TZ %s" % e)
-                            self._accumulateExclusions(full_activity.SourceConnection, APIExcludeActivity("Could not determine TZ", activity=full_activity, permanent=False))
-                            activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.UnknownTZ))
+                        if not self._prepareDownloadedActivity(activity, full_activity):
+                            self._checkpointActivity(activity, [])
                             raise ActivityShouldNotSynchronizeException()
-                        else:
-                            logger.debug("\tDetermined TZ %s" % full_activity.TZ)
-
-                        try:
-                            full_activity.CheckTimestampSanity()
-                        except ValueError as e:
-                            logger.warning("\t\t...failed timestamp sanity check - %s" % e)
-                            # self._accumulateExclusions(full_activity.SourceConnection, APIExcludeActivity("Timestamp sanity check failed", activity=full_activity, permanent=True))
-                            # activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.SanityError))
-                            # raise ActivityShouldNotSynchronizeException()
-
-                        activity.Record.SetActivity(activity) # Update with whatever more accurate information we may have.
-
-                        full_activity.Record = activity.Record # Some services don't return the same object, so this gets lost, which is meh, but...
-
-                        successful_destination_service_ids = []
-
-                        for destinationSvcRecord in eligibleServices:
-                            if heartbeat_callback:
-                                heartbeat_callback(SyncStep.Upload)
-                            destSvc = destinationSvcRecord.Service
-                            if not destSvc.ReceivesStationaryActivities and full_activity.Stationary:
-                                logger.info("\t\t...marked as stationary during download")
-                                activity.Record.MarkAsNotPresentOn(destinationSvcRecord, UserException(UserExceptionType.StationaryUnsupported))
-                                continue
-                            if not full_activity.Stationary:
-                                if not (destSvc.ReceivesNonGPSActivitiesWithOtherSensorData or full_activity.GPS):
-                                    logger.info("\t\t...marked as non-GPS during download")
-                                    activity.Record.MarkAsNotPresentOn(destinationSvcRecord, UserException(UserExceptionType.NonGPSUnsupported))
-                                    continue
-
-                            uploaded_external_id = None
-                            logger.info("\t  Uploading to " + destSvc.ID)
-                            try:
-                                uploaded_external_id = self._uploadActivity(full_activity, destinationSvcRecord)
-                            except UploadException:
-                                continue # At this point it's already been added to the error collection, so we can just bail.
-                            logger.info("\t  Uploaded")
-
-                            activity.Record.MarkAsSynchronizedTo(destinationSvcRecord)
-                            successful_destination_service_ids.append(destSvc.ID)
-
-                            if uploaded_external_id:
-                                # record external ID, for posterity (and later debugging)
-                                db.uploaded_activities.insert({"ExternalID": uploaded_external_id, "Service": destSvc.ID, "UserExternalID": destinationSvcRecord.ExternalID, "Timestamp": datetime.utcnow()})
-                            # flag as successful
-                            db.connections.update({"_id": destinationSvcRecord._id},
-                                                  {"$addToSet": {"SynchronizedActivities": {"$each": list(activity.UIDs)}}})
-
-                            db.sync_stats.update({"ActivityID": activity.UID}, {"$addToSet": {"DestinationServices": destSvc.ID, "SourceServices": activitySource.ID}, "$set": {"Distance": activity.Stats.Distance.asUnits(ActivityStatisticUnit.Meters).Value, "Timestamp": datetime.utcnow()}}, upsert=True)
-
-                        if len(successful_destination_service_ids):
-                            self._pushRecentSyncActivity(full_activity, successful_destination_service_ids)
+
+                        successful_destination_service_ids = self._uploadActivityToDestinations(activity, full_activity, activitySource, eligibleServices, heartbeat_callback)
+
+                        self._checkpointActivity(activity, [x for x in eligibleServices if x.Service.ID in successful_destination_service_ids])
                         del full_activity
                         processedActivities += 1
                     except ActivityShouldNotSynchronizeException:
@@ -1152,20 +1772,53 @@ class SynchronizationTask:
                 # This gets thrown when there is obviously nothing left to do - but we still need to clean things up.
                 logger.info("SynchronizationCompleteException thrown")
 
+            if backfill:
+                # Triggers are for the regular syncs - and the backfill might not have gotten as far as whatever they were triggered by.
+                for conn in self._serviceConnections:
+                    self._persistServiceTrigger(conn)
+                self._writeBackBackfillListing(self._activities[consideredActivities:] if sync_result.Incomplete else [])
+                if backfill_listing is None:
+                    backfill_processed, backfill_total = 0, len(self._activities)
+                else:
+                    backfill_processed, backfill_total = self.user["BackfillProgress"]["Processed"], self.user["BackfillProgress"]["Total"]
+                backfill_processed += consideredActivities if sync_result.Incomplete else len(self._activities)
+                db.users.update({"_id": self.user["_id"]}, {"$set": {"BackfillProgress.Processed": backfill_processed, "BackfillProgress.Total": backfill_total, "BackfillProgress.Updated": datetime.utcnow(), "BackfillProgress.Failures": 0}})
+            elif sync_result.Incomplete:
+                # Pick up where we left off ASAP - the checkpoint will keep us from repeating everything done so far.
+                # We need to make sure everything's listed again next time, too.
+                for conn in self._serviceConnections:
+                    self._persistServiceTrigger(conn)
+                sync_result.ForceScheduleNextSyncOnOrBefore(datetime.utcnow())
+                if exhaustive:
+                    sync_result.ForceExhaustive = True
+
             logger.info("Writing back service data")
             self._writeBackSyncErrorsAndExclusions()
 
-            if exhaustive:
+            if exhaustive and not sync_result.Incomplete and backfill_listing is None:
                 # Clean up potentially orphaned records, since we know everything is here.
+                # (not so when a backfill is finishing off an earlier listing - only what was left of it went through this time)
                 logger.info("Clearing old activity records")
                 self._dropUntouchedActivityRecords()
 
             logger.info("Writing back activity records")
             self._writeBackActivityRecords()
+            self._writeBackServiceTraffic()
+
+            # Only now that everything they might be looking at is written back can the next stages start
+            if self._stagedTransfers:
+                logger.info("Handing %d activities off to the download workers" % len(self._stagedTransfers))
+                self._dispatchStagedTransfers()
+
+            # Everything's been persisted properly now
+            if not sync_result.Incomplete and (self._checkpoint["Activities"] or "SyncCheckpoint" in self.user):
+                self._clearCheckpoint()
 
             logger.info("Finalizing")
             # Clear non-persisted extended auth details.
-            self._destroyExtendedAuthData()
+            # (unless the later stages still need them, from this sync or an earlier one - they'll take care of it)
+            if not self._stagedTransfers and not db.sync_transfers.find_one({"UserID": self.user["_id"]}, {"_id": 1}):
+                self._destroyExtendedAuthData()
 
             logger.info("Unlocking user")
             # Unlock the user.
@@ -1178,6 +1831,8 @@ class SynchronizationTask:
         else:
             logger.info("Finished sync for %s (worker %d)" % (self.user["_id"], os.getpid()))
         finally:
+            # If we didn't get as far as unlocking, the lease will expire shortly.
+            self._releaseLease()
             self._closeUserLogging()
 
         return sync_result
@@ -1187,6 +1842,8 @@ class SynchronizationTaskResult:
     def __init__(self, force_next_sync=None, force_exhaustive=False):
         self.ForceNextSync = force_next_sync
         self.ForceExhaustive = force_exhaustive
+        self.LatestActivityTime = None
+        self.Incomplete = False # i.e. ran out of time, another slice is needed to finish up
 
     def ForceScheduleNextSyncOnOrBefore(self, next_sync):
         self.ForceNextSync = self.ForceNextSync if self.ForceNextSync and self.ForceNextSync < next_sync else next_sync
@@ -1201,7 +1858,15 @@ class ActivityShouldNotSynchronizeException(Exception):
 class SynchronizationCompleteException(Exception):
     pass
 
+class SynchronizationLockedException(Exception):
+    pass
+
 class SyncStep:
     List = "list"
     Download = "download"
     Upload = "upload"
+
+    def StallTimeout(step):
+        if step == SyncStep.List:
+            return timedelta(minutes=45)  # This can take a loooooooong time
+        return timedelta(minutes=10)  # But everything else shouldn't
@@ -2,3 +2,9 @@ from .sync import *
 from .interchange import *
 from .gpx import *
 from .statistics import *
+from .fit import *
+from .tcx import *
+from .timestamp_parser import *
+from .compression import *
+from .cpu_budget import *
+from .requests_lib import *
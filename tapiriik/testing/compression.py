@@ -0,0 +1,21 @@
+from tapiriik.testing.testtools import TestTools, TapiriikTestCase
+from tapiriik.services.compression import ActivityFileCompression
+from tapiriik.services.gpx import GPXIO
+
+import gzip
+
+
+class CompressionTests(TapiriikTestCase):
+    def test_round_trip(self):
+        svcA, other = TestTools.create_mock_services()
+        act = TestTools.create_random_activity(svcA, tz=True)
+        gpx = GPXIO.Dump(act)
+
+        compressed = ActivityFileCompression.CompressDump(GPXIO.Dump, act)
+        self.assertTrue(ActivityFileCompression.IsCompressed(compressed))
+        self.assertEqual(compressed, ActivityFileCompression.Compress(gpx))
+        self.assertEqual(gzip.decompress(compressed).decode("UTF-8"), gpx)
+        self.assertEqual(ActivityFileCompression.Decompress(compressed).decode("UTF-8"), gpx)
+
+    def test_decompress_passthrough(self):
+        self.assertEqual(ActivityFileCompression.Decompress(b"<gpx/>"), b"<gpx/>")
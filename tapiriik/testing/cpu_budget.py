@@ -0,0 +1,64 @@
+from tapiriik.testing.testtools import TapiriikTestCase
+import tapiriik.cpu_budget
+from tapiriik.cpu_budget import CooperativeCPUBudget, COOPERATIVE_MAX_SLEEP, apply_configured_worker_cpu_limit
+from tapiriik import settings
+
+
+class _FakeClock:
+    # Stands in for the time module, so we can see how long the budget sleeps without waiting it out
+    def __init__(self):
+        self.cpu = 0
+        self.wall = 0
+        self.sleeps = []
+
+    def process_time(self):
+        return self.cpu
+
+    def monotonic(self):
+        return self.wall
+
+    def sleep(self, duration):
+        self.sleeps.append(duration)
+        self.wall += duration
+
+
+class CPUBudgetTests(TapiriikTestCase):
+    def setUp(self):
+        self._clock = _FakeClock()
+        self._original_time = tapiriik.cpu_budget.time
+        tapiriik.cpu_budget.time = self._clock
+
+    def tearDown(self):
+        tapiriik.cpu_budget.time = self._original_time
+
+    def test_throttle(self):
+        budget = CooperativeCPUBudget(50)
+        self._clock.cpu += 1
+        self._clock.wall += 1
+        budget.Throttle()
+        self.assertEqual(self._clock.sleeps, [1])
+
+    def test_throttle_sleep_capped(self):
+        # 30s of CPU in 30s at 4% leaves 720s owed - far too long to go without a heartbeat
+        budget = CooperativeCPUBudget(4)
+        self._clock.cpu += 30
+        self._clock.wall += 30
+        for x in range(20):
+            budget.Throttle()
+        self.assertEqual(max(self._clock.sleeps), COOPERATIVE_MAX_SLEEP)
+        # ...but it all gets paid back eventually
+        self.assertAlmostEqual(sum(self._clock.sleeps), 720)
+
+    def test_configured_limit(self):
+        original = (settings.WORKER_CPU_LIMIT, settings.WORKER_CGROUP)
+        try:
+            settings.WORKER_CPU_LIMIT, settings.WORKER_CGROUP = None, None
+            self.assertEqual(apply_configured_worker_cpu_limit(), None)
+            settings.WORKER_CPU_LIMIT = 50
+            throttle = apply_configured_worker_cpu_limit()
+            self._clock.cpu += 1
+            self._clock.wall += 1
+            throttle()
+            self.assertEqual(self._clock.sleeps, [1])
+        finally:
+            settings.WORKER_CPU_LIMIT, settings.WORKER_CGROUP = original
@@ -0,0 +1,118 @@
+from tapiriik.testing.testtools import TestTools, TapiriikTestCase
+from tapiriik.services.fit import FITIO, FITMessageGenerator
+from tapiriik.services.interchange import ActivityType, ActivityStatistics, WaypointType
+
+from datetime import datetime, timedelta
+import io
+import struct
+import pytz
+
+
+class FITTests(TapiriikTestCase):
+    def _buildFile(self, records):
+        header = FITIO._generateHeader(len(records))
+        return header + records + struct.pack("<H", FITIO._calculateCRC(records, FITIO._calculateCRC(header)))
+
+    def test_constant_representation(self):
+        ''' ensures that FIT export and import round-trip, to within the precision of the format '''
+        svcA, other = TestTools.create_mock_services()
+        act = TestTools.create_random_activity(svcA, ActivityType.Cycling, tz=pytz.utc, withPauses=False)
+
+        act2 = FITIO.Parse(FITIO.Dump(act))
+
+        self.assertEqual(act2.Type, ActivityType.Cycling)
+        self.assertEqual(act2.StartTime, act.StartTime.replace(microsecond=0))
+        self.assertEqual(len(act2.Laps), len(act.Laps))
+        for lap, lap2 in zip(act.Laps, act2.Laps):
+            self.assertEqual(len(lap2.Waypoints), len(lap.Waypoints))
+            for wp, wp2 in zip(lap.Waypoints, lap2.Waypoints):
+                self.assertTrue(abs(wp2.Timestamp - wp.Timestamp) < timedelta(seconds=1))
+                self.assertEqual(wp2.HR, round(wp.HR) if wp.HR is not None else None)
+                if wp.Location and wp.Location.Latitude is not None:
+                    self.assertAlmostEqual(wp2.Location.Latitude, wp.Location.Latitude, places=6)
+                    self.assertAlmostEqual(wp2.Location.Longitude, wp.Location.Longitude, places=6)
+                if wp.Location and wp.Location.Altitude is not None:
+                    self.assertAlmostEqual(wp2.Location.Altitude, wp.Location.Altitude, delta=0.2)
+
+    def test_parse_into_activity(self):
+        ''' ensures what the caller already knows about the activity wins out over the file '''
+        svcA, other = TestTools.create_mock_services()
+        act = TestTools.create_random_activity(svcA, ActivityType.Cycling, tz=pytz.utc, withPauses=False)
+        raw = FITIO.Dump(act)
+
+        act2 = TestTools.create_blank_activity(svcA, ActivityType.Walking)
+        act2.Stats = ActivityStatistics(kcal=99)
+        act2 = FITIO.Parse(raw, act2)
+        self.assertEqual(act2.Type, ActivityType.Walking)
+        self.assertEqual(act2.Stats.Energy.Value, 99)
+        self.assertEqual(act2.CountTotalWaypoints(), act.CountTotalWaypoints())
+
+        # ...but the file fills in the blanks
+        act3 = TestTools.create_blank_activity(svcA)
+        self.assertEqual(FITIO.Parse(raw, act3).Type, ActivityType.Cycling)
+
+    def test_compressed_timestamps_developer_fields(self):
+        ''' ensures records with compressed timestamp headers and developer fields are read '''
+        records = b""
+        # file_id: type
+        records += struct.pack("<BBBHBBBB", 0x40, 0, 0, 0, 1, 0, 1, 0x00)
+        records += struct.pack("<BB", 0, 4)
+        # record: timestamp, heart_rate + a 2-byte developer field
+        records += struct.pack("<BBBHB" + "BBB" * 2, 0x41 | 0x20, 0, 0, 20, 2, 253, 4, 0x86, 3, 1, 0x02)
+        records += struct.pack("<BBBB", 1, 0, 2, 0)
+        start = 0x30000010
+        records += struct.pack("<BIBH", 1, start, 120, 0xBEEF)
+        # record: the same, minus the timestamp - that comes from the header instead
+        records += struct.pack("<BBBHBBBB", 0x42 | 0x20, 0, 0, 20, 1, 3, 1, 0x02)
+        records += struct.pack("<BBBB", 1, 0, 2, 0)
+        # Two compressed timestamp records - the second rolls the 5-bit offset over
+        records += struct.pack("<BBH", 0x80 | (2 << 5) | 0x1F, 121, 0xBEEF)
+        records += struct.pack("<BBH", 0x80 | (2 << 5) | 0x02, 122, 0xBEEF)
+
+        act = FITIO.Parse(self._buildFile(records))
+
+        waypoints = act.GetFlatWaypoints()
+        epoch = datetime(1989, 12, 31, tzinfo=pytz.utc)
+        self.assertEqual([wp.Timestamp for wp in waypoints], [epoch + timedelta(seconds=x) for x in (start, start + 0xF, start + 0x12)])
+        self.assertEqual([wp.HR for wp in waypoints], [120, 121, 122])
+        self.assertEqual(waypoints[0].Type, WaypointType.Start)
+        self.assertEqual(waypoints[-1].Type, WaypointType.End)
+
+    def test_generator_local_messages(self):
+        ''' ensures records are written with compressed timestamps where possible, and that running out of local message types doesn't lose anything '''
+        start = datetime(2015, 7, 8, 16, 13, 4)
+        fields = ["heart_rate", "cadence", "power", "temperature", "calories", "distance", "speed"]
+
+        def generate(interval):
+            fmg = FITMessageGenerator()
+            fmg.GenerateMessage("file_id", type=4)
+            expected = []
+            for x in range(200):
+                # Every combination of fields needs its own local message type - far more than the 16 available
+                record = {name: x % 50 for bit, name in enumerate(fields) if (x + 1) & (1 << bit)}
+                record["timestamp"] = start + timedelta(seconds=x * interval + (1000 if x == 100 else 0))
+                fmg.GenerateMessage("record", **record)
+                expected.append(record)
+            return fmg.GetResult(), expected
+
+        for interval in (7, 40):
+            records, expected = generate(interval)
+            messages = [message for name, message in FITIO._readMessages(io.BytesIO(self._buildFile(records))) if name == "record"]
+            self.assertEqual(len(messages), len(expected))
+            for message, record in zip(messages, expected):
+                self.assertEqual(message["timestamp"], record["timestamp"].replace(tzinfo=pytz.utc))
+                self.assertEqual(message.get("heart_rate"), record.get("heart_rate"))
+                self.assertEqual(message.get("distance"), record.get("distance"))
+
+        # Records 40 seconds apart can't have their timestamps compressed
+        self.assertTrue(len(generate(7)[0]) < len(generate(40)[0]))
+
+    def test_crc(self):
+        ''' ensures the CRC matches the FIT SDK's, and still covers the header when worked out as the file's written '''
+        self.assertEqual(FITIO._calculateCRC(b"123456789"), 0xBB3D)
+        self.assertEqual(FITIO._combineCRC(FITIO._calculateCRC(b"1234"), FITIO._calculateCRC(b"56789"), 5), 0xBB3D)
+
+        svcA, other = TestTools.create_mock_services()
+        act = TestTools.create_random_activity(svcA, ActivityType.Running, tz=pytz.utc)
+        # Running the CRC over the CRC itself leaves nothing
+        self.assertEqual(FITIO._calculateCRC(FITIO.Dump(act)), 0)
@@ -19,3 +19,20 @@ class GPXTests(TapiriikTestCase):
         act.Stats.Distance = act2.Stats.Distance = None  # same here
 
         self.assertActivitiesEqual(act2, act)
+
+    def test_metadata_only(self):
+        ''' ensures that a metadata-only parse places the activity the same as a full one '''
+        svcA, other = TestTools.create_mock_services()
+        act = TestTools.create_random_activity(svcA, tz=True, withPauses=False)
+
+        mid = GPXIO.Dump(act)
+        full = GPXIO.Parse(mid)
+        meta = GPXIO.Parse(mid, metadata_only=True)
+
+        self.assertEqual(meta.StartTime, full.StartTime)
+        self.assertEqual(meta.EndTime, full.EndTime)
+        self.assertEqual(meta.UID, full.UID)
+        self.assertEqual(len(meta.Laps), len(full.Laps))
+        self.assertEqual(meta.GetFirstWaypointWithLocation().Latitude, full.GetFirstWaypointWithLocation().Latitude)
+        for lap in meta.Laps:
+            self.assertLessEqual(len(lap.Waypoints), 2)
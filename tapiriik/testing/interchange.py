@@ -1,9 +1,13 @@
 from tapiriik.testing.testtools import TestTools, TapiriikTestCase
 
 from tapiriik.services import Service
-from tapiriik.services.interchange import Activity, ActivityType
+from tapiriik.services.gpx import GPXIO
+from tapiriik.services.tcx import TCXIO
+from tapiriik.services.interchange import Activity, ActivityType, ActivityStatistics, ActivityStatistic, ActivityStatisticUnit, Lap, Waypoint, WaypointType, WaypointList, Location
 
 from datetime import datetime, timedelta
+import copy
+import pytz
 
 
 class InterchangeTests(TapiriikTestCase):
@@ -63,3 +67,219 @@ class InterchangeTests(TapiriikTestCase):
 
         # Normal w/ Other + None
         self.assertEqual(ActivityType.PickMostSpecific([ActivityType.Other, ActivityType.Cycling, None, ActivityType.MountainBiking]), ActivityType.MountainBiking)
+
+    def test_waypoint_list(self):
+        tz = pytz.timezone("America/Toronto")
+        start = tz.localize(datetime(2014, 11, 2, 0, 30))
+        lap = Lap()
+        wps = [Waypoint(timestamp=start + timedelta(hours=x), location=Location(45 + x, -75, None), hr=100 + x) for x in range(4)]
+        lap.Waypoints = wps
+        self.assertTrue(type(lap.Waypoints) is WaypointList)
+
+        # The timestamps come back with the same tzinfo, across the DST change too
+        self.assertEqual([wp.Timestamp for wp in lap.Waypoints], [wp.Timestamp for wp in wps])
+        self.assertEqual(lap.Waypoints[3].Timestamp.tzinfo, wps[3].Timestamp.tzinfo)
+        self.assertEqual(lap.Waypoints.Column("HR"), [100, 101, 102, 103])
+
+        # Appended waypoints and their locations are adopted, so changes still stick
+        wps[1].HR = 150
+        wps[1].Location.Altitude = 12.5
+        self.assertEqual(lap.Waypoints[1].HR, 150)
+        self.assertEqual(lap.Waypoints[1].Location, Location(46, -75, 12.5))
+
+        # ...but only by the first list they went into, and the plain list itself was copied
+        otherLap = Lap()
+        otherLap.Waypoints.append(wps[1])
+        wps[1].HR = 160
+        self.assertEqual(otherLap.Waypoints[0].HR, 150)
+        self.assertEqual(lap.Waypoints[1].HR, 160)
+        wps.append(Waypoint(timestamp=start + timedelta(hours=4)))
+        self.assertEqual(len(lap.Waypoints), 4)
+        wps.pop()
+        wps[1].HR = 150
+
+        lap.Waypoints[2].Location = None
+        lap.Waypoints[0].Power = 250
+        lap.Waypoints[0].Type = WaypointType.Start
+        self.assertEqual(lap.Waypoints.Column("Latitude"), [45, 46, None, 48])
+        self.assertEqual(lap.Waypoints.Column("Power"), [250, None, None, None])
+        self.assertEqual(lap.Waypoints[1].Type, WaypointType.Regular)
+
+        # Rearranging the list leaves existing views with the old rows
+        last = lap.Waypoints[-1]
+        lap.Waypoints.insert(0, Waypoint(timestamp=start - timedelta(hours=1)))
+        del lap.Waypoints[1]
+        self.assertEqual(len(lap.Waypoints), 4)
+        self.assertEqual(lap.Waypoints[0].Location, None)
+        self.assertEqual(lap.Waypoints[-1].HR, 103)
+        self.assertEqual(last.HR, 103)
+
+        # Values that don't fit a typed column still go in
+        lap.Waypoints[1].HR = "abc"
+        self.assertEqual(lap.Waypoints.Column("HR"), [None, "abc", 102, 103])
+
+        lapCopy = copy.deepcopy(lap)
+        self.assertEqual(lapCopy.Waypoints, lap.Waypoints)
+        lapCopy.Waypoints[2].HR = 1
+        self.assertEqual(lap.Waypoints[2].HR, 102)
+
+        # Appends are packed in batches - what's changed before then (or appended twice) still comes out in order
+        batch = WaypointList()
+        wp = Waypoint(timestamp=start, hr=100)
+        batch.append(wp)
+        wp.HR = 110
+        batch.append(wp)
+        wp.HR = 120
+        batch.append(Waypoint(timestamp=start, cadence=90))
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(batch.Column("HR"), [120, 110, None])
+        self.assertTrue(isinstance(batch[0], Waypoint))
+
+        # Fields can be moved wholesale
+        batch.MoveColumn("Cadence", "RunCadence")
+        self.assertEqual(batch.Column("Cadence"), [None, None, None])
+        self.assertEqual(batch.Column("RunCadence"), [None, None, 90])
+
+    def test_activity_statistics_absent(self):
+        stats = ActivityStatistics(distance=1000, avg_hr=140)
+        self.assertEqual(stats.Present(), ["Distance", "HR"])
+
+        # Absent statistics still read as empty ones
+        self.assertEqual(stats.Power, ActivityStatistic(ActivityStatisticUnit.Watts))
+        self.assertEqual(stats.Power.Average, None)
+        self.assertEqual(stats.Power.asUnits(ActivityStatisticUnit.Watts).Max, None)
+        self.assertEqual(stats.Present(), ["Distance", "HR"])
+
+        # ...and writing to them fills them in
+        stats.Power.Average = 250
+        stats.Cadence.update(ActivityStatistic(ActivityStatisticUnit.RevolutionsPerMinute, max=95))
+        self.assertEqual(stats.Present(), ["Distance", "HR", "Cadence", "Power"])
+        self.assertEqual(stats.Power.Average, 250)
+        self.assertEqual(stats.Cadence.Max, 95)
+
+        other = ActivityStatistics()
+        other.Temperature = stats.Temperature
+        other.sumWith(stats)
+        self.assertEqual(other.Present(), ["Distance", "HR", "Cadence", "Power"])
+        self.assertEqual(other.Distance.Value, 1000)
+        self.assertEqual(copy.deepcopy(stats), stats)
+
+    def test_activity_sanity_checks(self):
+        svc = TestTools.create_mock_service("mockA")
+        act = TestTools.create_random_activity(svc, tz=pytz.utc, withLaps=False)
+        act.Stationary = False
+        act.GPS = True
+        act.Laps[0].Stats = act.Stats
+        act.CheckSanity()
+        act.CheckTimestampSanity()
+
+        # Once the timestamps have been pinned to the activity's TZ, the bounds and zones can be checked without going through them one by one
+        naive_list = WaypointList([Waypoint(timestamp=wp.Timestamp.replace(tzinfo=None)) for wp in act.Laps[0].Waypoints])
+        naive_list.LocalizeTimestamps(act.TZ)
+        self.assertEqual(naive_list.TimestampZones(), set([act.TZ]))
+        self.assertEqual(naive_list.TimestampBounds(), (min(wp.Timestamp for wp in act.Laps[0].Waypoints), max(wp.Timestamp for wp in act.Laps[0].Waypoints)))
+
+        # The first waypoint at fault decides the message
+        wps = act.Laps[0].Waypoints
+        wps[5].Location = Location(0, 0, None)
+        wps[3].Location.Latitude = 95
+        self.assertRaisesRegex(ValueError, "^Out of range lat/lng$", act.CheckSanity)
+        wps[3].Location = None
+        self.assertRaisesRegex(ValueError, "^Invalid lat/lng$", act.CheckSanity)
+        wps[5].Location = Location(45, -75, None)
+        act.CheckSanity()
+
+        wps[4].Timestamp = act.EndTime + timedelta(hours=1)
+        wps[6].Timestamp = act.StartTime - timedelta(hours=1)
+        self.assertRaisesRegex(ValueError, "^Waypoint occurs too far after lap$", act.CheckTimestampSanity)
+        wps[4].Timestamp = wps[4].Timestamp.astimezone(pytz.FixedOffset(60))
+        self.assertRaisesRegex(ValueError, "^Waypoint TZ mismatch", act.CheckTimestampSanity)
+
+    def test_activity_tz_retarget(self):
+        # Across a DST change, to make sure each timestamp still ends up with the right offset
+        naive_times = [datetime(2014, 11, 2, 0, 30) + timedelta(minutes=20 * x) for x in range(10)]
+        act = Activity()
+        act.StartTime = naive_times[0]
+        act.EndTime = naive_times[-1]
+        lap = Lap(startTime=act.StartTime, endTime=act.EndTime)
+        lap.Waypoints = [Waypoint(timestamp=x) for x in naive_times]
+        act.Laps = [lap]
+
+        act.TZ = pytz.timezone("America/Toronto")
+        act.DefineTZ()
+        localized_times = [act.TZ.localize(x) for x in naive_times]
+        self.assertEqual([str(wp.Timestamp) for wp in lap.Waypoints], [str(x) for x in localized_times])
+        self.assertEqual([wp.Timestamp.tzinfo for wp in lap.Waypoints], [x.tzinfo for x in localized_times])
+
+        # ...and into the gap when the clocks go forward
+        gap_times = [datetime(2014, 3, 9, 1, 30) + timedelta(minutes=20 * x) for x in range(6)]
+        gap_list = WaypointList([Waypoint(timestamp=x) for x in gap_times])
+        gap_list.LocalizeTimestamps(act.TZ)
+        self.assertEqual([str(wp.Timestamp) for wp in gap_list], [str(act.TZ.localize(x)) for x in gap_times])
+
+        act.TZ = pytz.timezone("Europe/Berlin")
+        act.AdjustTZ()
+        self.assertEqual([str(wp.Timestamp) for wp in lap.Waypoints], [str(x.astimezone(act.TZ)) for x in localized_times])
+        self.assertEqual([wp.Timestamp.tzinfo for wp in lap.Waypoints], [x.astimezone(act.TZ).tzinfo for x in localized_times])
+
+        # Anything added afterwards is left as-is
+        lap.Waypoints.append(Waypoint(timestamp=localized_times[0]))
+        self.assertEqual(str(lap.Waypoints[-1].Timestamp), str(localized_times[0]))
+
+    def test_prerendered_formats_invalidation(self):
+        # The original file can only be passed along if nothing's been done to the activity since it was read
+        start = datetime(2014, 6, 1, 12, 0, tzinfo=pytz.utc)
+        act = Activity(startTime=start, endTime=start + timedelta(minutes=1))
+        lap = Lap(startTime=act.StartTime, endTime=act.EndTime, stats=ActivityStatistics(avg_hr=150))
+        lap.Waypoints = [Waypoint(timestamp=start + timedelta(seconds=x), hr=140, distance=x * 5) for x in range(60)]
+        act.Laps = [lap]
+        act.Stats = ActivityStatistics(distance=300)
+
+        act.PrerenderedFormats["tcx"] = b"original"
+        act.CleanStats()
+        act.CleanWaypoints()
+        act.TZ = pytz.timezone("America/Toronto")
+        act.AdjustTZ()
+        self.assertEqual(act.PrerenderedFormats, {"tcx": b"original"})
+
+        lap.Stats.HR = ActivityStatistic(ActivityStatisticUnit.BeatsPerMinute, avg=1)
+        act.CleanStats()
+        self.assertEqual(act.PrerenderedFormats, {})
+
+        act.PrerenderedFormats["tcx"] = b"original"
+        lap.Waypoints[10].Distance = -1
+        act.CleanWaypoints()
+        self.assertEqual(act.PrerenderedFormats, {})
+        self.assertEqual(lap.Waypoints[10].Distance, 0)
+
+        act.PrerenderedFormats["tcx"] = b"original"
+        act.DefineTZ()
+        self.assertEqual(act.PrerenderedFormats, {})
+
+    def test_prerendered_formats_metadata(self):
+        # Dropbox only gets the file, so the original can't go out if sync has since given the activity a different name, notes or type
+        svc = TestTools.create_mock_service("mockA")
+        dropbox = Service.FromID("dropbox")
+        act = TestTools.create_random_activity(svc, ActivityType.Cycling, tz=pytz.utc)
+        for lap in act.Laps:
+            lap.Stats.Distance = ActivityStatistic(ActivityStatisticUnit.Meters, value=1000)  # TCX won't do without
+        act.Name = "Morning Ride"
+        act.Notes = None
+        original = TCXIO.Dump(act)
+        self.assertTrue(dropbox._prerendered_file_matches("tcx", original, act))
+
+        act.Notes = "Merged in from elsewhere"
+        self.assertFalse(dropbox._prerendered_file_matches("tcx", original, act))
+        act.Notes = None
+        act.Type = ActivityType.Running
+        self.assertFalse(dropbox._prerendered_file_matches("tcx", original, act))
+        # ...we'd have said Other
+        act.Type = ActivityType.MountainBiking
+        self.assertFalse(dropbox._prerendered_file_matches("tcx", original, act))
+
+        act.Type = ActivityType.Cycling
+        original = GPXIO.Dump(act)
+        act.Notes = "GPX has nowhere to put these"
+        self.assertTrue(dropbox._prerendered_file_matches("gpx", original, act))
+        act.Name = "Evening Ride"
+        self.assertFalse(dropbox._prerendered_file_matches("gpx", original, act))
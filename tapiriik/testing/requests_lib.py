@@ -0,0 +1,15 @@
+from tapiriik.testing.testtools import TapiriikTestCase
+from tapiriik.requests_lib import resolve_source_address
+
+
+class RequestsLibTests(TapiriikTestCase):
+    def test_resolve_source_address(self):
+        self.assertEqual(resolve_source_address("10.0.0.1", "garminconnect", 3), "10.0.0.1")
+        self.assertEqual(resolve_source_address(["10.0.0.1", "10.0.0.2"], None, 3), "10.0.0.2")
+
+        # Each affinity gets its own interfaces, everyone else gets the general pool
+        addresses = {None: ["10.0.0.1", "10.0.0.2"], "garminconnect": "10.0.1.1"}
+        self.assertEqual(resolve_source_address(addresses, "garminconnect", 1), "10.0.1.1")
+        self.assertEqual(resolve_source_address(addresses, "strava", 1), "10.0.0.2")
+        self.assertEqual(resolve_source_address(addresses), "10.0.0.1")
+        self.assertEqual(resolve_source_address({"garminconnect": "10.0.1.1"}), "0.0.0.0")
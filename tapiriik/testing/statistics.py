@@ -1,6 +1,9 @@
 from tapiriik.testing.testtools import TapiriikTestCase
 
-from tapiriik.services.interchange import ActivityStatistic, ActivityStatisticUnit
+from tapiriik.services.interchange import ActivityStatistic, ActivityStatisticUnit, Activity, Lap, Waypoint, WaypointType, Location
+from tapiriik.services.statistic_calculator import ActivityStatisticCalculator
+
+from datetime import datetime, timedelta
 
 
 class StatisticTests(TapiriikTestCase):
@@ -67,6 +70,13 @@ class StatisticTests(TapiriikTestCase):
         stat = ActivityStatistic(ActivityStatisticUnit.KilometersPerHour, value=100)
         self.assertEqual(stat.asUnits(ActivityStatisticUnit.KilometersPerHour).Value, 100)
 
+    def test_unitconv_bulk(self):
+        values = [0, 13.5, None, 100]
+        self.assertEqual(ActivityStatistic.convertValues(values, ActivityStatisticUnit.MetersPerSecond, ActivityStatisticUnit.MilesPerHour), [ActivityStatistic.convertValue(x, ActivityStatisticUnit.MetersPerSecond, ActivityStatisticUnit.MilesPerHour) if x is not None else None for x in values])
+        self.assertEqual(ActivityStatistic.convertValues(values, ActivityStatisticUnit.DegreesFahrenheit, ActivityStatisticUnit.DegreesCelcius)[2:], [None, (100 - 32) * 5/9])
+        self.assertEqual(ActivityStatistic.convertValues(values, ActivityStatisticUnit.Watts, ActivityStatisticUnit.Watts), values)
+        self.assertRaises(ValueError, ActivityStatistic.convertValues, values, ActivityStatisticUnit.KilometersPerHour, ActivityStatisticUnit.Meters)
+
     def test_stat_coalesce(self):
         stat1 = ActivityStatistic(ActivityStatisticUnit.Meters, value=1)
         stat2 = ActivityStatistic(ActivityStatisticUnit.Meters, value=2)
@@ -181,3 +191,20 @@ class StatisticTests(TapiriikTestCase):
         self.assertEqual(stat1.Value, 2)
         self.assertEqual(stat1.Max, 2)
         self.assertEqual(stat1.Gain, 3)
+
+    def test_calculator_multiple_laps(self):
+        start = datetime(2014, 1, 1, 12)
+        act = Activity()
+        act.Laps = [Lap(), Lap()]
+        # 10 seconds apart, with an explicit pause in the first lap and an implicit one (the 5 minute gap) at the start of the second
+        act.Laps[0].Waypoints = [Waypoint(start + timedelta(seconds=10 * x), location=Location(45, -75 + x * 0.001, None), hr=100 + x) for x in range(5)]
+        act.Laps[0].Waypoints[2].Type = WaypointType.Pause
+        act.Laps[1].Waypoints = [Waypoint(start + timedelta(seconds=340 + 10 * x), location=Location(45, -75 + (x + 5) * 0.001, None), hr=None if x == 0 else 200) for x in range(3)]
+
+        self.assertEqual(ActivityStatisticCalculator.CalculateTimerTime(act), timedelta(seconds=50))
+        self.assertEqual(ActivityStatisticCalculator.CalculateAverageMaxHR(act), ((100 + 101 + 102 + 103 + 104 + 200 + 200) / 7, 200))
+
+        # Only the segments between the pauses count towards the distance
+        segment = ActivityStatisticCalculator.CalculateDistance(act, act.Laps[1].Waypoints[0], act.Laps[1].Waypoints[1])
+        self.assertAlmostEqual(segment, 78.8, places=1)
+        self.assertAlmostEqual(ActivityStatisticCalculator.CalculateDistance(act), segment * 3, places=6)
@@ -1,13 +1,19 @@
 from tapiriik.testing.testtools import TestTools, TapiriikTestCase
 
-from tapiriik.sync import SynchronizationTask
+from tapiriik.sync import Sync, SynchronizationTask, SyncStep
+from tapiriik.sync.sync import _packActivities, _unpackActivities, _packUserException, SynchronizationLockedException
 from tapiriik.sync.activity_record import ActivityRecord
-from tapiriik.services import UserException, UserExceptionType
+from tapiriik.services import Service, ServiceExceptionScope, UserException, UserExceptionType
 from tapiriik.services.api import APIExcludeActivity
 from tapiriik.services.interchange import Activity, ActivityType
+from tapiriik.services.interchange import Lap
 from tapiriik.auth import User
+from tapiriik.database import db, cachedb
+import tapiriik.sync.sync
 
+from bson.objectid import ObjectId
 from datetime import datetime, timedelta, tzinfo
+import tempfile
 import pytz
 import copy
 
@@ -604,3 +610,369 @@ class SyncTests(TapiriikTestCase):
         eligible = s._determineEligibleRecipientServices(act, recipientServices)
         self.assertTrue(recA in eligible)
         self.assertTrue(recB in eligible)
+
+    def test_sync_interval_idle_backoff(self):
+        svcA, svcB = TestTools.create_mock_services()
+        user = {"ConnectedServices": [{"Service": svcA.ID}, {"Service": svcB.ID}]}
+
+        self.assertEqual(Sync._determineSyncInterval(user), Sync.SyncInterval)
+        self.assertEqual(Sync._determineSyncInterval(user, datetime.utcnow() - timedelta(hours=2)), Sync.SyncInterval)
+        interval = Sync._determineSyncInterval(user, datetime.utcnow() - timedelta(days=7))
+        self.assertTrue(Sync.SyncInterval < interval < Sync.MaximumSyncInterval)
+        self.assertEqual(Sync._determineSyncInterval(user, datetime.utcnow() - timedelta(days=365)), Sync.MaximumSyncInterval)
+
+    def test_sync_interval_trigger_coverage(self):
+        svcA = TestTools.create_mock_service("mockTriggerA")
+        svcB = TestTools.create_mock_service("mockTriggerB")
+        svcA.PartialSyncRequiresTrigger = True
+        user = {"ConnectedServices": [{"Service": svcA.ID}, {"Service": svcB.ID}]}
+
+        # One service still needs polling
+        self.assertEqual(Sync._determineSyncInterval(user), Sync.SyncInterval)
+
+        svcB.SuppliesActivities = False
+        self.assertEqual(Sync._determineSyncInterval(user), Sync.TriggeredSyncInterval)
+
+    def test_sync_slot_least_loaded(self):
+        earliest = datetime(2015, 1, 1, 12, 0, 30)
+        slots = Sync._enumerateSyncSlots(earliest, earliest + timedelta(minutes=10))
+        self.assertEqual(len(slots), 11)
+        self.assertEqual(slots[0], datetime(2015, 1, 1, 12, 0))
+
+        bookings = {slot: 5 for slot in slots}
+        bookings[slots[7]] = 2
+        self.assertEqual(Sync._leastLoadedSyncSlot(slots, bookings), slots[7])
+
+        del bookings[slots[3]]
+        self.assertEqual(Sync._leastLoadedSyncSlot(slots, bookings), slots[3])
+
+    def test_affinity_routing_key(self):
+        import tapiriik.sync.sync
+        user = {"ConnectedServices": [{"Service": "mockA"}, {"Service": "mockB"}]}
+        self.assertEqual(Sync.GetRoutingKey(user), "")
+
+        original_affinity_services = tapiriik.sync.sync.SYNC_AFFINITY_SERVICES
+        tapiriik.sync.sync.SYNC_AFFINITY_SERVICES = ["mockC", "mockB", "mockA"]
+        try:
+            self.assertEqual(Sync.GetRoutingKey(user), Sync._affinityRoutingKey("mockB"))
+            # The one we've been talking to the most wins out over the configured order
+            user["ServiceTraffic"] = {"mockA": 12, "mockB": 3}
+            self.assertEqual(Sync.GetRoutingKey(user), Sync._affinityRoutingKey("mockA"))
+            user["SynchronizationHostRestriction"] = "somehost"
+            self.assertEqual(Sync.GetRoutingKey(user), "somehost")
+
+            original_worker_affinity = tapiriik.sync.sync.WORKER_AFFINITY
+            tapiriik.sync.sync.WORKER_AFFINITY = "mockD"
+            try:
+                self.assertRaisesRegex(ValueError, "mockD", Sync.InitializeWorkerBindings)
+            finally:
+                tapiriik.sync.sync.WORKER_AFFINITY = original_worker_affinity
+        finally:
+            tapiriik.sync.sync.SYNC_AFFINITY_SERVICES = original_affinity_services
+
+    def test_user_lock_lease(self):
+        self.assertFalse(Sync.IsUserLocked({}))
+        self.assertTrue(Sync.IsUserLocked({"SynchronizationWorker": 1234, "SynchronizationLeaseExpiry": datetime.utcnow() + Sync.LockLeaseDuration}))
+        # The holder went away without unlocking
+        self.assertFalse(Sync.IsUserLocked({"SynchronizationWorker": 1234, "SynchronizationLeaseExpiry": datetime.utcnow() - timedelta(seconds=1)}))
+
+    def test_checkpoint_resume(self):
+        svcA, svcB = TestTools.create_mock_services()
+        recA = TestTools.create_mock_svc_record(svcA)
+        recB = TestTools.create_mock_svc_record(svcB)
+        actA = TestTools.create_blank_activity(svcA, record=recA)
+        actA.UIDs = set([actA.UID])
+        actA.Record = ActivityRecord.FromActivity(actA)
+        actB = TestTools.create_blank_activity(svcA, record=recA)
+        actB.StartTime += timedelta(hours=1)
+        actB.CalculateUID()
+        actB.UIDs = set([actB.UID])
+        actB.Record = ActivityRecord.FromActivity(actB)
+
+        s = SynchronizationTask(None)
+        s._serviceConnections = [recA, recB]
+        s._checkpoint = {"Activities": {actA.UID: {"Uploaded": [recB._id], "FailureCounts": {svcA.ID: 1}}}, "Downloading": {"UID": actB.UID, "Connection": recA._id}}
+
+        # Completed before the checkpoint - shouldn't be processed again, but what we knew about it should be restored
+        self.assertTrue(s._resumeActivityFromCheckpoint(actA))
+        self.assertEqual(actA.Record.GetFailureCount(recA), 1)
+        self.assertTrue(svcB.ID in actA.Record.PresentOnServices)
+
+        # In progress when the sync died - process it again, but count it against the service it was being downloaded from
+        self.assertFalse(s._resumeActivityFromCheckpoint(actB))
+        self.assertEqual(actB.Record.GetFailureCount(recA), 1)
+        self.assertFalse("Downloading" in s._checkpoint)
+
+    def _create_mock_sync_user(self, activity_count):
+        # A user with everything needed for a real run of SynchronizationTask - activity_count activities on mockA, all headed for mockB
+        svcA, svcB = TestTools.create_mock_services()
+        recA = TestTools.create_mock_svc_record(svcA)
+        recB = TestTools.create_mock_svc_record(svcB)
+        # The random IDs can collide (with each other, or with a previous test's) - these end up in the database, so they need to be unique
+        recA._id = str(ObjectId())
+        recB._id = str(ObjectId())
+        db.connections.insert({"_id": recA._id, "Service": svcA.ID, "ExternalID": recA.ExternalID})
+        db.connections.insert({"_id": recB._id, "Service": svcB.ID, "ExternalID": recB.ExternalID})
+        user = {"_id": ObjectId(), "ConnectedServices": [{"Service": svcA.ID, "ID": recA._id}, {"Service": svcB.ID, "ID": recB._id}], "Payments": [{"Expiry": None}]}
+        db.users.insert(user)
+
+        calls = {"List": 0, "Upload": []}
+
+        def list_activities(serviceRecord, exhaustive=False):
+            calls["List"] += 1
+            activities = []
+            for x in range(activity_count):
+                act = Activity(startTime=datetime(2015, 1, 1, 12, tzinfo=pytz.utc) + timedelta(days=x), tz=pytz.utc)
+                act.EndTime = act.StartTime + timedelta(hours=1)
+                act.Type = ActivityType.Rowing
+                act.ServiceData = {"ActivityID": x}
+                act.CalculateUID()
+                activities.append(act)
+            return activities, []
+
+        def download_activity(serviceRecord, activity):
+            activity.Laps = [Lap(startTime=activity.StartTime, endTime=activity.EndTime)]
+            activity.Stationary = True
+            activity.GPS = False
+            return activity
+
+        def upload_activity(serviceRecord, activity):
+            if svcB.RequiresExtendedAuthorizationDetails and not serviceRecord.ExtendedAuthorization:
+                raise Exception("Uploading without extended auth details")
+            calls["Upload"].append(activity.StartTime)
+
+        svcA.DownloadActivityList = list_activities
+        svcA.DownloadActivity = download_activity
+        svcB.DownloadActivityList = lambda serviceRecord, exhaustive=False: ([], [])
+        svcB.UploadActivity = upload_activity
+
+        original_priority_list = Service.PreferredDownloadPriorityList
+        original_log_path = tapiriik.sync.sync.USER_SYNC_LOGS
+        Service.PreferredDownloadPriorityList = lambda: [svcA, svcB]
+        tapiriik.sync.sync.USER_SYNC_LOGS = tempfile.mkdtemp() + "/"
+
+        def restore():
+            Service.PreferredDownloadPriorityList = original_priority_list
+            tapiriik.sync.sync.USER_SYNC_LOGS = original_log_path
+        self.addCleanup(restore)
+        return user, calls
+
+    def test_time_budget_progress(self):
+        user, calls = self._create_mock_sync_user(3)
+        # Even with next to no time, each slice gets something done
+        result = SynchronizationTask(user).Run(exhaustive=True, time_budget=timedelta(microseconds=1))
+        self.assertTrue(result.Incomplete)
+        self.assertEqual(len(calls["Upload"]), 1)
+
+        # ...and doesn't redo what the last one did
+        result = SynchronizationTask(db.users.find_one({"_id": user["_id"]})).Run(exhaustive=True, time_budget=timedelta(microseconds=1))
+        self.assertTrue(result.Incomplete)
+        self.assertEqual(len(calls["Upload"]), 2)
+        self.assertEqual(len(set(calls["Upload"])), 2)
+
+    def test_backfill_yields_to_sync(self):
+        user = {"_id": "test", "ConnectedServices": []}
+        # Nothing to do
+        self.assertEqual(Sync.PerformUserBackfill(user), None)
+
+        user["BackfillProgress"] = {"Requested": datetime.utcnow(), "Processed": 0, "Total": None}
+        user["QueuedAt"] = datetime.utcnow()
+        self.assertEqual(Sync.PerformUserBackfill(user), Sync.BackfillRetryInterval)
+
+        del user["QueuedAt"]
+        user["SynchronizationWorker"] = 1
+        user["SynchronizationLeaseExpiry"] = datetime.utcnow() + timedelta(seconds=30)
+        self.assertEqual(Sync.PerformUserBackfill(user), Sync.BackfillRetryInterval)
+
+    def test_backfill_slices(self):
+        user, calls = self._create_mock_sync_user(5)
+        db.users.update({"_id": user["_id"]}, {"$set": {"BackfillProgress": {"Requested": datetime.utcnow(), "Processed": 0, "Total": None}}})
+
+        original_batch_size = Sync.BackfillBatchSize
+        Sync.BackfillBatchSize = 2
+        try:
+            self.assertEqual(Sync.PerformUserBackfill(db.users.find_one({"_id": user["_id"]})), Sync.BackfillSliceInterval)
+            progress = db.users.find_one({"_id": user["_id"]})["BackfillProgress"]
+            self.assertEqual((progress["Processed"], progress["Total"]), (2, 5))
+
+            self.assertEqual(Sync.PerformUserBackfill(db.users.find_one({"_id": user["_id"]})), Sync.BackfillSliceInterval)
+            self.assertEqual(db.users.find_one({"_id": user["_id"]})["BackfillProgress"]["Processed"], 4)
+
+            self.assertEqual(Sync.PerformUserBackfill(db.users.find_one({"_id": user["_id"]})), None)
+        finally:
+            Sync.BackfillBatchSize = original_batch_size
+
+        # Listed the once, and worked through it oldest-first
+        self.assertEqual(calls["List"], 1)
+        self.assertEqual(calls["Upload"], sorted(calls["Upload"]))
+        self.assertEqual(len(set(calls["Upload"])), 5)
+        self.assertFalse("BackfillProgress" in db.users.find_one({"_id": user["_id"]}))
+        self.assertEqual(db.sync_backfills.find_one({"UserID": user["_id"]}), None)
+
+    def test_user_lock_race(self):
+        user, calls = self._create_mock_sync_user(1)
+        db.users.update({"_id": user["_id"]}, {"$set": {"BackfillProgress": {"Requested": datetime.utcnow(), "Processed": 0, "Total": None}}})
+        stale = db.users.find_one({"_id": user["_id"]})
+        # Someone else gets the lock after the user was read, but before the sync gets going
+        db.users.update({"_id": user["_id"]}, {"$set": {"SynchronizationWorker": 1234, "SynchronizationLeaseExpiry": datetime.utcnow() + Sync.LockLeaseDuration}})
+
+        self.assertRaises(SynchronizationLockedException, SynchronizationTask(stale).Run)
+        self.assertEqual(Sync.PerformUserBackfill(stale), Sync.BackfillRetryInterval)
+        self.assertEqual(calls["List"], 0)
+        current = db.users.find_one({"_id": user["_id"]})
+        self.assertEqual(current["SynchronizationWorker"], 1234)
+        self.assertFalse("Failures" in current["BackfillProgress"])
+
+        # Once their lease lapses, it's fair game
+        db.users.update({"_id": user["_id"]}, {"$set": {"SynchronizationLeaseExpiry": datetime.utcnow() - timedelta(seconds=1)}})
+        SynchronizationTask(db.users.find_one({"_id": user["_id"]})).Run()
+        self.assertEqual(calls["List"], 1)
+        self.assertFalse(Sync.IsUserLocked(db.users.find_one({"_id": user["_id"]})))
+
+    def test_backfill_failure(self):
+        user, calls = self._create_mock_sync_user(1)
+        db.users.update({"_id": user["_id"]}, {"$set": {"BackfillProgress": {"Requested": datetime.utcnow(), "Processed": 0, "Total": None}}})
+
+        def failing_run(*args, **kwargs):
+            raise Exception("Something broke")
+
+        original_run = SynchronizationTask.Run
+        SynchronizationTask.Run = failing_run
+        try:
+            for x in range(Sync.BackfillRetryCount - 1):
+                self.assertEqual(Sync.PerformUserBackfill(db.users.find_one({"_id": user["_id"]})), Sync.BackfillRetryInterval)
+            self.assertEqual(db.users.find_one({"_id": user["_id"]})["BackfillProgress"]["Failures"], Sync.BackfillRetryCount - 1)
+            # Then it's left to their next exhaustive sync
+            self.assertEqual(Sync.PerformUserBackfill(db.users.find_one({"_id": user["_id"]})), None)
+        finally:
+            SynchronizationTask.Run = original_run
+        user = db.users.find_one({"_id": user["_id"]})
+        self.assertFalse("BackfillProgress" in user)
+        self.assertTrue(user["NextSyncIsExhaustive"])
+
+    def test_backfill_eligibility(self):
+        user, calls = self._create_mock_sync_user(1)
+        self.assertTrue(Sync.CanBackfill(user))
+        user["Config"] = {"suppress_auto_sync": True}
+        self.assertFalse(Sync.CanBackfill(user))
+        del user["Config"]
+        del user["Payments"]
+        self.assertFalse(Sync.CanBackfill(user))
+
+        # They might have stopped being eligible partway through
+        user["BackfillProgress"] = {"Requested": datetime.utcnow(), "Processed": 0, "Total": None}
+        db.users.update({"_id": user["_id"]}, user)
+        self.assertEqual(Sync.PerformUserBackfill(user), None)
+        self.assertEqual(calls["List"], 0)
+        self.assertFalse("BackfillProgress" in db.users.find_one({"_id": user["_id"]}))
+
+    def test_pipeline_record_revision(self):
+        svcA, svcB = TestTools.create_mock_services()
+        recA = TestTools.create_mock_svc_record(svcA)
+        user = {"_id": ObjectId(), "ConnectedServices": [{"Service": svcA.ID, "ID": recA._id}]}
+        act = TestTools.create_blank_activity(svcA, record=recA)
+        act.UIDs = set([act.UID])
+        act.Record = ActivityRecord.FromActivity(act)
+
+        s = SynchronizationTask(user)
+        s._activityRecords = [act.Record]
+        s._writeBackActivityRecords()
+        self.addCleanup(db.activity_records.remove, {"UserID": user["_id"]})
+
+        # Made alongside the current records - goes through
+        act.Record.Name = "Staged"
+        s._transfer = {"RecordsRevision": s._activityRecordsRevision}
+        s._writeBackActivityRecord(act.Record)
+        self.assertEqual(db.activity_records.find_one({"UserID": user["_id"]})["Activities"][0]["Name"], "Staged")
+
+        # A later sync rewrote them in the meantime - left be
+        s._writeBackActivityRecords()
+        act.Record.Name = "Stale"
+        s._transfer = {"RecordsRevision": ObjectId()}
+        s._writeBackActivityRecord(act.Record)
+        records = db.activity_records.find_one({"UserID": user["_id"]})["Activities"]
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["Name"], "Staged")
+
+    def test_pipeline_expired_transfers(self):
+        user = {"_id": ObjectId(), "ConnectedServices": [{"Service": "mockA", "ID": ObjectId()}]}
+        db.users.insert(user)
+        self.addCleanup(db.users.remove, {"_id": user["_id"]})
+        cachedb.extendedAuthDetails.insert({"ID": user["ConnectedServices"][0]["ID"], "ExtendedAuthorization": {"Password": "hunter2"}})
+        self.addCleanup(cachedb.extendedAuthDetails.remove, {"ID": user["ConnectedServices"][0]["ID"]})
+        expired_id = db.sync_transfers.insert({"UserID": user["_id"], "Expires": datetime.utcnow() - timedelta(seconds=1)})
+        live_id = db.sync_transfers.insert({"UserID": user["_id"], "Expires": datetime.utcnow() + Sync.PipelineTransferLifetime})
+        self.addCleanup(db.sync_transfers.remove, {"UserID": user["_id"]}, multi=True)
+
+        # The other transfer still needs them
+        Sync.ClearExpiredTransfers()
+        self.assertEqual(db.sync_transfers.find_one({"_id": expired_id}), None)
+        self.assertNotEqual(cachedb.extendedAuthDetails.find_one({"ID": user["ConnectedServices"][0]["ID"]}), None)
+
+        db.sync_transfers.update({"_id": live_id}, {"$set": {"Expires": datetime.utcnow() - timedelta(seconds=1)}})
+        Sync.ClearExpiredTransfers()
+        self.assertEqual(db.sync_transfers.find_one({"UserID": user["_id"]}), None)
+        self.assertEqual(cachedb.extendedAuthDetails.find_one({"ID": user["ConnectedServices"][0]["ID"]}), None)
+
+    def _run_pipeline_stages(self, user, before_stages=None):
+        # Runs the sync proper in staged mode, then each stage the transfers are handed off to
+        published = []
+        original_publish = Sync._publishTransfer
+        Sync._publishTransfer = lambda transfer_id, stage: published.append(transfer_id)
+        self.addCleanup(setattr, Sync, "_publishTransfer", original_publish)
+        self.addCleanup(db.sync_transfers.remove, {"UserID": user["_id"]}, multi=True)
+
+        SynchronizationTask(user).Run(exhaustive=True, staged=True)
+        if before_stages:
+            before_stages()
+        while published:
+            transfer = db.sync_transfers.find_one({"_id": published.pop(0)})
+            SynchronizationTask(db.users.find_one({"_id": user["_id"]})).RunStage(transfer)
+
+    def test_pipeline_stage_extended_auth(self):
+        user, calls = self._create_mock_sync_user(2)
+        svcB = Service.FromID("mockB")
+        svcB.RequiresExtendedAuthorizationDetails = True
+        recB_id = user["ConnectedServices"][1]["ID"]
+        cachedb.extendedAuthDetails.insert({"ID": recB_id, "ExtendedAuthorization": {"Password": "hunter2"}})
+        self.addCleanup(cachedb.extendedAuthDetails.remove, {"ID": recB_id})
+
+        # The stages fill the credentials in the same as the sync does
+        self._run_pipeline_stages(user)
+        self.assertEqual(len(calls["Upload"]), 2)
+        # ...and the last one out cleared them away
+        self.assertEqual(cachedb.extendedAuthDetails.find_one({"ID": recB_id}), None)
+
+    def test_pipeline_stage_exclusions(self):
+        user, calls = self._create_mock_sync_user(2)
+        recB_id = user["ConnectedServices"][1]["ID"]
+
+        def block_destination():
+            # The destination was blocked after the transfers were staged
+            self.assertEqual(len(list(db.sync_transfers.find({"UserID": user["_id"]}))), 2)
+            db.connections.update({"_id": recB_id}, {"$set": {"SyncErrors": [{"Step": SyncStep.Upload, "Block": True, "Scope": ServiceExceptionScope.Service, "UserException": _packUserException(UserException(UserExceptionType.Authorization))}]}})
+
+        self._run_pipeline_stages(user, before_stages=block_destination)
+        self.assertEqual(calls["Upload"], [])
+        self.assertEqual(db.sync_transfers.find_one({"UserID": user["_id"]}), None)
+
+    def test_pipeline_activity_packing(self):
+        svcA, svcB = TestTools.create_mock_services()
+        recA = TestTools.create_mock_svc_record(svcA)
+        recB = TestTools.create_mock_svc_record(svcB)
+        act = TestTools.create_random_activity(svcA, tz=True, record=recA)
+        act.ServiceDataCollection = {recA._id: {"ActivityID": 1}} # The mock service data refers back to the record
+        act.UIDs = set([act.UID])
+        act.Record = ActivityRecord.FromActivity(act)
+        full_act = copy.copy(act)
+        full_act.SourceConnection = recA
+
+        packed = _packActivities(act, full_act)
+        self.assertEqual(full_act.SourceConnection, recA) # Left as it was
+
+        unpacked_act, unpacked_full_act = _unpackActivities(packed, [recA, recB])
+        self.assertEqual(unpacked_act.UID, act.UID)
+        self.assertEqual(unpacked_full_act.SourceConnection, recA)
+        self.assertFalse(hasattr(unpacked_act, "SourceConnection"))
+        self.assertTrue(unpacked_act.Record is unpacked_full_act.Record)
+        self.assertEqual(len(unpacked_full_act.GetFlatWaypoints()), len(full_act.GetFlatWaypoints()))
@@ -0,0 +1,100 @@
+from tapiriik.testing.testtools import TestTools, TapiriikTestCase
+from tapiriik.services.tcx import TCXIO
+from tapiriik.services.interchange import ActivityStatistic, ActivityStatisticUnit
+from tapiriik.services.xmlwriter import StreamingXMLWriter
+from lxml import etree
+
+import gzip
+import io
+import pytz
+
+
+class TCXTests(TapiriikTestCase):
+    def test_constant_representation(self):
+        ''' ensures that tcx import/export is symetric, whether it's read from a string or a stream '''
+        svcA, other = TestTools.create_mock_services()
+        svcA.SupportsHR = svcA.SupportsCadence = svcA.SupportsPower = True
+        act = TestTools.create_random_activity(svcA, tz=pytz.utc, withPauses=False)
+        for lap in act.Laps:
+            lap.Stats.Distance = ActivityStatistic(ActivityStatisticUnit.Meters, value=1000)  # TCX won't do without
+
+        mid = TCXIO.Dump(act)
+
+        for act2 in (TCXIO.Parse(mid), TCXIO.Parse(io.BytesIO(mid.encode("UTF-8")))):
+            self.assertEqual(len(act2.Laps), len(act.Laps))
+            for lap, lap2 in zip(act.Laps, act2.Laps):
+                self.assertEqual(len(lap2.Waypoints), len(lap.Waypoints))
+                for wp, wp2 in zip(lap.Waypoints, lap2.Waypoints):
+                    self.assertEqual(wp2.Timestamp, wp.Timestamp)
+                    self.assertEqual(wp2.HR, wp.HR)
+                    if wp.Location and wp.Location.Latitude is not None:
+                        self.assertEqual(wp2.Location.Latitude, wp.Location.Latitude)
+                        self.assertEqual(wp2.Location.Longitude, wp.Location.Longitude)
+
+    def test_streamed_dump(self):
+        ''' ensures that tcx written straight into a (compressed) stream is the same as what's returned as a string '''
+        svcA, other = TestTools.create_mock_services()
+        act = TestTools.create_random_activity(svcA, tz=pytz.utc)
+        act.Name = "Caf\u00e9 <&>"
+
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode="wb") as gzout:
+            self.assertIsNone(TCXIO.Dump(act, gzout))
+
+        self.assertEqual(gzip.decompress(buf.getvalue()).decode("UTF-8"), TCXIO.Dump(act))
+
+    def test_streaming_writer(self):
+        ''' ensures that the streaming writer (chunks and all) comes out the same as serializing the whole tree '''
+        xsi = "{" + TCXIO.Namespaces["xsi"] + "}"
+        def fill(parent, start, end):
+            for idx in range(start, end):
+                xpt = etree.SubElement(parent, "Trackpoint")
+                xpt.attrib[xsi + "type"] = "Point_t <%d>" % idx
+                etree.SubElement(xpt, "Time").text = "T%d & co" % idx
+                etree.SubElement(etree.SubElement(xpt, "Extensions"), "{http://example.com/ext}Value").text = str(idx)
+
+        root = etree.Element("TrainingCenterDatabase", nsmap=TCXIO.Namespaces)
+        xact = etree.SubElement(etree.SubElement(root, "Activities"), "Activity", Sport="Biking")
+        etree.SubElement(xact, "Id").text = "x"
+        fill(etree.SubElement(xact, "Track"), 0, StreamingXMLWriter.ChunkSize + 3)
+        etree.SubElement(xact, "Empty")
+
+        buf = io.BytesIO()
+        writer = StreamingXMLWriter(buf, etree.Element("TrainingCenterDatabase", nsmap=TCXIO.Namespaces))
+        writer.Start(writer.Element("Activities"))
+        writer.Start(writer.Element("Activity", attrib={"Sport": "Biking"}))
+        xid = writer.Element("Id")
+        xid.text = "x"
+        writer.Write(xid)
+        writer.Start(writer.Element("Track"))
+        chunk = writer.Chunk()
+        fill(chunk, 0, StreamingXMLWriter.ChunkSize)
+        writer.WriteChunk(chunk)
+        chunk = writer.Chunk()
+        fill(chunk, StreamingXMLWriter.ChunkSize, StreamingXMLWriter.ChunkSize + 3)
+        writer.WriteChunk(chunk)
+        writer.WriteChunk(writer.Chunk())
+        writer.End()
+        writer.Start(writer.Element("Empty"))
+        writer.Close()
+
+        self.assertEqual(buf.getvalue(), etree.tostring(root, pretty_print=True, xml_declaration=True, encoding="UTF-8"))
+
+    def test_metadata_only(self):
+        ''' ensures that a metadata-only parse places the activity the same as a full one '''
+        svcA, other = TestTools.create_mock_services()
+        act = TestTools.create_random_activity(svcA, tz=pytz.utc)
+        for lap in act.Laps:
+            lap.Stats.Distance = ActivityStatistic(ActivityStatisticUnit.Meters, value=1000)
+
+        mid = TCXIO.Dump(act)
+        full = TCXIO.Parse(mid)
+        meta = TCXIO.Parse(mid, metadata_only=True)
+
+        self.assertEqual(meta.StartTime, full.StartTime)
+        self.assertEqual(meta.EndTime, full.EndTime)
+        self.assertEqual(meta.UID, full.UID)
+        self.assertEqual(len(meta.Laps), len(full.Laps))
+        self.assertEqual(meta.GetFirstWaypointWithLocation().Latitude, full.GetFirstWaypointWithLocation().Latitude)
+        for lap in meta.Laps:
+            self.assertLessEqual(len(lap.Waypoints), 2)
@@ -0,0 +1,27 @@
+from tapiriik.testing.testtools import TapiriikTestCase
+from tapiriik.services.timestamp_parser import TimestampParser
+
+from datetime import datetime, timedelta
+from dateutil.tz import tzutc
+
+
+class TimestampParserTests(TapiriikTestCase):
+    def test_fixed_formats(self):
+        self.assertEqual(TimestampParser.Parse("2014-06-01T12:34:56Z"), datetime(2014, 6, 1, 12, 34, 56, tzinfo=tzutc()))
+        self.assertEqual(TimestampParser.Parse("2014-06-01T12:34:56.1234567Z"), datetime(2014, 6, 1, 12, 34, 56, 123456, tzinfo=tzutc()))
+        self.assertEqual(TimestampParser.Parse("2014-06-01 12:34:56 UTC"), datetime(2014, 6, 1, 12, 34, 56, tzinfo=tzutc()))
+        self.assertEqual(TimestampParser.Parse("2014-06-01T12:34"), datetime(2014, 6, 1, 12, 34))
+        self.assertEqual(TimestampParser.Parse("2014-06-01"), datetime(2014, 6, 1))
+
+        result = TimestampParser.Parse("2014-06-01T12:34:56.5-04:30")
+        self.assertEqual(result.replace(tzinfo=None), datetime(2014, 6, 1, 12, 34, 56, 500000))
+        self.assertEqual(result.utcoffset(), -timedelta(hours=4, minutes=30))
+        self.assertEqual(TimestampParser.Parse("2014-06-01T12:34:56+0200").utcoffset(), timedelta(hours=2))
+        self.assertEqual(TimestampParser.Parse("2014-06-01T12:34:56+00:00").tzinfo, tzutc())
+
+        self.assertIsNone(TimestampParser.Parse("2014-06-01T12:34:56+02:00", ignoretz=True).tzinfo)
+
+    def test_fallback(self):
+        self.assertEqual(TimestampParser.Parse("June 1 2014 12:34"), datetime(2014, 6, 1, 12, 34))
+        self.assertRaises(ValueError, TimestampParser.Parse, "2014-06-01T25:00:00Z")
+        self.assertRaises(ValueError, TimestampParser.Parse, "not a date")
@@ -398,6 +398,8 @@ tapiriik.OpenDropboxConfigDialog = function(){
 			<select id=\"format\">\
 				<option value=\"tcx\">.tcx</option>\
 				<option value=\"gpx\">.gpx</option>\
+				<option value=\"tcx.gz\">.tcx.gz</option>\
+				<option value=\"gpx.gz\">.gpx.gz</option>\
 			</select>\
 			<tt><span id=\"exampleName\">test/asd.tcx</span></tt><br/>\
 			(you can include folders, try <tt>/&lt;YYYY&gt;/&lt;MMM&gt;/&lt;NAME&gt;</tt>)<br/>\
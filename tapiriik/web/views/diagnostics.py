@@ -32,9 +32,11 @@ def diag_queue_dashboard(req):
     # We fetch this twice so the (orphaned) indicators are correct even if there were writes during all these other queries
     context["allWorkerPIDsPre"] = [x["Process"] for x in db.sync_workers.find()]
 
-    context["lockedSyncUsers"] = list(db.users.find({"SynchronizationWorker": {"$ne": None}}))
+    context["lockedSyncUsers"] = list(db.users.find(Sync.LockedUserMongoQuery()))
     context["lockedSyncRecords"] = len(context["lockedSyncUsers"])
-    context["queuedUnlockedUsers"] = list(db.users.find({"SynchronizationWorker": {"$exists": False}, "QueuedAt": {"$ne": None}}))
+    queuedUnlockedQuery = {"QueuedAt": {"$ne": None}}
+    queuedUnlockedQuery.update(Sync.UnlockedUserMongoQuery())
+    context["queuedUnlockedUsers"] = list(db.users.find(queuedUnlockedQuery))
 
     context["userCt"] = db.users.count()
     context["scheduledCt"] = db.users.find({"$or":[{"NextSynchronization": {"$ne": None, "$exists": True}}, {"QueuedAt": {"$ne": None, "$exists": True}}]}).count()
@@ -74,10 +76,12 @@ def diag_queue_dashboard(req):
         delta = True
     if "unlockOrphaned" in req.POST:
         orphanedUserIDs = [x["_id"] for x in context["lockedSyncUsers"] if x["SynchronizationWorker"] not in context["allWorkerPIDs"]]
-        db.users.update({"_id":{"$in":orphanedUserIDs}}, {"$unset": {"SynchronizationWorker": None}}, multi=True)
+        db.users.update({"_id":{"$in":orphanedUserIDs}}, {"$unset": {"SynchronizationWorker": None, "SynchronizationLeaseExpiry": None}}, multi=True)
         delta = True
     if "requeueQueued" in req.POST:
-        db.users.update({"QueuedAt": {"$lt": datetime.utcnow()}, "$or": [{"SynchronizationWorker": {"$exists": False}}, {"SynchronizationWorker": None}]}, {"$set": {"NextSynchronization": datetime.utcnow(), "QueuedGeneration": "manual"}, "$unset": {"QueuedAt": True}}, multi=True)
+        requeueQuery = {"QueuedAt": {"$lt": datetime.utcnow()}}
+        requeueQuery.update(Sync.UnlockedUserMongoQuery())
+        db.users.update(requeueQuery, {"$set": {"NextSynchronization": datetime.utcnow(), "QueuedGeneration": "manual"}, "$unset": {"QueuedAt": True, "NextSyncIsPeriodic": True}}, multi=True)
 
     if delta:
         return redirect("diagnostics_queue_dashboard")
@@ -148,9 +152,10 @@ def diag_user(req, user):
     if "sync" in req.POST:
         Sync.ScheduleImmediateSync(userRec, req.POST["sync"] == "Full")
     elif "unlock" in req.POST:
-        db.users.update({"_id": ObjectId(user)}, {"$unset": {"SynchronizationWorker": None}})
+        db.users.update({"_id": ObjectId(user)}, {"$unset": {"SynchronizationWorker": None, "SynchronizationLeaseExpiry": None}})
     elif "lock" in req.POST:
-        db.users.update({"_id": ObjectId(user)}, {"$set": {"SynchronizationWorker": 1}})
+        # Nobody's going to renew this one
+        db.users.update({"_id": ObjectId(user)}, {"$set": {"SynchronizationWorker": 1, "SynchronizationLeaseExpiry": datetime.max}})
     elif "requeue" in req.POST:
         db.users.update({"_id": ObjectId(user)}, {"$unset": {"QueuedAt": None}})
     elif "hostrestrict" in req.POST:
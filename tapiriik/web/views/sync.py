@@ -39,10 +39,11 @@ def sync_status(req):
 
     sync_status_dict = {"NextSync": (pendingSyncTime.ctime() + " UTC") if pendingSyncTime else None,
                         "LastSync": (req.user["LastSynchronization"].ctime() + " UTC") if "LastSynchronization" in req.user and req.user["LastSynchronization"] is not None else None,
-                        "Synchronizing": "SynchronizationWorker" in req.user,
+                        "Synchronizing": Sync.IsUserLocked(req.user),
                         "SynchronizationProgress": req.user["SynchronizationProgress"] if "SynchronizationProgress" in req.user else None,
                         "SynchronizationStep": req.user["SynchronizationStep"] if "SynchronizationStep" in req.user else None,
                         "SynchronizationWaitTime": None, # I wish.
+                        "Backfill": {"Processed": req.user["BackfillProgress"]["Processed"], "Total": req.user["BackfillProgress"]["Total"]} if "BackfillProgress" in req.user else None,
                         "Hash": syncHash}
 
     if stats and "QueueHeadTime" in stats: